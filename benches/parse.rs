@@ -0,0 +1,85 @@
+//! Criterion benchmarks of fiasto parsing and lexing over the formula corpus.
+//!
+//! Conversion to Python objects needs an interpreter and is measured by
+//! `benchmarks/bench_layers.py`. After the timings, the peak heap usage of
+//! one parse and one lex of each formula is printed, tracked by a counting
+//! global allocator.
+
+use std::alloc::{GlobalAlloc, Layout, System};
+use std::hint::black_box;
+use std::sync::atomic::{AtomicUsize, Ordering};
+
+use criterion::{criterion_group, criterion_main, BenchmarkId, Criterion, Throughput};
+
+const CORPUS: &str = include_str!("../benchmarks/corpus.txt");
+
+/// System allocator that tracks current and peak allocated bytes
+struct CountingAllocator;
+
+static CURRENT: AtomicUsize = AtomicUsize::new(0);
+static PEAK: AtomicUsize = AtomicUsize::new(0);
+
+unsafe impl GlobalAlloc for CountingAllocator {
+    unsafe fn alloc(&self, layout: Layout) -> *mut u8 {
+        let ptr = System.alloc(layout);
+        if !ptr.is_null() {
+            let current = CURRENT.fetch_add(layout.size(), Ordering::Relaxed) + layout.size();
+            PEAK.fetch_max(current, Ordering::Relaxed);
+        }
+        ptr
+    }
+
+    unsafe fn dealloc(&self, ptr: *mut u8, layout: Layout) {
+        System.dealloc(ptr, layout);
+        CURRENT.fetch_sub(layout.size(), Ordering::Relaxed);
+    }
+}
+
+#[global_allocator]
+static ALLOCATOR: CountingAllocator = CountingAllocator;
+
+fn corpus() -> impl Iterator<Item = (&'static str, &'static str)> {
+    CORPUS.lines().filter_map(|line| line.split_once('\t'))
+}
+
+/// Peak bytes allocated above the starting level while running `f`
+fn peak_bytes<T>(f: impl FnOnce() -> T) -> usize {
+    let start = CURRENT.load(Ordering::Relaxed);
+    PEAK.store(start, Ordering::Relaxed);
+    drop(black_box(f()));
+    PEAK.load(Ordering::Relaxed) - start
+}
+
+fn bench_parse(c: &mut Criterion) {
+    let mut group = c.benchmark_group("parse");
+    for (name, formula) in corpus() {
+        group.throughput(Throughput::Bytes(formula.len() as u64));
+        group.bench_with_input(BenchmarkId::from_parameter(name), formula, |b, formula| {
+            b.iter(|| fiasto::parse_formula(black_box(formula)))
+        });
+    }
+    group.finish();
+}
+
+fn bench_lex(c: &mut Criterion) {
+    let mut group = c.benchmark_group("lex");
+    for (name, formula) in corpus() {
+        group.throughput(Throughput::Bytes(formula.len() as u64));
+        group.bench_with_input(BenchmarkId::from_parameter(name), formula, |b, formula| {
+            b.iter(|| fiasto::lex_formula(black_box(formula)))
+        });
+    }
+    group.finish();
+}
+
+fn report_memory(_: &mut Criterion) {
+    println!("\n{:<24} {:>14} {:>14}", "formula", "parse peak (B)", "lex peak (B)");
+    for (name, formula) in corpus() {
+        let parse = peak_bytes(|| fiasto::parse_formula(formula));
+        let lex = peak_bytes(|| fiasto::lex_formula(formula));
+        println!("{:<24} {:>14} {:>14}", name, parse, lex);
+    }
+}
+
+criterion_group!(benches, bench_parse, bench_lex, report_memory);
+criterion_main!(benches);
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Benchmark parse_formula on formulas of increasing size.
+
+Run it once per build and compare the saved results to see the effect of a
+change to the Rust-to-Python conversion:
+
+    python benchmarks/bench_conversion.py --save before.json
+    # rebuild with `maturin develop --release`
+    python benchmarks/bench_conversion.py --compare before.json
+"""
+
+import argparse
+import json
+import timeit
+
+import fiasto_py
+
+
+def make_formula(n_terms, interaction_every=4):
+    """Build a formula with `n_terms` predictors and a 2-way interaction every few terms"""
+    terms = []
+    for i in range(n_terms):
+        if interaction_every and i % interaction_every == interaction_every - 1:
+            terms.append(f"x{i}*x{i - 1}")
+        else:
+            terms.append(f"x{i}")
+    return "y ~ " + " + ".join(terms) + " + (1 + x0|group)"
+
+
+def bench(n_terms, repeat=5):
+    """Return the best per-call time (seconds) of parse_formula for one formula size"""
+    formula = make_formula(n_terms)
+    fiasto_py.parse_formula(formula)
+    number = max(1, 2000 // n_terms)
+    timer = timeit.Timer(lambda: fiasto_py.parse_formula(formula))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    """Run the benchmark and optionally save or compare results"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 50, 100, 200])
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="compare against results saved with --save")
+    args = parser.parse_args()
+
+    results = {str(n): bench(n) for n in args.sizes}
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print(f"{'terms':>6} {'time (us)':>12} {'baseline (us)':>14} {'speedup':>8}")
+    for n, seconds in results.items():
+        line = f"{n:>6} {seconds * 1e6:>12.1f}"
+        if n in baseline:
+            line += f" {baseline[n] * 1e6:>14.1f} {baseline[n] / seconds:>7.2f}x"
+        print(line)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
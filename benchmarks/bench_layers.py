@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+pytest-benchmark suite timing each layer separately over the formula corpus.
+
+- parse: fiasto parsing only (`parse()` converts nothing up front)
+- lex: fiasto lexing only (`lex()` returns three compact buffers)
+- conversion: building the Python dict from an already parsed formula
+- end_to_end: `parse_formula()` and `lex_formula()`, parsing plus conversion
+
+Peak Python memory of each layer, measured with tracemalloc, is attached to
+the results as `extra_info["peak_bytes"]`. Memory allocated by Rust is
+reported by the criterion benches (`cargo bench`).
+
+    pytest benchmarks/bench_layers.py --benchmark-save=before
+    # rebuild with `maturin develop --release`
+    pytest benchmarks/bench_layers.py --benchmark-compare=0001 --benchmark-compare-fail=median:10%
+"""
+
+import tracemalloc
+
+import pytest
+import fiasto_py
+
+from corpus import CORPUS
+
+pytest.importorskip("pytest_benchmark")
+
+NAMES = [name for name, _ in CORPUS]
+FORMULAS = dict(CORPUS)
+
+
+@pytest.fixture(autouse=True)
+def no_cache():
+    """Disable the parse cache so every call parses"""
+    info = fiasto_py.cache_info()
+    fiasto_py.configure_cache(0)
+    yield
+    fiasto_py.configure_cache(info.maxsize)
+
+
+def peak_bytes(function, *args):
+    """Peak Python heap usage of one call"""
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(benchmark, function, *args):
+    """Time `function(*args)` and record its peak Python memory"""
+    benchmark.extra_info["peak_bytes"] = peak_bytes(function, *args)
+    benchmark(function, *args)
+
+
+@pytest.mark.parametrize("name", NAMES)
+def test_parse(benchmark, name):
+    """Time fiasto parsing without conversion"""
+    benchmark.group = "parse"
+    run(benchmark, fiasto_py.parse, FORMULAS[name])
+
+
+@pytest.mark.parametrize("name", NAMES)
+def test_lex(benchmark, name):
+    """Time fiasto lexing without per-token conversion"""
+    benchmark.group = "lex"
+    run(benchmark, fiasto_py.lex, FORMULAS[name])
+
+
+@pytest.mark.parametrize("name", NAMES)
+def test_conversion(benchmark, name):
+    """Time converting a parse result to Python objects"""
+    benchmark.group = "conversion"
+    parsed = fiasto_py.parse(FORMULAS[name])
+    run(benchmark, parsed.to_dict)
+
+
+@pytest.mark.parametrize("name", NAMES)
+def test_parse_formula(benchmark, name):
+    """Time parse_formula end to end"""
+    benchmark.group = "parse_formula"
+    run(benchmark, fiasto_py.parse_formula, FORMULAS[name])
+
+
+@pytest.mark.parametrize("name", NAMES)
+def test_lex_formula(benchmark, name):
+    """Time lex_formula end to end"""
+    benchmark.group = "lex_formula"
+    run(benchmark, fiasto_py.lex_formula, FORMULAS[name])
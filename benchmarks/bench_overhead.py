@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+pytest-benchmark suite tracking the fixed cost of a call and of the import.
+
+`y ~ x` parses in well under a microsecond in Rust, so its timings are
+dominated by argument extraction, result conversion and import-time setup.
+`len` is timed alongside as the floor of any Python call on this machine.
+
+    pytest benchmarks/bench_overhead.py --benchmark-save=before
+    # rebuild with `maturin develop --release`
+    pytest benchmarks/bench_overhead.py --benchmark-compare=0001 --benchmark-compare-fail=median:10%
+"""
+
+import subprocess
+import sys
+
+import pytest
+import fiasto_py
+
+pytest.importorskip("pytest_benchmark")
+
+FORMULA = "y ~ x"
+
+
+@pytest.fixture(autouse=True)
+def no_cache():
+    """Disable the parse cache so every call parses"""
+    info = fiasto_py.cache_info()
+    fiasto_py.configure_cache(0)
+    yield
+    fiasto_py.configure_cache(info.maxsize)
+
+
+def test_call_floor(benchmark):
+    """Time a builtin call on a string, the lower bound for any call"""
+    benchmark.group = "overhead"
+    benchmark(len, FORMULA)
+
+
+@pytest.mark.parametrize("function", ["parse_formula", "lex_formula", "parse", "lex", "validate"])
+def test_small_formula(benchmark, function):
+    """Time one call on `y ~ x`"""
+    benchmark.group = "overhead"
+    benchmark(getattr(fiasto_py, function), FORMULA)
+
+
+def test_cached_parse_formula(benchmark):
+    """Time a parse cache hit, which leaves only extraction and conversion"""
+    benchmark.group = "overhead"
+    fiasto_py.configure_cache(16)
+    fiasto_py.parse_formula(FORMULA)
+    benchmark(fiasto_py.parse_formula, FORMULA)
+
+
+def test_import(benchmark):
+    """Time importing the module in a fresh interpreter"""
+    benchmark.group = "import"
+    command = [sys.executable, "-c", "import fiasto_py"]
+    benchmark.pedantic(subprocess.run, args=(command,), kwargs={"check": True}, rounds=10, warmup_rounds=1)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Measure parse_formula throughput as the number of Python threads grows.
+
+Each thread parses the corpus formulas in a loop for a fixed time. On a
+free-threaded build (python3.13t) throughput should grow almost linearly
+with the thread count up to the number of cores; with the GIL it stays flat.
+Every result is also checked against a single-threaded parse, so the run
+doubles as a stress test of the shared state.
+
+    python3.13t benchmarks/bench_threads.py
+    python3.13t benchmarks/bench_threads.py --threads 1 2 4 8 16 --cache 128
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+import fiasto_py
+
+from corpus import CORPUS
+
+
+def worker(formulas, expected, barrier, deadline, counts, index):
+    """Parse formulas until the deadline, recording how many were parsed"""
+    barrier.wait()
+    count = 0
+    while time.perf_counter() < deadline[0]:
+        for formula, result in zip(formulas, expected):
+            if fiasto_py.parse_formula(formula) != result:
+                counts[index] = None
+                return
+        count += len(formulas)
+    counts[index] = count
+
+
+def throughput(n_threads, formulas, expected, seconds):
+    """Return formulas parsed per second across `n_threads` threads"""
+    barrier = threading.Barrier(n_threads + 1)
+    deadline = [0.0]
+    counts = [0] * n_threads
+    threads = [
+        threading.Thread(target=worker, args=(formulas, expected, barrier, deadline, counts, i))
+        for i in range(n_threads)
+    ]
+    for thread in threads:
+        thread.start()
+    deadline[0] = time.perf_counter() + seconds
+    barrier.wait()
+    for thread in threads:
+        thread.join()
+    if None in counts:
+        raise AssertionError("a thread got a result different from the single-threaded parse")
+    return sum(counts) / seconds
+
+
+def main():
+    """Run the benchmark for each thread count and print the scaling"""
+    cores = os.cpu_count() or 1
+    default_threads = sorted({1, 2, 4, 8, cores} & set(range(1, cores + 1)))
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, nargs="+", default=default_threads)
+    parser.add_argument("--seconds", type=float, default=2.0, help="duration of each measurement")
+    parser.add_argument("--cache", type=int, default=0, help="parse cache size (0 disables it)")
+    args = parser.parse_args()
+
+    fiasto_py.configure_cache(args.cache)
+    # Small and medium formulas, where fixed per-call costs matter most
+    formulas = [formula for _, formula in CORPUS if len(formula) < 2000]
+    expected = [fiasto_py.parse_formula(formula) for formula in formulas]
+
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"Python {sys.version.split()[0]}, GIL {'enabled' if gil else 'disabled'}, {cores} cores")
+    print(f"{'threads':>8} {'formulas/s':>12} {'speedup':>8} {'efficiency':>11}")
+    base = None
+    for n_threads in args.threads:
+        rate = throughput(n_threads, formulas, expected, args.seconds)
+        base = base or rate
+        speedup = rate / base
+        print(f"{n_threads:>8} {rate:>12.0f} {speedup:>7.2f}x {speedup / n_threads:>10.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Formula corpus shared by the Python and Rust benchmarks.
+
+The corpus runs from `y ~ x` to 200-term formulas with deep n-way
+interactions, transformations and nested random effects. The Rust benches
+read `corpus.txt`; regenerate it after changing this file:
+
+    python benchmarks/corpus.py > benchmarks/corpus.txt
+"""
+
+
+def main_effects(n_terms):
+    """`y ~ x0 + ... + x{n-1}`"""
+    return "y ~ " + " + ".join(f"x{i}" for i in range(n_terms))
+
+
+def interactions(n_terms, order):
+    """`n_terms` predictors grouped into `order`-way interactions"""
+    groups = []
+    for start in range(0, n_terms, order):
+        groups.append("*".join(f"x{i}" for i in range(start, min(start + order, n_terms))))
+    return "y ~ " + " + ".join(groups)
+
+
+def mixed(n_terms):
+    """Main effects, 3-way interactions, transformations and nested random effects"""
+    terms = []
+    for i in range(0, n_terms - 2, 10):
+        terms.append(f"x{i}*x{i + 1}*x{i + 2}")
+        terms.extend(f"x{j}" for j in range(i + 3, min(i + 8, n_terms)))
+        terms.append(f"log(z{i})")
+        terms.append(f"poly(w{i}, 2)")
+    terms.append("(1 + x0 | school/classroom)")
+    terms.append("(1 | region)")
+    return "y ~ " + " + ".join(terms)
+
+
+CORPUS = [
+    ("minimal", "y ~ x"),
+    ("main_10", main_effects(10)),
+    ("main_50", main_effects(50)),
+    ("main_200", main_effects(200)),
+    ("interaction_4way", interactions(4, 4)),
+    ("interaction_5way_x8", interactions(40, 5)),
+    ("random_effects", "y ~ x1 + x2 + (1 + x1 | group) + (1 | site)"),
+    ("mixed_50", mixed(50)),
+    ("mixed_200", mixed(200)),
+]
+
+
+if __name__ == "__main__":
+    for name, formula in CORPUS:
+        print(f"{name}\t{formula}")
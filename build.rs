@@ -0,0 +1,37 @@
+//! Record the versions that on-disk parse cache entries are keyed by.
+//!
+//! `FIASTO_PY_VERSION` is the released package version from pyproject.toml
+//! (Cargo.toml's version is not bumped on release) and `FIASTO_VERSION` is
+//! the resolved version of the fiasto parser from Cargo.lock, so entries
+//! written by another release or another parser are never read back.
+
+use std::fs;
+use std::path::Path;
+
+/// The `version = "..."` value of the first entry after the line `header`
+fn version_after(text: &str, header: &str) -> Option<String> {
+    text.lines()
+        .skip_while(|line| line.trim() != header)
+        .skip(1)
+        .take_while(|line| !line.starts_with('['))
+        .find_map(|line| line.trim().strip_prefix("version = "))
+        .map(|version| version.trim_matches('"').to_owned())
+}
+
+fn read_version(manifest_dir: &Path, file: &str, header: &str) -> String {
+    let path = manifest_dir.join(file);
+    println!("cargo:rerun-if-changed={}", path.display());
+    fs::read_to_string(&path)
+        .ok()
+        .and_then(|text| version_after(&text, header))
+        .unwrap_or_else(|| panic!("no version after `{}` in {}", header, path.display()))
+}
+
+fn main() {
+    let manifest_dir = std::env::var("CARGO_MANIFEST_DIR").expect("CARGO_MANIFEST_DIR is set by cargo");
+    let manifest_dir = Path::new(&manifest_dir);
+    let package = read_version(manifest_dir, "pyproject.toml", "[project]");
+    let fiasto = read_version(manifest_dir, "Cargo.lock", "name = \"fiasto\"");
+    println!("cargo:rustc-env=FIASTO_PY_VERSION={}", package);
+    println!("cargo:rustc-env=FIASTO_VERSION={}", fiasto);
+}
@@ -0,0 +1,139 @@
+//! asyncio entry points that parse on a native thread pool.
+//!
+//! Each call creates a future on the running event loop and returns it
+//! immediately. The fiasto work runs on a dedicated rayon pool without the
+//! GIL; the worker then converts the result and hands it to the loop with
+//! `call_soon_threadsafe`, so the event loop thread never blocks on parsing.
+
+use std::any::Any;
+use std::panic::{self, AssertUnwindSafe};
+use std::sync::OnceLock;
+use std::time::Instant;
+
+use pyo3::panic::PanicException;
+use pyo3::prelude::*;
+use pyo3::sync::GILOnceCell;
+use pyo3::types::PyCFunction;
+use rayon::{ThreadPool, ThreadPoolBuilder};
+
+use crate::batch::{map_batch, results_to_python};
+use crate::convert::json_value_to_python;
+use crate::{cache, parse_error, stats};
+
+static POOL: OnceLock<ThreadPool> = OnceLock::new();
+
+static RESOLVE: GILOnceCell<Py<PyCFunction>> = GILOnceCell::new();
+
+fn pool() -> &'static ThreadPool {
+    POOL.get_or_init(|| {
+        ThreadPoolBuilder::new()
+            .thread_name(|index| format!("fiasto-py-async-{}", index))
+            .build()
+            .expect("failed to start the fiasto_py async thread pool")
+    })
+}
+
+/// Complete `future` unless it was cancelled; runs on the event loop thread
+#[pyfunction]
+fn resolve(future: &Bound<PyAny>, value: &Bound<PyAny>, failed: bool) -> PyResult<()> {
+    if future.call_method0("done")?.is_truthy()? {
+        return Ok(());
+    }
+    let method = if failed { "set_exception" } else { "set_result" };
+    future.call_method1(method, (value,))?;
+    Ok(())
+}
+
+/// The `PanicException` raised in place of a panic caught on the async pool
+fn panic_error(payload: Box<dyn Any + Send>) -> PyErr {
+    let message = match payload.downcast::<String>() {
+        Ok(message) => *message,
+        Err(payload) => match payload.downcast::<&str>() {
+            Ok(message) => (*message).to_owned(),
+            Err(_) => "panic in a fiasto_py async task".to_owned(),
+        },
+    };
+    PanicException::new_err(message)
+}
+
+/// Run `work` on the async pool and return a future for `convert(result)`
+///
+/// A panic in either step fails the future with `PanicException`, as the
+/// synchronous entry points do, instead of unwinding out of the pool.
+fn spawn<T, W, C>(py: Python, work: W, convert: C) -> PyResult<PyObject>
+where
+    T: Send + 'static,
+    W: FnOnce() -> T + Send + 'static,
+    C: FnOnce(Python, T) -> PyResult<PyObject> + Send + 'static,
+{
+    let event_loop = py.import_bound("asyncio")?.call_method0("get_running_loop")?;
+    let future = event_loop.call_method0("create_future")?;
+    let resolve = RESOLVE
+        .get_or_try_init(py, || wrap_pyfunction!(resolve, py).map(Bound::unbind))?
+        .clone_ref(py);
+    let (event_loop, pending) = (event_loop.unbind(), future.clone().unbind());
+    pool().spawn(move || {
+        let result = panic::catch_unwind(AssertUnwindSafe(work));
+        let waiting = Instant::now();
+        Python::with_gil(|py| {
+            if stats::enabled() {
+                stats::GIL_WAIT.record(waiting);
+            }
+            let converted = match result {
+                Ok(result) => panic::catch_unwind(AssertUnwindSafe(|| convert(py, result)))
+                    .unwrap_or_else(|payload| Err(panic_error(payload))),
+                Err(payload) => Err(panic_error(payload)),
+            };
+            let (value, failed) = match converted {
+                Ok(value) => (value, false),
+                Err(e) => (e.into_value(py).into_any(), true),
+            };
+            // Fails only if the loop was closed, in which case nothing awaits the future
+            let _ = event_loop
+                .bind(py)
+                .call_method1("call_soon_threadsafe", (resolve, pending, value, failed));
+        });
+    });
+    Ok(future.unbind())
+}
+
+/// Parse a formula off the event loop: `await aparse_formula(formula)`
+///
+/// Returns an `asyncio.Future` resolving to the `parse_formula()` dictionary,
+/// or raising `FormulaParseError`. Parsing runs with the GIL released on a native
+/// thread pool and goes through the parse cache when it is enabled. Must be
+/// called while an event loop is running.
+#[pyfunction]
+pub fn aparse_formula(py: Python, formula: String) -> PyResult<PyObject> {
+    spawn(
+        py,
+        move || {
+            let result = cache::parse_cached(&formula);
+            (formula, result)
+        },
+        |py, (formula, result)| match result {
+            Ok(json_value) => json_value_to_python(py, &json_value),
+            Err(e) => Err(parse_error(&formula, e)),
+        },
+    )
+}
+
+/// Parse many formulas off the event loop: `await aparse_formulas(formulas)`
+///
+/// Resolves to the list returned by `parse_formulas()`, with a `FormulaParseError`
+/// instance in the slot of each formula that fails. The batch is spread
+/// over the native thread pool when `parallel` is true.
+#[pyfunction]
+#[pyo3(signature = (formulas, parallel = true))]
+pub fn aparse_formulas(py: Python, formulas: Vec<String>, parallel: bool) -> PyResult<PyObject> {
+    spawn(
+        py,
+        move || {
+            let results = map_batch(&formulas, parallel, cache::parse_cached);
+            (formulas, results)
+        },
+        |py, (formulas, results)| {
+            results_to_python(py, &formulas, results, |formula, e| parse_error(formula, e))
+        },
+    )
+}
@@ -0,0 +1,84 @@
+//! Batch entry points that parse or lex many formulas in a single call.
+//!
+//! The fiasto work for the whole batch runs with the GIL released (optionally
+//! spread over the rayon thread pool); only the final conversion to Python
+//! objects happens while holding the GIL.
+
+use std::borrow::Borrow;
+
+use pyo3::prelude::*;
+use pyo3::types::PyList;
+use rayon::prelude::*;
+use serde_json::Value;
+
+use crate::convert::json_value_to_python;
+use crate::tokens::lex_value;
+use crate::{cache, lex_error, parse_error, stats};
+
+/// Run `f` over every formula with the GIL released, preserving input order
+pub(crate) fn run_batch<T, F>(py: Python, formulas: &[String], parallel: bool, f: F) -> Vec<Result<T, String>>
+where
+    T: Send,
+    F: Fn(&str) -> Result<T, String> + Send + Sync,
+{
+    py.allow_threads(|| map_batch(formulas, parallel, f))
+}
+
+/// `run_batch` for callers that already run without the GIL
+pub(crate) fn map_batch<T, F>(formulas: &[String], parallel: bool, f: F) -> Vec<Result<T, String>>
+where
+    T: Send,
+    F: Fn(&str) -> Result<T, String> + Send + Sync,
+{
+    stats::increment(&stats::BATCH_CALLS, 1);
+    stats::increment(&stats::BATCH_ITEMS, formulas.len() as u64);
+    if parallel {
+        formulas.par_iter().map(|formula| f(formula)).collect()
+    } else {
+        formulas.iter().map(|formula| f(formula)).collect()
+    }
+}
+
+/// Convert batch results to a Python list, placing an exception instance
+/// at the position of every formula that failed
+pub(crate) fn results_to_python<T: Borrow<Value>>(
+    py: Python,
+    formulas: &[String],
+    results: Vec<Result<T, String>>,
+    to_error: fn(&str, String) -> PyErr,
+) -> PyResult<PyObject> {
+    let py_list = PyList::empty_bound(py);
+    for (formula, result) in formulas.iter().zip(results) {
+        match result {
+            Ok(json_value) => py_list.append(json_value_to_python(py, json_value.borrow())?)?,
+            Err(e) => py_list.append(to_error(formula, e).into_value(py))?,
+        }
+    }
+    Ok(py_list.into())
+}
+
+/// Parse many Wilkinson's formulas at once and return a list of Python dictionaries
+///
+/// Parsing happens with the GIL released and, when `parallel` is true, across
+/// the rayon thread pool, going through the parse cache when it is enabled.
+/// Results are returned in input order; a formula that fails to parse yields
+/// a `FormulaParseError` instance in its slot instead of aborting the whole
+/// batch.
+#[pyfunction]
+#[pyo3(signature = (formulas, parallel = true))]
+pub fn parse_formulas(py: Python, formulas: Vec<String>, parallel: bool) -> PyResult<PyObject> {
+    let results = run_batch(py, &formulas, parallel, cache::parse_cached);
+    results_to_python(py, &formulas, results, |formula, e| parse_error(formula, e))
+}
+
+/// Tokenize many formula strings at once and return a list of token lists
+///
+/// Lexing happens with the GIL released and, when `parallel` is true, across
+/// the rayon thread pool. Results are returned in input order; a formula that
+/// fails to lex yields a `FormulaLexError` instance in its slot.
+#[pyfunction]
+#[pyo3(signature = (formulas, parallel = true))]
+pub fn lex_formulas(py: Python, formulas: Vec<String>, parallel: bool) -> PyResult<PyObject> {
+    let results = run_batch(py, &formulas, parallel, lex_value);
+    results_to_python(py, &formulas, results, |formula, e| lex_error(formula, e))
+}
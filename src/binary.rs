@@ -0,0 +1,254 @@
+//! Compact, versioned binary encoding of parse results for `dumps`/`loads`.
+//!
+//! A payload is the magic bytes `FIAS`, a format version byte, a table of
+//! the distinct strings in the result and then the value tree, whose keys
+//! and strings refer to the table by index. Repeated keys such as `roles`
+//! or `generated_columns` are stored once, and all lengths and indices are
+//! LEB128 varints, so payloads are a fraction of the size of the JSON or of
+//! a pickled dict.
+
+use std::collections::HashMap;
+use std::sync::Arc;
+
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+use pyo3::types::PyBytes;
+use serde_json::{Map, Number, Value};
+
+use crate::parsed::{formula_value, ParsedFormula};
+
+const MAGIC: &[u8; 4] = b"FIAS";
+
+/// Bump when the layout changes; `decode` rejects versions it does not know
+pub(crate) const FORMAT_VERSION: u8 = 1;
+
+const NULL: u8 = 0;
+const FALSE: u8 = 1;
+const TRUE: u8 = 2;
+const UINT: u8 = 3;
+const NEGINT: u8 = 4;
+const FLOAT: u8 = 5;
+const STRING: u8 = 6;
+const ARRAY: u8 = 7;
+const OBJECT: u8 = 8;
+
+pub(crate) fn write_varint(out: &mut Vec<u8>, mut n: u64) {
+    while n >= 0x80 {
+        out.push((n as u8) | 0x80);
+        n >>= 7;
+    }
+    out.push(n as u8);
+}
+
+/// Assigns table indices to strings in first-seen order
+#[derive(Default)]
+struct StringTable<'a> {
+    indices: HashMap<&'a str, u64>,
+    strings: Vec<&'a str>,
+}
+
+impl<'a> StringTable<'a> {
+    fn index(&mut self, s: &'a str) -> u64 {
+        let next = self.strings.len() as u64;
+        *self.indices.entry(s).or_insert_with(|| {
+            self.strings.push(s);
+            next
+        })
+    }
+}
+
+fn encode_value<'a>(value: &'a Value, table: &mut StringTable<'a>, out: &mut Vec<u8>) {
+    match value {
+        Value::Null => out.push(NULL),
+        Value::Bool(false) => out.push(FALSE),
+        Value::Bool(true) => out.push(TRUE),
+        Value::Number(n) => {
+            if let Some(u) = n.as_u64() {
+                out.push(UINT);
+                write_varint(out, u);
+            } else if let Some(i) = n.as_i64() {
+                // Negative: store -(i + 1) so i64::MIN fits
+                out.push(NEGINT);
+                write_varint(out, !(i as u64));
+            } else {
+                out.push(FLOAT);
+                out.extend_from_slice(&n.as_f64().unwrap_or(f64::NAN).to_le_bytes());
+            }
+        }
+        Value::String(s) => {
+            out.push(STRING);
+            write_varint(out, table.index(s));
+        }
+        Value::Array(items) => {
+            out.push(ARRAY);
+            write_varint(out, items.len() as u64);
+            items.iter().for_each(|item| encode_value(item, table, out));
+        }
+        Value::Object(map) => {
+            out.push(OBJECT);
+            write_varint(out, map.len() as u64);
+            for (key, item) in map {
+                write_varint(out, table.index(key));
+                encode_value(item, table, out);
+            }
+        }
+    }
+}
+
+/// Encode a parse result
+pub(crate) fn encode(value: &Value) -> Vec<u8> {
+    let mut table = StringTable::default();
+    let mut body = Vec::new();
+    encode_value(value, &mut table, &mut body);
+
+    let mut out = Vec::with_capacity(body.len() + 64);
+    out.extend_from_slice(MAGIC);
+    out.push(FORMAT_VERSION);
+    write_varint(&mut out, table.strings.len() as u64);
+    for s in &table.strings {
+        write_varint(&mut out, s.len() as u64);
+        out.extend_from_slice(s.as_bytes());
+    }
+    out.extend_from_slice(&body);
+    out
+}
+
+/// Cursor over a payload, failing cleanly on truncated or corrupt input
+pub(crate) struct Reader<'a> {
+    bytes: &'a [u8],
+    pos: usize,
+}
+
+impl<'a> Reader<'a> {
+    pub(crate) fn new(bytes: &'a [u8]) -> Self {
+        Reader { bytes, pos: 0 }
+    }
+
+    /// Whether every byte has been read
+    pub(crate) fn is_done(&self) -> bool {
+        self.pos == self.bytes.len()
+    }
+
+    pub(crate) fn byte(&mut self) -> Result<u8, String> {
+        let byte = *self.bytes.get(self.pos).ok_or("truncated payload")?;
+        self.pos += 1;
+        Ok(byte)
+    }
+
+    pub(crate) fn take(&mut self, n: usize) -> Result<&'a [u8], String> {
+        let end = self.pos.checked_add(n).filter(|&end| end <= self.bytes.len());
+        let slice = &self.bytes[self.pos..end.ok_or("truncated payload")?];
+        self.pos += n;
+        Ok(slice)
+    }
+
+    pub(crate) fn varint(&mut self) -> Result<u64, String> {
+        let mut n = 0u64;
+        for shift in (0..64).step_by(7) {
+            let byte = self.byte()?;
+            n |= u64::from(byte & 0x7f) << shift;
+            if byte & 0x80 == 0 {
+                return Ok(n);
+            }
+        }
+        Err("invalid varint".to_owned())
+    }
+
+    /// A length, bounded by the bytes left so corrupt input cannot over-allocate
+    pub(crate) fn len(&mut self) -> Result<usize, String> {
+        let n = self.varint()?;
+        usize::try_from(n)
+            .ok()
+            .filter(|&n| n <= self.bytes.len() - self.pos)
+            .ok_or_else(|| "invalid length".to_owned())
+    }
+
+    fn string(&mut self, table: &[String]) -> Result<String, String> {
+        let index = self.varint()?;
+        table
+            .get(index as usize)
+            .cloned()
+            .ok_or_else(|| format!("string index {} out of range", index))
+    }
+
+    fn value(&mut self, table: &[String], depth: usize) -> Result<Value, String> {
+        if depth > 256 {
+            return Err("payload nested too deeply".to_owned());
+        }
+        Ok(match self.byte()? {
+            NULL => Value::Null,
+            FALSE => Value::Bool(false),
+            TRUE => Value::Bool(true),
+            UINT => Value::from(self.varint()?),
+            NEGINT => Value::from(!self.varint()? as i64),
+            FLOAT => {
+                let bytes = self.take(8)?.try_into().map_err(|_| "truncated payload")?;
+                Number::from_f64(f64::from_le_bytes(bytes)).map_or(Value::Null, Value::Number)
+            }
+            STRING => Value::String(self.string(table)?),
+            ARRAY => {
+                let len = self.len()?;
+                let mut items = Vec::with_capacity(len);
+                for _ in 0..len {
+                    items.push(self.value(table, depth + 1)?);
+                }
+                Value::Array(items)
+            }
+            OBJECT => {
+                let len = self.len()?;
+                let mut map = Map::new();
+                for _ in 0..len {
+                    let key = self.string(table)?;
+                    map.insert(key, self.value(table, depth + 1)?);
+                }
+                Value::Object(map)
+            }
+            tag => return Err(format!("invalid tag {}", tag)),
+        })
+    }
+}
+
+/// Decode a payload produced by `encode`
+pub(crate) fn decode(bytes: &[u8]) -> Result<Value, String> {
+    let mut reader = Reader::new(bytes);
+    if reader.take(MAGIC.len()).ok() != Some(MAGIC.as_slice()) {
+        return Err("not a fiasto_py payload".to_owned());
+    }
+    let version = reader.byte()?;
+    if version != FORMAT_VERSION {
+        return Err(format!(
+            "unsupported payload version {} (this build reads version {})",
+            version, FORMAT_VERSION
+        ));
+    }
+    let count = reader.len()?;
+    let mut table = Vec::with_capacity(count);
+    for _ in 0..count {
+        let len = reader.len()?;
+        let s = std::str::from_utf8(reader.take(len)?).map_err(|e| e.to_string())?;
+        table.push(s.to_owned());
+    }
+    let value = reader.value(&table, 0)?;
+    if !reader.is_done() {
+        return Err("trailing bytes after payload".to_owned());
+    }
+    Ok(value)
+}
+
+/// Serialize a parsed formula (or formula string) to compact, versioned bytes
+///
+/// The payload holds the full parse result; `loads` restores it without
+/// parsing the formula again.
+#[pyfunction]
+pub fn dumps<'py>(py: Python<'py>, formula: &Bound<'py, PyAny>) -> PyResult<Bound<'py, PyBytes>> {
+    let value = formula_value(formula)?;
+    let payload = py.allow_threads(|| encode(&value));
+    Ok(PyBytes::new_bound(py, &payload))
+}
+
+/// Restore a `ParsedFormula` from bytes produced by `dumps`
+#[pyfunction]
+pub fn loads(py: Python, data: &[u8]) -> PyResult<ParsedFormula> {
+    let value = py.allow_threads(|| decode(data)).map_err(PyValueError::new_err)?;
+    Ok(ParsedFormula::new(Arc::new(value)))
+}
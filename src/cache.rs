@@ -0,0 +1,141 @@
+//! Opt-in, bounded LRU cache of parse results keyed by formula string.
+//!
+//! The cache stores the Rust-side `serde_json::Value` behind an `Arc`, so a
+//! hit skips lexing and parsing entirely; every caller still receives a
+//! freshly built Python object, which keeps cached results immutable.
+
+use std::num::NonZeroUsize;
+use std::sync::atomic::{AtomicBool, Ordering};
+use std::sync::{Arc, Mutex, MutexGuard};
+
+use lru::LruCache;
+use pyo3::prelude::*;
+use serde_json::Value;
+
+use crate::{disk_cache, stats};
+
+struct ParseCache {
+    entries: Option<LruCache<String, Arc<Value>>>,
+    hits: u64,
+    misses: u64,
+}
+
+static CACHE: Mutex<ParseCache> = Mutex::new(ParseCache {
+    entries: None,
+    hits: 0,
+    misses: 0,
+});
+
+/// Whether `CACHE.entries` is set, so parsing with the cache disabled never takes the lock
+static ENABLED: AtomicBool = AtomicBool::new(false);
+
+fn lock() -> MutexGuard<'static, ParseCache> {
+    // A panic while holding the lock cannot leave the cache inconsistent
+    CACHE.lock().unwrap_or_else(|e| e.into_inner())
+}
+
+/// Parse a formula, consulting the LRU cache and then the disk cache when enabled
+pub(crate) fn parse_cached(formula: &str) -> Result<Arc<Value>, String> {
+    let enabled = ENABLED.load(Ordering::Acquire) && {
+        let mut guard = lock();
+        let cache = &mut *guard;
+        match cache.entries.as_mut() {
+            Some(entries) => {
+                if let Some(json_value) = entries.get(formula) {
+                    let json_value = Arc::clone(json_value);
+                    cache.hits += 1;
+                    stats::increment(&stats::CACHE_HITS, 1);
+                    return Ok(json_value);
+                }
+                cache.misses += 1;
+                stats::increment(&stats::CACHE_MISSES, 1);
+                true
+            }
+            None => false,
+        }
+    };
+
+    // Parse without holding the lock so concurrent misses do not serialize
+    let json_value = match disk_cache::get(formula) {
+        Some(json_value) => Arc::new(json_value),
+        None => {
+            let json_value = stats::PARSE.time(|| fiasto::parse_formula(formula)).map_err(|e| e.to_string())?;
+            let json_value = Arc::new(json_value);
+            disk_cache::put(formula, &json_value);
+            json_value
+        }
+    };
+    if enabled {
+        if let Some(entries) = lock().entries.as_mut() {
+            entries.put(formula.to_owned(), Arc::clone(&json_value));
+        }
+    }
+    Ok(json_value)
+}
+
+/// Statistics about the parse cache, mirroring `functools.lru_cache`'s `cache_info()`
+#[pyclass(frozen, get_all, module = "fiasto_py")]
+pub struct CacheInfo {
+    pub(crate) hits: u64,
+    pub(crate) misses: u64,
+    pub(crate) maxsize: usize,
+    pub(crate) currsize: usize,
+}
+
+#[pymethods]
+impl CacheInfo {
+    fn __repr__(&self) -> String {
+        format!(
+            "CacheInfo(hits={}, misses={}, maxsize={}, currsize={})",
+            self.hits, self.misses, self.maxsize, self.currsize
+        )
+    }
+}
+
+/// Enable, resize or disable the parse cache
+///
+/// A `maxsize` of 0 disables the cache and drops all entries. Resizing keeps
+/// the most recently used entries.
+#[pyfunction]
+#[pyo3(signature = (maxsize = 128))]
+pub fn configure_cache(maxsize: usize) {
+    let mut cache = lock();
+    match NonZeroUsize::new(maxsize) {
+        Some(capacity) => match cache.entries.as_mut() {
+            Some(entries) => entries.resize(capacity),
+            None => cache.entries = Some(LruCache::new(capacity)),
+        },
+        None => cache.entries = None,
+    }
+    ENABLED.store(cache.entries.is_some(), Ordering::Release);
+}
+
+/// Report cache hits, misses, maximum size and current size
+///
+/// Hits and misses count since the last `cache_clear()`; `reset_stats()`
+/// does not change them.
+#[pyfunction]
+pub fn cache_info() -> CacheInfo {
+    let cache = lock();
+    let (maxsize, currsize) = cache
+        .entries
+        .as_ref()
+        .map_or((0, 0), |entries| (entries.cap().get(), entries.len()));
+    CacheInfo {
+        hits: cache.hits,
+        misses: cache.misses,
+        maxsize,
+        currsize,
+    }
+}
+
+/// Drop all cached parse results and reset the statistics
+#[pyfunction]
+pub fn cache_clear() {
+    let mut cache = lock();
+    if let Some(entries) = cache.entries.as_mut() {
+        entries.clear();
+    }
+    cache.hits = 0;
+    cache.misses = 0;
+}
@@ -0,0 +1,232 @@
+//! Canonical forms and stable hashes of formulas, for deduplicating models.
+//!
+//! The canonical form is built from the resolved terms of the parse result,
+//! so `*`, `/` and `^` are already expanded into the individual terms that
+//! fiasto generates. Interaction members are sorted, terms are ordered by
+//! interaction order and then by name, and random-effects terms are written
+//! in one normalized spelling. Two formulas describing the same model
+//! therefore canonicalize to the same string and hash.
+
+use std::collections::{BTreeSet, HashSet};
+
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+use pyo3::types::PyList;
+use serde_json::Value;
+
+use crate::batch::run_batch;
+use crate::design::{transform_call, Plan, Term};
+use crate::parsed::{columns_in_order, formula_value, str_list};
+use crate::{cache, parse_error};
+
+/// 64-bit FNV-1a, stable across processes, builds and platforms
+pub(crate) fn fnv1a_64(bytes: &[u8]) -> u64 {
+    let mut hash: u64 = 0xcbf29ce484222325;
+    for &byte in bytes {
+        hash ^= u64::from(byte);
+        hash = hash.wrapping_mul(0x100000001b3);
+    }
+    hash
+}
+
+/// 128-bit FNV-1a over several parts, stable across processes, builds and platforms
+pub(crate) fn fnv1a_128(parts: &[&[u8]]) -> u128 {
+    const OFFSET: u128 = 0x6c62272e07bb014262b821756295c58d;
+    const PRIME: u128 = 0x0000000001000000000000000000013b;
+    let mut hash = OFFSET;
+    for part in parts {
+        for &byte in *part {
+            hash ^= u128::from(byte);
+            hash = hash.wrapping_mul(PRIME);
+        }
+        // Separator so ("ab", "c") and ("a", "bc") differ
+        hash ^= 0xff;
+        hash = hash.wrapping_mul(PRIME);
+    }
+    hash
+}
+
+/// Write one term; interaction members are sorted so `b:a` equals `a:b`, and
+/// transformations keep their arguments so `lag(x, 1)` differs from `lag(x, 2)`
+fn render(term: &Term) -> String {
+    match term {
+        Term::Intercept => "1".to_owned(),
+        Term::Column(name) => name.clone(),
+        Term::Transform {
+            function,
+            column,
+            parameters,
+            count,
+            ..
+        } => transform_call(function, column, parameters, *count),
+        Term::Interaction(members) => {
+            let members: BTreeSet<String> = members.iter().map(render).collect();
+            members.into_iter().collect::<Vec<_>>().join(":")
+        }
+        Term::Level { column, level } => format!("{}[{}]", column, level),
+    }
+}
+
+/// Random-effects terms as `(1 + x | g)`, with sorted variables and `||` when uncorrelated
+fn random_effects(value: &Value) -> BTreeSet<String> {
+    let mut terms = BTreeSet::new();
+    for (_, info) in columns_in_order(value) {
+        for entry in info["random_effects"].as_array().into_iter().flatten() {
+            let Some(group) = entry["grouping_variable"].as_str() else {
+                continue;
+            };
+            let mut variables: Vec<&str> = str_list(&entry["variables"]);
+            variables.sort_unstable();
+            variables.dedup();
+            let intercept = if entry["has_intercept"].as_bool().unwrap_or(true) { "1" } else { "0" };
+            let bar = if entry["correlated"].as_bool().unwrap_or(true) { "|" } else { "||" };
+            let lhs: Vec<&str> = std::iter::once(intercept).chain(variables).collect();
+            terms.insert(format!("({} {} {})", lhs.join(" + "), bar, group));
+        }
+    }
+    terms
+}
+
+/// The canonical string of a parse result
+pub(crate) fn canonical_form(value: &Value) -> Result<String, String> {
+    let plan = Plan::from_parsed(value)?;
+    let mut response: Vec<String> = plan.response_terms.iter().map(render).collect();
+    response.dedup();
+    let response = match response.len() {
+        0 => String::new(),
+        1 => response.remove(0) + " ",
+        _ => format!("mvbind({}) ", response.join(", ")),
+    };
+
+    // Order by interaction order, then name
+    let mut seen = HashSet::new();
+    let mut terms: Vec<(usize, String)> = plan
+        .terms
+        .iter()
+        .filter(|term| **term != Term::Intercept)
+        .map(|term| {
+            let order = match term {
+                Term::Interaction(members) => members.len(),
+                _ => 1,
+            };
+            (order, render(term))
+        })
+        .filter(|(_, rendered)| seen.insert(rendered.clone()))
+        .collect();
+    terms.sort();
+
+    let intercept = plan.terms.contains(&Term::Intercept);
+    let mut rhs: Vec<String> = Vec::with_capacity(terms.len() + 1);
+    if !intercept {
+        rhs.push("0".to_owned());
+    } else if terms.is_empty() {
+        rhs.push("1".to_owned());
+    }
+    rhs.extend(terms.into_iter().map(|(_, rendered)| rendered));
+    rhs.extend(random_effects(value));
+    Ok(format!("{}~ {}", response, rhs.join(" + ")))
+}
+
+/// Parse (through the cache) and canonicalize a formula string
+fn canonicalize_str(formula: &str) -> Result<String, String> {
+    canonical_form(&cache::parse_cached(formula)?)
+}
+
+fn hash_canonical(canonical: &str, bits: u32) -> u128 {
+    match bits {
+        64 => u128::from(fnv1a_64(canonical.as_bytes())),
+        _ => fnv1a_128(&[canonical.as_bytes()]),
+    }
+}
+
+fn check_bits(bits: u32) -> PyResult<()> {
+    match bits {
+        64 | 128 => Ok(()),
+        _ => Err(PyValueError::new_err(format!("bits must be 64 or 128, not {}", bits))),
+    }
+}
+
+/// Convert batch results to a list, with a `FormulaParseError` instance for each failure
+fn results_to_list<T: IntoPy<PyObject>>(
+    py: Python,
+    formulas: &[String],
+    results: Vec<Result<T, String>>,
+) -> PyResult<PyObject> {
+    let items: Vec<PyObject> = results
+        .into_iter()
+        .zip(formulas)
+        .map(|(result, formula)| match result {
+            Ok(item) => item.into_py(py),
+            Err(e) => parse_error(formula, e).into_value(py).into_any(),
+        })
+        .collect();
+    Ok(PyList::new_bound(py, items).into())
+}
+
+/// Return the canonical string of a formula (string or `ParsedFormula`)
+///
+/// `*`, `/` and `^` are expanded into individual terms, interaction members
+/// and terms are sorted, and random effects are normalized, so formulas
+/// describing the same model give the same string, e.g.
+/// `canonicalize("y ~ a*b") == canonicalize("y ~ b:a + b + a")`.
+#[pyfunction]
+pub fn canonicalize(py: Python, formula: &Bound<PyAny>) -> PyResult<String> {
+    let value = formula_value(formula)?;
+    py.allow_threads(|| canonical_form(&value))
+        .map_err(|e| parse_error(value["formula"].as_str().unwrap_or_default(), e))
+}
+
+/// Return a stable 64- or 128-bit hash of a formula's canonical form
+///
+/// The hash is FNV-1a over the canonical string, so it is the same across
+/// processes, platforms and releases that produce the same canonical form.
+#[pyfunction]
+#[pyo3(signature = (formula, bits = 64))]
+pub fn formula_hash(py: Python, formula: &Bound<PyAny>, bits: u32) -> PyResult<u128> {
+    check_bits(bits)?;
+    let canonical = canonicalize(py, formula)?;
+    Ok(hash_canonical(&canonical, bits))
+}
+
+/// Canonicalize many formulas with the GIL released
+///
+/// Returns the canonical strings in input order, with a `FormulaParseError`
+/// instance in the slot of each formula that fails to parse.
+#[pyfunction]
+#[pyo3(signature = (formulas, parallel = true))]
+pub fn canonicalize_formulas(py: Python, formulas: Vec<String>, parallel: bool) -> PyResult<PyObject> {
+    let results = run_batch(py, &formulas, parallel, canonicalize_str);
+    results_to_list(py, &formulas, results)
+}
+
+/// Hash many formulas with the GIL released, like `formula_hash`
+#[pyfunction]
+#[pyo3(signature = (formulas, bits = 64, parallel = true))]
+pub fn formula_hashes(py: Python, formulas: Vec<String>, bits: u32, parallel: bool) -> PyResult<PyObject> {
+    check_bits(bits)?;
+    let results = run_batch(py, &formulas, parallel, |formula| {
+        canonicalize_str(formula).map(|canonical| hash_canonical(&canonical, bits))
+    });
+    results_to_list(py, &formulas, results)
+}
+
+/// Indices of the first formula of each distinct model, in input order
+///
+/// Formulas are compared by canonical form (not by hash, so collisions are
+/// impossible). Formulas that fail to parse are left out.
+#[pyfunction]
+#[pyo3(signature = (formulas, parallel = true))]
+pub fn unique_formulas(py: Python, formulas: Vec<String>, parallel: bool) -> Vec<usize> {
+    let results = run_batch(py, &formulas, parallel, canonicalize_str);
+    py.allow_threads(|| {
+        let mut seen = HashSet::with_capacity(results.len());
+        results
+            .iter()
+            .enumerate()
+            .filter_map(|(index, result)| match result {
+                Ok(canonical) if seen.insert(canonical.as_str()) => Some(index),
+                _ => None,
+            })
+            .collect()
+    })
+}
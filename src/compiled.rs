@@ -0,0 +1,181 @@
+//! Compiled formulas: resolve the evaluation plan once, evaluate many times.
+
+use std::sync::{Arc, OnceLock};
+
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+use pyo3::types::{PyBytes, PyType};
+use serde_json::Value;
+
+use crate::binary;
+use crate::design::{FittedState, Plan};
+use crate::matrix::{evaluate_with_response, prepare, state_from_python, state_to_python, to_numpy};
+use crate::parsed::formula_value;
+
+/// A formula resolved into its evaluation plan, with optional learned state
+///
+/// Holds the terms, their order and the generated column names in Rust, so
+/// `transform` only reads the data and does the numeric work. Categorical
+/// columns are expanded with the levels learned by `fit`, which are part of
+/// the state. Instances are immutable: `fit` returns a new, fitted
+/// `CompiledFormula`. They pickle without re-parsing the formula.
+#[pyclass(frozen, module = "fiasto_py")]
+pub struct CompiledFormula {
+    value: Arc<Value>,
+    /// The plan as parsed, with categorical columns unexpanded
+    plan: Plan,
+    /// The plan expanded with the levels of `state`
+    design: Plan,
+    state: Option<FittedState>,
+}
+
+impl CompiledFormula {
+    fn new(value: Arc<Value>, state: Option<FittedState>) -> PyResult<Self> {
+        let plan = Plan::from_parsed(&value).map_err(PyValueError::new_err)?;
+        let design = match &state {
+            Some(state) => plan.expand(&state.levels).map_err(PyValueError::new_err)?,
+            None => plan.clone(),
+        };
+        Ok(CompiledFormula {
+            value,
+            plan,
+            design,
+            state,
+        })
+    }
+
+    /// The state to evaluate with, if the plan can be evaluated
+    fn evaluation_state(&self) -> PyResult<&FittedState> {
+        static EMPTY: OnceLock<FittedState> = OnceLock::new();
+        match &self.state {
+            Some(state) => Ok(state),
+            None if !self.plan.needs_state() => Ok(EMPTY.get_or_init(FittedState::default)),
+            None => Err(PyValueError::new_err(
+                "formula has data-dependent transformations; call fit() before transform()",
+            )),
+        }
+    }
+}
+
+#[pymethods]
+impl CompiledFormula {
+    /// The formula string that was compiled
+    #[getter]
+    fn formula(&self) -> &str {
+        self.value["formula"].as_str().unwrap_or_default()
+    }
+
+    /// Names of the response column(s)
+    #[getter]
+    fn response(&self) -> Vec<String> {
+        self.plan.response.clone()
+    }
+
+    /// Names of the model-matrix columns, in order
+    ///
+    /// Categorical columns are listed unexpanded until the formula is fitted.
+    #[getter]
+    fn columns(&self) -> Vec<String> {
+        self.design.names.clone()
+    }
+
+    /// Raw data columns read by `transform`
+    #[getter]
+    fn required_columns(&self) -> Vec<&str> {
+        self.plan.required_columns()
+    }
+
+    /// Whether the data-dependent constants have been learned
+    #[getter]
+    fn is_fitted(&self) -> bool {
+        self.state.is_some()
+    }
+
+    /// The learned constants in the format of `fit_state`, or `None`
+    #[getter]
+    fn state(&self, py: Python) -> PyResult<Option<PyObject>> {
+        self.state
+            .as_ref()
+            .map(|state| state_to_python(py, state))
+            .transpose()
+    }
+
+    /// Learn the constants of `scale`, `center`, `poly` and friends and the
+    /// levels of categorical columns from `data`
+    ///
+    /// Returns a new fitted `CompiledFormula`; this one is left unchanged.
+    fn fit(&self, py: Python, data: &Bound<PyAny>) -> PyResult<CompiledFormula> {
+        let prepared = prepare(data, &self.plan, None, true)?;
+        let columns = prepared.inputs.column_set()?;
+        let state = prepared.fit(py, &columns)?;
+        Ok(CompiledFormula {
+            value: Arc::clone(&self.value),
+            plan: self.plan.clone(),
+            design: prepared.plan,
+            state: Some(state),
+        })
+    }
+
+    /// Evaluate the model matrix for `data`
+    ///
+    /// Returns the matrix, or `(y, X)` when `include_response` is true. The
+    /// column names are in `columns`.
+    #[pyo3(signature = (data, include_response = false))]
+    fn transform(&self, py: Python, data: &Bound<PyAny>, include_response: bool) -> PyResult<PyObject> {
+        let state = self.evaluation_state()?;
+        if include_response && self.plan.response_terms.is_empty() {
+            return Err(PyValueError::new_err("formula has no response"));
+        }
+        let prepared = prepare(data, &self.plan, Some(&state.levels), include_response)?;
+        let columns = prepared.inputs.column_set()?;
+        let plan = &prepared.plan;
+        if include_response {
+            let pair = evaluate_with_response(py, plan, state, &columns)?;
+            return Ok(pair.into_py(py));
+        }
+        let values = py
+            .allow_threads(|| plan.evaluate(state, &columns))
+            .map_err(PyValueError::new_err)?;
+        to_numpy(py, values, columns.nrows(), plan.terms.len())
+    }
+
+    /// Rebuild a `CompiledFormula` from the payload of `__reduce__`
+    #[classmethod]
+    fn _restore(_cls: &Bound<PyType>, payload: &[u8], state: Option<&Bound<PyAny>>) -> PyResult<Self> {
+        let value = binary::decode(payload).map_err(PyValueError::new_err)?;
+        let state = state.map(state_from_python).transpose()?;
+        CompiledFormula::new(Arc::new(value), state)
+    }
+
+    /// Pickle as the parse result and state, so unpickling does not re-parse
+    fn __reduce__(slf: &Bound<Self>) -> PyResult<(PyObject, (PyObject, Option<PyObject>))> {
+        let py = slf.py();
+        let this = slf.get();
+        let payload = binary::encode(&this.value);
+        let restore = slf.get_type().getattr("_restore")?.unbind();
+        Ok((restore, (PyBytes::new_bound(py, &payload).into_any().unbind(), this.state(py)?)))
+    }
+
+    fn __repr__(&self) -> String {
+        format!(
+            "CompiledFormula({:?}, columns={}, fitted={})",
+            self.formula(),
+            self.design.names.len(),
+            self.is_fitted()
+        )
+    }
+}
+
+/// Compile a formula (string or `ParsedFormula`) into a reusable `CompiledFormula`
+///
+/// When `data` is given, the data-dependent constants are learned from it,
+/// as with `CompiledFormula.fit`.
+#[pyfunction]
+#[pyo3(signature = (formula, data = None))]
+pub fn compile(py: Python, formula: &Bound<PyAny>, data: Option<&Bound<PyAny>>) -> PyResult<CompiledFormula> {
+    let compiled = CompiledFormula::new(formula_value(formula)?, None)?;
+    match data {
+        Some(data) => compiled.fit(py, data),
+        None => Ok(compiled),
+    }
+}
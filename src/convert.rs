@@ -0,0 +1,172 @@
+//! Conversion of fiasto's `serde_json::Value` output into Python objects.
+//!
+//! fiasto's public API hands back a `serde_json::Value`, so that tree is the
+//! one intermediate we cannot skip. What we can avoid is redundant work on the
+//! Python side: keys and enum-like values that appear in every result
+//! (`'roles'`, `'interactions'`, `'FixedEffect'`, ...) are interned once at
+//! import and shared between results, and lists are allocated at their final
+//! size.
+
+use std::collections::HashMap;
+use std::hash::{BuildHasherDefault, Hasher};
+use std::sync::OnceLock;
+
+use pyo3::prelude::*;
+use pyo3::types::{PyDict, PyList, PyString};
+use serde_json::Value;
+
+use crate::stats;
+
+/// Strings that occur in (nearly) every parse or lex result
+const KNOWN_STRINGS: &[&str] = &[
+    // parse result keys
+    "all_generated_columns",
+    "all_generated_columns_formula_order",
+    "columns",
+    "formula",
+    "metadata",
+    "generated_columns",
+    "id",
+    "interactions",
+    "random_effects",
+    "roles",
+    "transformations",
+    "correlated",
+    "grouping_variable",
+    "has_intercept",
+    "includes_interactions",
+    "kind",
+    "variables",
+    "order",
+    "with",
+    "context",
+    "function",
+    "parameters",
+    "generates_columns",
+    "family",
+    "has_uncorrelated_slopes_and_intercepts",
+    "is_random_effects_model",
+    "response_variable_count",
+    // parse result values
+    "Response",
+    "FixedEffect",
+    "Identity",
+    "GroupingVariable",
+    "RandomEffect",
+    "fixed_effects",
+    "grouping",
+    "intercept",
+    // lex result keys and values
+    "lexeme",
+    "token",
+    "ColumnName",
+    "Tilde",
+    "Plus",
+    "Minus",
+    "One",
+    "Zero",
+    "Pipe",
+    "DoublePipe",
+    "Colon",
+    "InteractionAndEffect",
+    "FunctionStart",
+    "FunctionEnd",
+    "Comma",
+    "InteractionOnly",
+    "Integer",
+];
+
+/// FNV-1a as a `Hasher`: every string of a result is looked up, and the
+/// known strings are short, where it is much cheaper than the default SipHash
+struct FnvHasher(u64);
+
+impl Default for FnvHasher {
+    fn default() -> Self {
+        FnvHasher(0xcbf29ce484222325)
+    }
+}
+
+impl Hasher for FnvHasher {
+    fn write(&mut self, bytes: &[u8]) {
+        for &byte in bytes {
+            self.0 ^= u64::from(byte);
+            self.0 = self.0.wrapping_mul(0x100000001b3);
+        }
+    }
+
+    fn finish(&self) -> u64 {
+        self.0
+    }
+}
+
+type InternedStrings = HashMap<&'static str, Py<PyString>, BuildHasherDefault<FnvHasher>>;
+
+static INTERNED: OnceLock<InternedStrings> = OnceLock::new();
+
+/// Intern the known strings; called once from module initialization
+pub(crate) fn init(py: Python) {
+    INTERNED.get_or_init(|| {
+        KNOWN_STRINGS
+            .iter()
+            .map(|&k| (k, PyString::intern_bound(py, k).unbind()))
+            .collect()
+    });
+}
+
+/// Return the shared, interned Python string for `s` if it is a known key or value
+#[inline]
+fn interned<'py>(py: Python<'py>, s: &str) -> Option<&'py Bound<'py, PyString>> {
+    INTERNED.get()?.get(s).map(|k| k.bind(py))
+}
+
+/// Convert a string, reusing the interned object when there is one
+fn string_to_python(py: Python, s: &str) -> PyObject {
+    match interned(py, s) {
+        Some(k) => k.clone().into_any().unbind(),
+        None => PyString::new_bound(py, s).into_any().unbind(),
+    }
+}
+
+/// Convert a serde_json::Value to a Python object
+pub(crate) fn json_value_to_python(py: Python, value: &Value) -> PyResult<PyObject> {
+    if stats::enabled() {
+        stats::record_conversion(value);
+    }
+    stats::CONVERT.time(|| value_to_python(py, value))
+}
+
+fn value_to_python(py: Python, value: &Value) -> PyResult<PyObject> {
+    match value {
+        Value::Null => Ok(py.None()),
+        Value::Bool(b) => Ok(b.into_py(py)),
+        Value::Number(n) => {
+            if let Some(i) = n.as_i64() {
+                Ok(i.into_py(py))
+            } else if let Some(f) = n.as_f64() {
+                Ok(f.into_py(py))
+            } else {
+                Ok(n.to_string().into_py(py))
+            }
+        }
+        Value::String(s) => Ok(string_to_python(py, s)),
+        Value::Array(arr) => {
+            let items = arr
+                .iter()
+                .map(|item| value_to_python(py, item))
+                .collect::<PyResult<Vec<_>>>()?;
+            Ok(PyList::new_bound(py, items).into())
+        }
+        Value::Object(obj) => {
+            let py_dict = PyDict::new_bound(py);
+            for (key, value) in obj {
+                let py_value = value_to_python(py, value)?;
+                // Interned keys are borrowed, saving a reference count round trip per key
+                match interned(py, key) {
+                    Some(py_key) => py_dict.set_item(py_key, py_value)?,
+                    None => py_dict.set_item(PyString::new_bound(py, key), py_value)?,
+                }
+            }
+            Ok(py_dict.into())
+        }
+    }
+}
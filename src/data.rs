@@ -0,0 +1,353 @@
+//! Extraction of raw data columns from Python objects.
+//!
+//! Two kinds of input are accepted:
+//!
+//! * any mapping from column name to a 1-D array-like: a dict of NumPy arrays,
+//!   a pandas DataFrame, or anything NumPy can view as float64;
+//! * any object implementing the Arrow PyCapsule interface
+//!   (`__arrow_c_stream__`), such as a pyarrow Table or a Polars DataFrame.
+//!
+//! Contiguous float64 NumPy arrays and single-chunk, null-free Arrow float64
+//! columns are borrowed without copying.
+
+use std::collections::HashMap;
+use std::ffi::CStr;
+
+use arrow::array::{Array, ArrayRef, AsArray, Float64Array};
+use arrow::compute::{cast, concat};
+use arrow::datatypes::{DataType, Float64Type, Int64Type};
+use arrow::ffi_stream::{ArrowArrayStreamReader, FFI_ArrowArrayStream};
+use arrow::record_batch::RecordBatch;
+use numpy::PyReadonlyArray1;
+use pyo3::exceptions::{PyKeyError, PyValueError};
+use pyo3::prelude::*;
+use pyo3::types::PyCapsule;
+
+use crate::design::ColumnSet;
+
+/// The values of one input column
+enum ColumnValues<'py> {
+    Numpy(PyReadonlyArray1<'py, f64>),
+    Arrow(Float64Array),
+    Owned(Vec<f64>),
+}
+
+impl ColumnValues<'_> {
+    fn as_slice(&self) -> PyResult<&[f64]> {
+        match self {
+            ColumnValues::Numpy(array) => array
+                .as_slice()
+                .map_err(|e| PyValueError::new_err(e.to_string())),
+            ColumnValues::Arrow(array) => Ok(array.values()),
+            ColumnValues::Owned(values) => Ok(values),
+        }
+    }
+}
+
+/// Read-only float64 views of the data columns a plan needs, plus the level
+/// codes of its categorical columns
+pub(crate) struct InputColumns<'py> {
+    arrays: Vec<(String, ColumnValues<'py>)>,
+    codes: Vec<(String, Vec<u32>)>,
+}
+
+impl<'py> InputColumns<'py> {
+    /// Fetch `required` columns from `data`, plus any of `optional` that are present
+    pub(crate) fn extract(data: &Bound<'py, PyAny>, required: &[&str], optional: &[&str]) -> PyResult<Self> {
+        Table::new(data)?.numeric(required, optional)
+    }
+
+    /// Take the wanted columns out of a mapping of array-likes
+    fn from_mapping(data: &Bound<'py, PyAny>, required: &[&str], optional: &[&str]) -> PyResult<Self> {
+        let py = data.py();
+        let numpy = py.import_bound("numpy")?;
+        let float64 = numpy.getattr("float64")?;
+        let mut arrays = Vec::with_capacity(required.len() + optional.len());
+        for (name, is_required) in wanted(required, optional) {
+            if arrays.iter().any(|(existing, _)| existing == name) {
+                continue;
+            }
+            let column = match data.get_item(name) {
+                Ok(column) => column,
+                Err(_) if !is_required => continue,
+                Err(_) => return Err(missing_column(name)),
+            };
+            // No copy when the column already is a contiguous float64 array
+            let array = numpy.call_method1("ascontiguousarray", (column, &float64))?;
+            let array = array.extract::<PyReadonlyArray1<f64>>().map_err(|_| {
+                PyValueError::new_err(format!("column '{}' must be one-dimensional", name))
+            })?;
+            arrays.push((name.to_owned(), ColumnValues::Numpy(array)));
+        }
+        Ok(InputColumns {
+            arrays,
+            codes: Vec::new(),
+        })
+    }
+
+    /// Take the wanted columns out of Arrow record batches
+    pub(crate) fn from_batches(batches: &[RecordBatch], required: &[&str], optional: &[&str]) -> PyResult<Self> {
+        let mut arrays = Vec::with_capacity(required.len() + optional.len());
+        for (name, is_required) in wanted(required, optional) {
+            if arrays.iter().any(|(existing, _)| existing == name) {
+                continue;
+            }
+            if batches.is_empty() {
+                arrays.push((name.to_owned(), ColumnValues::Owned(Vec::new())));
+                continue;
+            }
+            let chunks: Vec<&ArrayRef> = batches
+                .iter()
+                .filter_map(|batch| batch.column_by_name(name))
+                .collect();
+            if chunks.len() != batches.len() {
+                if is_required {
+                    return Err(missing_column(name));
+                }
+                continue;
+            }
+            arrays.push((name.to_owned(), arrow_column(name, &chunks)?));
+        }
+        Ok(InputColumns {
+            arrays,
+            codes: Vec::new(),
+        })
+    }
+
+    /// Add the level codes of a categorical column
+    pub(crate) fn add_codes(&mut self, name: &str, codes: Vec<u32>) {
+        self.codes.push((name.to_owned(), codes));
+    }
+
+    /// Borrow the extracted columns as slices that can cross `allow_threads`
+    pub(crate) fn column_set(&self) -> PyResult<ColumnSet<'_>> {
+        let mut columns = ColumnSet::default();
+        for (name, values) in &self.arrays {
+            columns
+                .insert(name, values.as_slice()?)
+                .map_err(PyValueError::new_err)?;
+        }
+        for (name, codes) in &self.codes {
+            columns.insert_codes(name, codes).map_err(PyValueError::new_err)?;
+        }
+        Ok(columns)
+    }
+}
+
+/// A categorical column: one code per row indexing into the sorted levels
+pub(crate) struct Factor {
+    pub(crate) codes: Vec<u32>,
+    pub(crate) levels: Vec<String>,
+}
+
+impl Factor {
+    fn from_values<T: Ord + Clone + ToString>(values: Vec<T>) -> Factor {
+        let mut levels = values.clone();
+        levels.sort();
+        levels.dedup();
+        let codes = values
+            .iter()
+            .map(|v| levels.binary_search(v).unwrap_or_default() as u32)
+            .collect();
+        Factor {
+            codes,
+            levels: levels.iter().map(ToString::to_string).collect(),
+        }
+    }
+
+    /// Re-code the column against `levels` (a fitted state's), failing on a
+    /// value that is not among them
+    pub(crate) fn recode(self, name: &str, levels: &[String]) -> PyResult<Factor> {
+        let positions: HashMap<&str, u32> = levels
+            .iter()
+            .enumerate()
+            .map(|(index, level)| (level.as_str(), index as u32))
+            .collect();
+        let mapping = self
+            .levels
+            .iter()
+            .map(|level| {
+                positions.get(level.as_str()).copied().ok_or_else(|| {
+                    PyValueError::new_err(format!(
+                        "column '{}' has level '{}', which is not among the fitted levels",
+                        name, level
+                    ))
+                })
+            })
+            .collect::<PyResult<Vec<u32>>>()?;
+        Ok(Factor {
+            codes: self.codes.iter().map(|&code| mapping[code as usize]).collect(),
+            levels: levels.to_vec(),
+        })
+    }
+}
+
+/// Input data, read once, from which numeric and categorical columns are taken
+pub(crate) enum Table<'py> {
+    Mapping(Bound<'py, PyAny>),
+    Arrow(Vec<RecordBatch>),
+}
+
+impl<'py> Table<'py> {
+    pub(crate) fn new(data: &Bound<'py, PyAny>) -> PyResult<Self> {
+        if data.hasattr("__arrow_c_stream__")? {
+            Ok(Table::Arrow(read_arrow_stream(data)?))
+        } else {
+            Ok(Table::Mapping(data.clone()))
+        }
+    }
+
+    /// Fetch `required` columns as float64, plus any of `optional` that are present
+    pub(crate) fn numeric(&self, required: &[&str], optional: &[&str]) -> PyResult<InputColumns<'py>> {
+        match self {
+            Table::Mapping(data) => InputColumns::from_mapping(data, required, optional),
+            Table::Arrow(batches) => InputColumns::from_batches(batches, required, optional),
+        }
+    }
+
+    /// Whether a column holds numbers (or booleans) rather than labels
+    pub(crate) fn is_numeric(&self, name: &str) -> PyResult<bool> {
+        match self {
+            Table::Mapping(data) => {
+                let column = data.get_item(name).map_err(|_| missing_column(name))?;
+                let array = data.py().import_bound("numpy")?.call_method1("asarray", (column,))?;
+                let kind: String = array.getattr("dtype")?.getattr("kind")?.extract()?;
+                Ok(matches!(kind.as_str(), "b" | "i" | "u" | "f"))
+            }
+            Table::Arrow(batches) => {
+                let field = match batches.first() {
+                    Some(batch) => batch.schema().field_with_name(name).map_err(|_| missing_column(name))?.clone(),
+                    None => return Ok(true),
+                };
+                Ok(is_numeric_type(field.data_type()))
+            }
+        }
+    }
+
+    /// Read a column as a categorical factor with sorted levels
+    pub(crate) fn factor(&self, name: &str) -> PyResult<Factor> {
+        match self {
+            Table::Mapping(data) => {
+                let py = data.py();
+                let column = data.get_item(name).map_err(|_| missing_column(name))?;
+                let numpy = py.import_bound("numpy")?;
+                let array = numpy.call_method1("asarray", (column,))?;
+                let kind: String = array.getattr("dtype")?.getattr("kind")?.extract()?;
+                if matches!(kind.as_str(), "b" | "i" | "u") {
+                    let ints = numpy.call_method1("ascontiguousarray", (array, "int64"))?;
+                    let ints = ints.extract::<PyReadonlyArray1<i64>>()?;
+                    let values = ints
+                        .as_slice()
+                        .map_err(|e| PyValueError::new_err(e.to_string()))?;
+                    return Ok(Factor::from_values(values.to_vec()));
+                }
+                let mut labels = Vec::new();
+                for item in array.call_method0("tolist")?.iter()? {
+                    labels.push(item?.str()?.extract::<String>()?);
+                }
+                Ok(Factor::from_values(labels))
+            }
+            Table::Arrow(batches) => {
+                let chunks: Vec<&ArrayRef> = batches
+                    .iter()
+                    .map(|batch| batch.column_by_name(name).ok_or_else(|| missing_column(name)))
+                    .collect::<PyResult<_>>()?;
+                let arrays: Vec<&dyn Array> = chunks.iter().map(|chunk| chunk.as_ref()).collect();
+                if arrays.is_empty() {
+                    return Ok(Factor::from_values(Vec::<i64>::new()));
+                }
+                let array = concat(&arrays).map_err(arrow_error)?;
+                if array.null_count() > 0 {
+                    return Err(PyValueError::new_err(format!("column '{}' contains nulls", name)));
+                }
+                if array.data_type().is_integer() || array.data_type() == &DataType::Boolean {
+                    let ints = cast(&array, &DataType::Int64).map_err(arrow_error)?;
+                    let ints = ints.as_primitive::<Int64Type>();
+                    return Ok(Factor::from_values(ints.values().to_vec()));
+                }
+                let labels = cast(&array, &DataType::Utf8).map_err(arrow_error)?;
+                let labels = labels.as_string::<i32>();
+                Ok(Factor::from_values(
+                    labels.iter().map(|v| v.unwrap_or_default().to_owned()).collect(),
+                ))
+            }
+        }
+    }
+}
+
+/// Whether an Arrow column of this type holds numbers (or booleans) rather than labels
+pub(crate) fn is_numeric_type(data_type: &DataType) -> bool {
+    data_type.is_numeric() || data_type == &DataType::Boolean
+}
+
+/// Sort levels gathered from several batches of a column of `data_type` as
+/// `Table::factor` sorts those of the whole column: numerically for integer
+/// and boolean columns, as strings otherwise
+pub(crate) fn sort_levels(levels: &mut [String], data_type: &DataType) {
+    if data_type.is_integer() || data_type == &DataType::Boolean {
+        levels.sort_by_key(|level| level.parse::<i64>().unwrap_or(i64::MAX));
+    } else {
+        levels.sort();
+    }
+}
+
+/// Required names flagged `true` followed by optional names flagged `false`
+fn wanted<'a>(required: &'a [&'a str], optional: &'a [&'a str]) -> impl Iterator<Item = (&'a str, bool)> {
+    required
+        .iter()
+        .map(|name| (*name, true))
+        .chain(optional.iter().map(|name| (*name, false)))
+}
+
+fn missing_column(name: &str) -> PyErr {
+    PyKeyError::new_err(format!("column '{}' not found in data", name))
+}
+
+pub(crate) fn arrow_error(e: impl std::fmt::Display) -> PyErr {
+    PyValueError::new_err(format!("Arrow error: {}", e))
+}
+
+/// Convert the chunks of one Arrow column to float64, copying only when needed
+fn arrow_column<'py>(name: &str, chunks: &[&ArrayRef]) -> PyResult<ColumnValues<'py>> {
+    let array = match chunks {
+        [single] => (*single).clone(),
+        _ => {
+            let arrays: Vec<&dyn Array> = chunks.iter().map(|chunk| chunk.as_ref()).collect();
+            concat(&arrays).map_err(arrow_error)?
+        }
+    };
+    let array = cast(&array, &DataType::Float64).map_err(|e| {
+        PyValueError::new_err(format!("column '{}' cannot be read as float64: {}", name, e))
+    })?;
+    let array = array.as_primitive::<Float64Type>().clone();
+    if array.null_count() == 0 {
+        return Ok(ColumnValues::Arrow(array));
+    }
+    // Nulls become NaN
+    Ok(ColumnValues::Owned(
+        array.iter().map(|v| v.unwrap_or(f64::NAN)).collect(),
+    ))
+}
+
+/// Open an object implementing `__arrow_c_stream__` as a record batch reader
+pub(crate) fn arrow_stream_reader(data: &Bound<PyAny>) -> PyResult<ArrowArrayStreamReader> {
+    let capsule = data.call_method0("__arrow_c_stream__")?;
+    let capsule = capsule.downcast::<PyCapsule>()?;
+    let expected = CStr::from_bytes_with_nul(b"arrow_array_stream\0").unwrap();
+    if capsule.name()? != Some(expected) {
+        return Err(PyValueError::new_err(
+            "__arrow_c_stream__ must return an 'arrow_array_stream' capsule",
+        ));
+    }
+    // SAFETY: the capsule holds a valid FFI_ArrowArrayStream; `from_raw` moves
+    // it out and leaves a released stream behind for the capsule destructor.
+    unsafe { ArrowArrayStreamReader::from_raw(capsule.pointer() as *mut FFI_ArrowArrayStream) }
+        .map_err(arrow_error)
+}
+
+/// Read every record batch of an object implementing `__arrow_c_stream__`
+fn read_arrow_stream(data: &Bound<PyAny>) -> PyResult<Vec<RecordBatch>> {
+    arrow_stream_reader(data)?
+        .collect::<Result<Vec<_>, _>>()
+        .map_err(arrow_error)
+}
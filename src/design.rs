@@ -0,0 +1,1002 @@
+//! Design (model) matrix construction from a parsed formula.
+//!
+//! A `Plan` resolves every name in `all_generated_columns` to a `Term` that
+//! knows how to compute it from raw data columns. Evaluation is split in two
+//! steps: `fit` learns data-dependent constants (means, standard deviations,
+//! orthogonal polynomial coefficients, spline knots) into a `FittedState`,
+//! and `fill` writes the terms into a preallocated column-major buffer.
+//! Categorical columns are expanded by `Plan::expand` into one indicator
+//! term per level, from levels kept in the same `FittedState`. Nothing here
+//! touches Python, so both steps run with the GIL released.
+
+use std::collections::{HashMap, HashSet};
+use std::ops::Range;
+
+use rayon::prelude::*;
+use serde_json::Value;
+
+use crate::parsed::{columns_in_order, has_role, is_fixed_effect, str_list};
+use crate::stats;
+
+/// Below this many output cells a matrix is filled on the calling thread
+pub(crate) const PARALLEL_THRESHOLD: usize = 1 << 16;
+
+/// Spline smooths, evaluated as a cubic B-spline basis
+const SPLINE_FUNCTIONS: &[&str] = &["s", "bs"];
+
+/// Degree of the spline basis
+const SPLINE_DEGREE: usize = 3;
+
+/// Transformations that turn a column into a categorical factor
+pub(crate) const FACTOR_FUNCTIONS: &[&str] = &["factor", "as_factor", "c", "C"];
+
+/// How to compute one generated column
+#[derive(Clone, Debug, PartialEq, Eq, Hash)]
+pub(crate) enum Term {
+    /// A column of ones
+    Intercept,
+    /// A raw data column
+    Column(String),
+    /// Output `index` of `function` applied to `column`, which generates `count` outputs
+    Transform {
+        function: String,
+        column: String,
+        /// The call's extra arguments as written by `render_parameters`, empty when there are none
+        parameters: String,
+        index: usize,
+        count: usize,
+    },
+    /// The elementwise product of its members
+    Interaction(Vec<Term>),
+    /// Indicator of level `level` of a categorical column
+    Level { column: String, level: u32 },
+}
+
+impl Term {
+    /// Collect the raw data columns this term reads as numbers
+    pub(crate) fn inputs<'a>(&'a self, out: &mut Vec<&'a str>) {
+        match self {
+            Term::Intercept | Term::Level { .. } => {}
+            Term::Column(name) | Term::Transform { column: name, .. } => {
+                if !out.contains(&name.as_str()) {
+                    out.push(name);
+                }
+            }
+            Term::Interaction(members) => members.iter().for_each(|member| member.inputs(out)),
+        }
+    }
+
+    /// Collect the stateful transformations this term needs fitted
+    fn stateful<'a>(&'a self, out: &mut Vec<&'a Term>) {
+        match self {
+            Term::Transform { function, .. } if is_stateful(function) => {
+                if !out.iter().any(|t| t.state_key() == self.state_key()) {
+                    out.push(self);
+                }
+            }
+            Term::Interaction(members) => members.iter().for_each(|member| member.stateful(out)),
+            _ => {}
+        }
+    }
+
+    /// The call a transformation's fitted state is stored under, e.g. `poly(x, degree=3)`
+    ///
+    /// Outputs of one call share a key; calls that differ in their arguments
+    /// (or, without arguments, in their number of outputs) do not.
+    pub(crate) fn state_key(&self) -> Option<String> {
+        match self {
+            Term::Transform {
+                function,
+                column,
+                parameters,
+                count,
+                ..
+            } => Some(transform_call(function, column, parameters, *count)),
+            _ => None,
+        }
+    }
+}
+
+/// Write a transformation as a call: `f(x)`, `f(x, parameters)`, or `f(x, count)`
+/// when it has no parameters but several outputs
+pub(crate) fn transform_call(function: &str, column: &str, parameters: &str, count: usize) -> String {
+    match (parameters, count) {
+        ("", 1) => format!("{}({})", function, column),
+        ("", count) => format!("{}({}, {})", function, column, count),
+        (parameters, _) => format!("{}({}, {})", function, column, parameters),
+    }
+}
+
+/// Write a transformation's `parameters` as call arguments, e.g. `1` or `df=3, k=10`
+///
+/// Named parameters are sorted by name so the result does not depend on the
+/// order fiasto reports them in; no parameters give an empty string.
+pub(crate) fn render_parameters(parameters: &Value) -> String {
+    fn argument(value: &Value) -> String {
+        match value {
+            Value::String(text) => text.clone(),
+            other => other.to_string(),
+        }
+    }
+    match parameters {
+        Value::Null => String::new(),
+        Value::Array(values) => values.iter().map(argument).collect::<Vec<_>>().join(", "),
+        Value::Object(entries) => {
+            let mut entries: Vec<_> = entries.iter().collect();
+            entries.sort_by(|a, b| a.0.cmp(b.0));
+            entries
+                .into_iter()
+                .map(|(name, value)| format!("{}={}", name, argument(value)))
+                .collect::<Vec<_>>()
+                .join(", ")
+        }
+        other => argument(other),
+    }
+}
+
+/// Whether a transformation needs constants learned from the data
+fn is_stateful(function: &str) -> bool {
+    matches!(function, "center" | "scale" | "standardize" | "poly" | "s" | "bs")
+}
+
+/// The columns generated by one transformation of `column`, as
+/// `(name fiasto generates, column name, term)`
+///
+/// fiasto lists a spline smooth as a single column (`s(z)` generates
+/// `z_s`); it is expanded into its basis, named `z_s_1`, `z_s_2`, ...
+pub(crate) fn transformation_columns<'a>(column: &str, transformation: &'a Value) -> Vec<(&'a str, String, Term)> {
+    let function = transformation["function"].as_str().unwrap_or_default();
+    let parameters = &transformation["parameters"];
+    let generates = str_list(&transformation["generates_columns"]);
+    let names: Vec<(&str, String)> = match generates.as_slice() {
+        [generated] if SPLINE_FUNCTIONS.contains(&function) => (1..=spline_size(function, parameters))
+            .map(|i| (*generated, format!("{}_{}", generated, i)))
+            .collect(),
+        _ => generates.iter().map(|generated| (*generated, (*generated).to_owned())).collect(),
+    };
+    let count = names.len();
+    let rendered = render_parameters(parameters);
+    names
+        .into_iter()
+        .enumerate()
+        .map(|(index, (generated, name))| {
+            let term = Term::Transform {
+                function: function.to_owned(),
+                column: column.to_owned(),
+                parameters: rendered.clone(),
+                index,
+                count,
+            };
+            (generated, name, term)
+        })
+        .collect()
+}
+
+/// Number of basis columns of a spline call
+///
+/// `df` gives it directly and `k` (the first positional argument of `s()`)
+/// gives `k - 1`, as mgcv drops one column to keep the smooth identifiable
+/// next to the intercept. The defaults are `k = 10` for `s()` and `df = 3`
+/// for `bs()`; there are never fewer columns than the degree of the basis.
+fn spline_size(function: &str, parameters: &Value) -> usize {
+    let number = |value: &Value| value.as_u64().or_else(|| value.as_str()?.trim().parse().ok());
+    let named = |name: &str| parameters.get(name).and_then(number);
+    let first = parameters.get(0).and_then(number);
+    let size = match function {
+        "s" => named("df").or_else(|| named("k").or(first).map(|k| k.saturating_sub(1))),
+        _ => named("df").or(first),
+    };
+    let default = if function == "s" { 9 } else { SPLINE_DEGREE as u64 };
+    (size.unwrap_or(default) as usize).max(SPLINE_DEGREE)
+}
+
+/// One factor of a model term
+pub(crate) enum Member<'a> {
+    Numeric(&'a Term),
+    /// A categorical column, coded from level `first` on (1 under treatment contrasts)
+    Categorical { column: &'a str, first: usize },
+}
+
+/// Split a term into its numeric and categorical factors
+fn members<'a>(term: &'a Term, categorical: &HashSet<&str>) -> Vec<Member<'a>> {
+    match term {
+        Term::Intercept => Vec::new(),
+        Term::Interaction(parts) => parts.iter().flat_map(|part| members(part, categorical)).collect(),
+        Term::Column(name) if categorical.contains(name.as_str()) => {
+            vec![Member::Categorical { column: name, first: 0 }]
+        }
+        Term::Transform { function, column, .. } if FACTOR_FUNCTIONS.contains(&function.as_str()) => {
+            vec![Member::Categorical { column, first: 0 }]
+        }
+        other => vec![Member::Numeric(other)],
+    }
+}
+
+/// A key identifying a factor, used to compare terms as sets of factors
+fn member_key(member: &Member) -> String {
+    match member {
+        Member::Categorical { column, .. } => (*column).to_owned(),
+        Member::Numeric(Term::Column(name)) => name.clone(),
+        Member::Numeric(term) => format!("{:?}", term),
+    }
+}
+
+/// Split each term into its factors, choosing how its categorical ones are coded
+///
+/// Bare columns in `categorical` and columns wrapped in `factor()`/`c()` are
+/// categorical. As in R, a categorical factor is coded by treatment
+/// contrasts (its first level dropped) when the term without it is also in
+/// the model, e.g. `g` with an intercept or `x:g` alongside `x`; otherwise
+/// all levels are kept.
+pub(crate) fn coded_members<'a>(terms: &'a [Term], categorical: &HashSet<&str>) -> Vec<Vec<Member<'a>>> {
+    let mut split: Vec<Vec<Member>> = terms.iter().map(|term| members(term, categorical)).collect();
+    let keys: Vec<HashSet<String>> = split
+        .iter()
+        .map(|members| members.iter().map(member_key).collect())
+        .collect();
+    let intercept = terms.contains(&Term::Intercept);
+    for (members, own) in split.iter_mut().zip(&keys) {
+        for member in members.iter_mut() {
+            if let Member::Categorical { column, first } = member {
+                let mut margin = own.clone();
+                margin.remove(*column);
+                let contrasts = keys.iter().any(|other| *other == margin) || (margin.is_empty() && intercept);
+                *first = contrasts as usize;
+            }
+        }
+    }
+    split
+}
+
+/// Borrowed raw data columns, all of the same length
+#[derive(Default)]
+pub(crate) struct ColumnSet<'a> {
+    nrows: usize,
+    columns: HashMap<&'a str, &'a [f64]>,
+    /// Level codes of the categorical columns
+    codes: HashMap<&'a str, &'a [u32]>,
+}
+
+impl<'a> ColumnSet<'a> {
+    /// Add a column, checking that its length matches the columns already added
+    pub(crate) fn insert(&mut self, name: &'a str, values: &'a [f64]) -> Result<(), String> {
+        self.check_rows(name, values.len())?;
+        self.columns.insert(name, values);
+        Ok(())
+    }
+
+    /// Add the level codes of a categorical column, checked like `insert`
+    pub(crate) fn insert_codes(&mut self, name: &'a str, codes: &'a [u32]) -> Result<(), String> {
+        self.check_rows(name, codes.len())?;
+        self.codes.insert(name, codes);
+        Ok(())
+    }
+
+    fn check_rows(&mut self, name: &str, len: usize) -> Result<(), String> {
+        if self.columns.is_empty() && self.codes.is_empty() {
+            self.nrows = len;
+        } else if len != self.nrows {
+            return Err(format!("column '{}' has {} rows, expected {}", name, len, self.nrows));
+        }
+        Ok(())
+    }
+
+    pub(crate) fn get(&self, name: &str) -> Result<&'a [f64], String> {
+        self.columns
+            .get(name)
+            .copied()
+            .ok_or_else(|| format!("column '{}' not found in data", name))
+    }
+
+    pub(crate) fn codes(&self, name: &str) -> Result<&'a [u32], String> {
+        self.codes
+            .get(name)
+            .copied()
+            .ok_or_else(|| format!("categorical column '{}' not found in data", name))
+    }
+
+    pub(crate) fn nrows(&self) -> usize {
+        self.nrows
+    }
+}
+
+/// Constants learned from data, keyed by the transformation call (see
+/// `Term::state_key`), and the levels of each categorical column
+#[derive(Clone, Debug, Default, PartialEq)]
+pub(crate) struct FittedState {
+    pub(crate) params: HashMap<String, Vec<f64>>,
+    pub(crate) levels: HashMap<String, Vec<String>>,
+}
+
+impl FittedState {
+    fn get(&self, key: &str) -> Result<&[f64], String> {
+        self.params
+            .get(key)
+            .map(Vec::as_slice)
+            .ok_or_else(|| format!("no fitted state for {}", key))
+    }
+}
+
+/// The resolved terms of a formula
+#[derive(Clone, Debug)]
+pub(crate) struct Plan {
+    /// Names of the response columns
+    pub(crate) response: Vec<String>,
+    /// Terms computing the response columns
+    pub(crate) response_terms: Vec<Term>,
+    /// Names of the design-matrix columns
+    pub(crate) names: Vec<String>,
+    /// Terms computing the design-matrix columns
+    pub(crate) terms: Vec<Term>,
+}
+
+impl Plan {
+    /// Resolve the generated columns of a parse result into terms
+    pub(crate) fn from_parsed(value: &Value) -> Result<Plan, String> {
+        let columns = columns_in_order(value);
+        let ids: HashMap<&str, i64> = columns
+            .iter()
+            .map(|(name, info)| (*name, info["id"].as_i64().unwrap_or(i64::MAX)))
+            .collect();
+
+        // name -> (term, whether it belongs to the fixed-effects design matrix)
+        let mut resolved: HashMap<String, (Term, bool)> = HashMap::new();
+        // generated name -> the basis columns it stands for, for spline smooths
+        let mut expanded: HashMap<&str, Vec<String>> = HashMap::new();
+        let mut response = Vec::new();
+        for (name, info) in &columns {
+            let fixed = is_fixed_effect(info);
+            if has_role(info, "Response") {
+                response.extend(str_list(&info["generated_columns"]).into_iter().map(str::to_owned));
+            }
+            if str_list(&info["generated_columns"]).contains(name) {
+                resolved.insert((*name).to_owned(), (Term::Column((*name).to_owned()), fixed));
+            }
+            for transformation in info["transformations"].as_array().into_iter().flatten() {
+                for (generated, column, term) in transformation_columns(name, transformation) {
+                    if column != generated {
+                        expanded.entry(generated).or_default().push(column.clone());
+                    }
+                    resolved.insert(column, (term, fixed));
+                }
+            }
+        }
+
+        // Interactions last, so their members can refer to transformed columns
+        let mut interactions = Vec::new();
+        for (name, info) in &columns {
+            for interaction in info["interactions"].as_array().into_iter().flatten() {
+                let fixed = interaction["context"].as_str().unwrap_or("fixed_effects") == "fixed_effects";
+                let mut members = vec![*name];
+                members.extend(str_list(&interaction["with"]));
+                if let Some(member) = members.iter().find(|member| expanded.contains_key(*member)) {
+                    return Err(format!("interactions with the spline basis '{}' are not supported", member));
+                }
+                let term = Term::Interaction(
+                    members
+                        .iter()
+                        .map(|member| match resolved.get(*member) {
+                            Some((term, _)) => term.clone(),
+                            None => Term::Column((*member).to_owned()),
+                        })
+                        .collect(),
+                );
+                let as_written = members.join("_");
+                members.sort_by_key(|member| ids.get(member).copied().unwrap_or(i64::MAX));
+                for generated in [as_written, members.join("_")] {
+                    interactions.push((generated, (term.clone(), fixed)));
+                }
+            }
+        }
+        for (generated, entry) in interactions {
+            resolved.entry(generated).or_insert(entry);
+        }
+
+        let mut all_generated = str_list(&value["all_generated_columns"]);
+        if all_generated.is_empty() {
+            all_generated = columns
+                .iter()
+                .flat_map(|(_, info)| str_list(&info["generated_columns"]))
+                .collect();
+        }
+        let has_intercept = value["metadata"]["has_intercept"].as_bool().unwrap_or(true);
+
+        let mut plan = Plan {
+            response_terms: Vec::with_capacity(response.len()),
+            response,
+            names: Vec::new(),
+            terms: Vec::new(),
+        };
+        for name in &plan.response {
+            match resolved.get(name) {
+                Some((term, _)) => plan.response_terms.push(term.clone()),
+                None => return Err(format!("cannot resolve response column '{}'", name)),
+            }
+        }
+        if has_intercept && !all_generated.contains(&"intercept") {
+            plan.names.push("intercept".to_owned());
+            plan.terms.push(Term::Intercept);
+        }
+        let mut seen: HashSet<&str> = HashSet::new();
+        for generated in all_generated {
+            if !seen.insert(generated) || plan.response.iter().any(|r| r == generated) {
+                continue;
+            }
+            if generated == "intercept" {
+                if has_intercept {
+                    plan.names.push("intercept".to_owned());
+                    plan.terms.push(Term::Intercept);
+                }
+                continue;
+            }
+            let outputs = match expanded.get(generated) {
+                Some(basis) => basis.iter().map(String::as_str).collect(),
+                None => vec![generated],
+            };
+            for column in outputs {
+                match resolved.get(column) {
+                    Some((term, true)) => {
+                        plan.names.push(column.to_owned());
+                        plan.terms.push(term.clone());
+                    }
+                    Some((_, false)) => {}
+                    None => return Err(format!("cannot resolve generated column '{}'", column)),
+                }
+            }
+        }
+        Ok(plan)
+    }
+
+    /// Raw data columns needed to evaluate the design matrix
+    pub(crate) fn required_columns(&self) -> Vec<&str> {
+        let mut out = Vec::new();
+        self.terms.iter().for_each(|term| term.inputs(&mut out));
+        out
+    }
+
+    /// Raw data columns needed to evaluate the response
+    pub(crate) fn response_columns(&self) -> Vec<&str> {
+        let mut out = Vec::new();
+        self.response_terms.iter().for_each(|term| term.inputs(&mut out));
+        out
+    }
+
+    /// The transformations whose constants must be learned from data
+    fn stateful_terms(&self) -> Vec<&Term> {
+        let mut stateful = Vec::new();
+        for term in self.terms.iter().chain(&self.response_terms) {
+            term.stateful(&mut stateful);
+        }
+        stateful
+    }
+
+    /// Whether evaluating the plan needs a `FittedState`
+    pub(crate) fn needs_state(&self) -> bool {
+        !self.stateful_terms().is_empty() || !self.factor_columns(&HashSet::new()).is_empty()
+    }
+
+    /// The data columns read as categorical factors: those wrapped in
+    /// `factor()`/`c()` and the bare columns in `categorical`
+    pub(crate) fn factor_columns(&self, categorical: &HashSet<&str>) -> Vec<&str> {
+        let mut out = Vec::new();
+        for term in &self.terms {
+            for member in members(term, categorical) {
+                if let Member::Categorical { column, .. } = member {
+                    if !out.contains(&column) {
+                        out.push(column);
+                    }
+                }
+            }
+        }
+        out
+    }
+
+    /// Replace the categorical factors of the design terms by indicators
+    ///
+    /// `levels` holds the levels of each categorical column; bare columns
+    /// without levels stay numeric. A term gets one column per combination
+    /// of the levels it codes (see `coded_members`), named `name[b]` or
+    /// `name[b:u]` with the first factor varying fastest.
+    pub(crate) fn expand(&self, levels: &HashMap<String, Vec<String>>) -> Result<Plan, String> {
+        let categorical: HashSet<&str> = levels.keys().map(String::as_str).collect();
+        let mut plan = Plan {
+            response: self.response.clone(),
+            response_terms: self.response_terms.clone(),
+            names: Vec::with_capacity(self.names.len()),
+            terms: Vec::with_capacity(self.terms.len()),
+        };
+        let coded = coded_members(&self.terms, &categorical);
+        for ((name, term), members) in self.names.iter().zip(&self.terms).zip(coded) {
+            let mut numeric = Vec::new();
+            let mut factors: Vec<(&str, &[String], usize)> = Vec::new();
+            for member in members {
+                match member {
+                    Member::Numeric(term) => numeric.push(term.clone()),
+                    Member::Categorical { column, first } => {
+                        let labels = levels
+                            .get(column)
+                            .ok_or_else(|| format!("no levels for categorical column '{}'", column))?;
+                        factors.push((column, labels.as_slice(), first));
+                    }
+                }
+            }
+            if factors.is_empty() {
+                plan.names.push(name.clone());
+                plan.terms.push(term.clone());
+                continue;
+            }
+            let total: usize = factors
+                .iter()
+                .map(|(_, labels, first)| labels.len().saturating_sub(*first))
+                .product();
+            for combination in 0..total {
+                let mut rest = combination;
+                let mut parts = numeric.clone();
+                let mut labels = Vec::with_capacity(factors.len());
+                for (column, levels, first) in &factors {
+                    let size = levels.len() - first;
+                    let level = first + rest % size;
+                    rest /= size;
+                    labels.push(levels[level].as_str());
+                    parts.push(Term::Level {
+                        column: (*column).to_owned(),
+                        level: level as u32,
+                    });
+                }
+                plan.names.push(format!("{}[{}]", name, labels.join(":")));
+                plan.terms.push(match parts.len() {
+                    1 => parts.remove(0),
+                    _ => Term::Interaction(parts),
+                });
+            }
+        }
+        Ok(plan)
+    }
+
+    /// Learn the constants of every stateful transformation from `columns`
+    pub(crate) fn fit(&self, columns: &ColumnSet) -> Result<FittedState, String> {
+        let mut state = FittedState::default();
+        for term in self.stateful_terms() {
+            if let Term::Transform {
+                function,
+                column,
+                count,
+                ..
+            } = term
+            {
+                let params = fit_transform(function, columns.get(column)?, *count);
+                state.params.insert(term.state_key().unwrap_or_default(), params);
+            }
+        }
+        Ok(state)
+    }
+
+    /// Start learning the plan's constants incrementally, one batch at a time
+    pub(crate) fn accumulator(&self) -> StateAccumulator {
+        let mut accumulator = StateAccumulator {
+            moments: Vec::new(),
+            samples: Vec::new(),
+        };
+        for term in self.stateful_terms() {
+            let Term::Transform {
+                function,
+                column,
+                count,
+                ..
+            } = term
+            else {
+                continue;
+            };
+            let key = term.state_key().unwrap_or_default();
+            if SPLINE_FUNCTIONS.contains(&function.as_str()) {
+                accumulator.samples.push(Sample {
+                    key,
+                    column: column.clone(),
+                    count: *count,
+                    values: Vec::new(),
+                });
+                continue;
+            }
+            let max_power = if function == "poly" { 2 * count } else { 2 };
+            accumulator.moments.push(Moments {
+                key,
+                function: function.clone(),
+                column: column.clone(),
+                count: *count,
+                shift: None,
+                sums: vec![0.0; max_power + 1],
+            });
+        }
+        accumulator
+    }
+
+    /// Write `terms` for `rows` into `out`, column-major with `rows.len()` values per column
+    pub(crate) fn fill(
+        terms: &[Term],
+        state: &FittedState,
+        columns: &ColumnSet,
+        rows: Range<usize>,
+        out: &mut [f64],
+    ) -> Result<(), String> {
+        let nrows = rows.len();
+        if nrows == 0 {
+            return Ok(());
+        }
+        stats::EVALUATE.time(|| Plan::fill_columns(terms, state, columns, rows, out))
+    }
+
+    /// `fill` without the timer, in parallel over columns for large outputs
+    fn fill_columns(
+        terms: &[Term],
+        state: &FittedState,
+        columns: &ColumnSet,
+        rows: Range<usize>,
+        out: &mut [f64],
+    ) -> Result<(), String> {
+        let nrows = rows.len();
+        if nrows * terms.len() >= PARALLEL_THRESHOLD {
+            terms
+                .par_iter()
+                .zip(out.par_chunks_mut(nrows))
+                .try_for_each(|(term, column)| fill_term(term, state, columns, rows.clone(), column))
+        } else {
+            terms
+                .iter()
+                .zip(out.chunks_mut(nrows))
+                .try_for_each(|(term, column)| fill_term(term, state, columns, rows.clone(), column))
+        }
+    }
+
+    /// Evaluate the design matrix for all rows as a column-major buffer
+    pub(crate) fn evaluate(&self, state: &FittedState, columns: &ColumnSet) -> Result<Vec<f64>, String> {
+        let mut out = vec![0.0; columns.nrows() * self.terms.len()];
+        Plan::fill(&self.terms, state, columns, 0..columns.nrows(), &mut out)?;
+        Ok(out)
+    }
+}
+
+/// Shifted power sums `sum((x - shift)^j)` of one transformed column
+struct Moments {
+    key: String,
+    function: String,
+    column: String,
+    count: usize,
+    shift: Option<f64>,
+    sums: Vec<f64>,
+}
+
+/// The values of a spline's input, kept until its knots can be placed
+struct Sample {
+    key: String,
+    column: String,
+    count: usize,
+    values: Vec<f64>,
+}
+
+/// Learns a `FittedState` in a single pass over data that arrives in batches
+///
+/// Every stateful transformation but the splines only needs low-order power
+/// sums of its input, so the state is exact regardless of how the data is
+/// split. Sums are taken around the mean of the first batch to keep them
+/// well conditioned. Spline knots are quantiles, so the input of each
+/// spline is kept, one float per row, until `finish` places them.
+pub(crate) struct StateAccumulator {
+    moments: Vec<Moments>,
+    samples: Vec<Sample>,
+}
+
+impl StateAccumulator {
+    /// The data columns read by `update`
+    pub(crate) fn columns(&self) -> Vec<&str> {
+        let mut out: Vec<&str> = Vec::new();
+        let columns = self.moments.iter().map(|moments| moments.column.as_str());
+        for column in columns.chain(self.samples.iter().map(|sample| sample.column.as_str())) {
+            if !out.contains(&column) {
+                out.push(column);
+            }
+        }
+        out
+    }
+
+    /// Add one batch of rows
+    pub(crate) fn update(&mut self, columns: &ColumnSet) -> Result<(), String> {
+        for sample in &mut self.samples {
+            sample.values.extend_from_slice(columns.get(&sample.column)?);
+        }
+        for moments in &mut self.moments {
+            let x = columns.get(&moments.column)?;
+            if x.is_empty() {
+                continue;
+            }
+            let shift = *moments
+                .shift
+                .get_or_insert_with(|| x.iter().sum::<f64>() / x.len() as f64);
+            for &v in x {
+                let t = v - shift;
+                let mut power = 1.0;
+                for sum in moments.sums.iter_mut() {
+                    *sum += power;
+                    power *= t;
+                }
+            }
+        }
+        Ok(())
+    }
+
+    /// Turn the accumulated sums into the fitted constants
+    pub(crate) fn finish(self) -> FittedState {
+        let mut state = FittedState::default();
+        for moments in self.moments {
+            let shift = moments.shift.unwrap_or(0.0);
+            let s = &moments.sums;
+            let mean = shift + s[1] / s[0];
+            let params = match moments.function.as_str() {
+                "center" => vec![mean],
+                "scale" | "standardize" => {
+                    let variance = (s[2] - s[1] * s[1] / s[0]) / (s[0] - 1.0);
+                    vec![mean, variance.sqrt()]
+                }
+                "poly" => poly_from_moments(shift, s, moments.count),
+                _ => Vec::new(),
+            };
+            state.params.insert(moments.key, params);
+        }
+        for sample in self.samples {
+            state.params.insert(sample.key, spline_knots(&sample.values, sample.count));
+        }
+        state
+    }
+}
+
+/// Fit orthogonal polynomials from the power sums `s[j] = sum((x - shift)^j)`,
+/// j = 0..=2 * degree, producing the same constants as `poly_fit`
+fn poly_from_moments(shift: f64, s: &[f64], degree: usize) -> Vec<f64> {
+    // Polynomials are coefficient vectors in t = x - shift
+    let inner = |p: &[f64], q: &[f64]| -> f64 {
+        p.iter()
+            .enumerate()
+            .map(|(i, pi)| q.iter().enumerate().map(|(j, qj)| pi * qj * s[i + j]).sum::<f64>())
+            .sum()
+    };
+    let mut alpha = Vec::with_capacity(degree);
+    let mut norm2 = vec![s[0]];
+    let mut previous: Vec<f64> = Vec::new();
+    let mut current = vec![1.0];
+    for k in 0..degree {
+        let mut next = vec![0.0];
+        next.extend(&current);
+        let a = inner(&next, &current) / norm2[k] + shift;
+        let beta = if k == 0 { 0.0 } else { norm2[k] / norm2[k - 1] };
+        for (i, p) in current.iter().enumerate() {
+            next[i] += (shift - a) * p;
+        }
+        for (i, q) in previous.iter().enumerate() {
+            next[i] -= beta * q;
+        }
+        alpha.push(a);
+        norm2.push(inner(&next, &next));
+        previous = current;
+        current = next;
+    }
+    alpha.extend(norm2);
+    alpha
+}
+
+/// Compute one term for `rows` into `out`
+pub(crate) fn fill_term(
+    term: &Term,
+    state: &FittedState,
+    columns: &ColumnSet,
+    rows: Range<usize>,
+    out: &mut [f64],
+) -> Result<(), String> {
+    match term {
+        Term::Intercept => out.fill(1.0),
+        Term::Column(name) => out.copy_from_slice(&columns.get(name)?[rows]),
+        Term::Transform {
+            function,
+            column,
+            index,
+            count,
+            ..
+        } => {
+            let x = &columns.get(column)?[rows];
+            let params = match term.state_key() {
+                Some(key) if is_stateful(function) => state.get(&key)?,
+                _ => &[],
+            };
+            apply_transform(function, *index, *count, params, x, out)?;
+        }
+        Term::Level { column, level } => {
+            let codes = &columns.codes(column)?[rows];
+            out.iter_mut().zip(codes).for_each(|(o, code)| *o = f64::from(u8::from(code == level)));
+        }
+        Term::Interaction(members) => {
+            let (first, rest) = members
+                .split_first()
+                .ok_or_else(|| "empty interaction".to_owned())?;
+            fill_term(first, state, columns, rows.clone(), out)?;
+            let mut buffer = vec![0.0; out.len()];
+            for member in rest {
+                fill_term(member, state, columns, rows.clone(), &mut buffer)?;
+                out.iter_mut().zip(&buffer).for_each(|(o, b)| *o *= b);
+            }
+        }
+    }
+    Ok(())
+}
+
+/// Apply output `index` of a transformation to `x`, writing into `out`
+fn apply_transform(
+    function: &str,
+    index: usize,
+    count: usize,
+    params: &[f64],
+    x: &[f64],
+    out: &mut [f64],
+) -> Result<(), String> {
+    let map = |out: &mut [f64], f: &dyn Fn(f64) -> f64| {
+        out.iter_mut().zip(x).for_each(|(o, &v)| *o = f(v));
+    };
+    match function {
+        "log" => map(out, &f64::ln),
+        "log10" => map(out, &f64::log10),
+        "log2" => map(out, &f64::log2),
+        "log1p" => map(out, &f64::ln_1p),
+        "exp" => map(out, &f64::exp),
+        "sqrt" => map(out, &f64::sqrt),
+        "abs" => map(out, &f64::abs),
+        "offset" | "identity" | "I" => out.copy_from_slice(x),
+        "center" => map(out, &|v| v - params[0]),
+        "scale" | "standardize" => map(out, &|v| (v - params[0]) / params[1]),
+        "poly" => {
+            if params.len() != 2 * count + 1 {
+                return Err(format!(
+                    "fitted state for poly() has {} values, expected {}",
+                    params.len(),
+                    2 * count + 1
+                ));
+            }
+            let (alpha, norm2) = params.split_at(count);
+            map(out, &|v| poly_value(v, alpha, norm2, index));
+        }
+        "s" | "bs" => {
+            // Boundary knots around `count - SPLINE_DEGREE` interior knots
+            let expected = count + 2 - SPLINE_DEGREE;
+            if params.len() != expected {
+                return Err(format!(
+                    "fitted state for {}() has {} values, expected {}",
+                    function,
+                    params.len(),
+                    expected
+                ));
+            }
+            let (lower, upper) = (params[0], params[expected - 1]);
+            if !(lower < upper) {
+                return Err(format!("{}() needs a column with at least two distinct values", function));
+            }
+            let mut knots = vec![lower; SPLINE_DEGREE];
+            knots.extend_from_slice(params);
+            knots.extend(std::iter::repeat(upper).take(SPLINE_DEGREE));
+            map(out, &|v| bspline_value(v.clamp(lower, upper), &knots, index + 1));
+        }
+        other => return Err(format!("cannot evaluate transformation '{}'", other)),
+    }
+    Ok(())
+}
+
+/// Learn the constants of a stateful transformation
+fn fit_transform(function: &str, x: &[f64], count: usize) -> Vec<f64> {
+    let n = x.len() as f64;
+    let mean = x.iter().sum::<f64>() / n;
+    match function {
+        "center" => vec![mean],
+        "scale" | "standardize" => {
+            let variance = x.iter().map(|v| (v - mean).powi(2)).sum::<f64>() / (n - 1.0);
+            vec![mean, variance.sqrt()]
+        }
+        "poly" => poly_fit(x, count),
+        "s" | "bs" => spline_knots(x, count),
+        _ => Vec::new(),
+    }
+}
+
+/// Knots of a cubic B-spline basis with `count` columns, as R's `bs()`:
+/// the range of `x` and `count - 3` interior knots at its quantiles
+fn spline_knots(x: &[f64], count: usize) -> Vec<f64> {
+    let mut sorted: Vec<f64> = x.iter().copied().filter(|v| !v.is_nan()).collect();
+    if sorted.is_empty() {
+        return Vec::new();
+    }
+    sorted.sort_unstable_by(f64::total_cmp);
+    let last = sorted.len() - 1;
+    // Linear interpolation between order statistics (R's default quantile type)
+    let quantile = |p: f64| {
+        let h = last as f64 * p;
+        let below = h.floor() as usize;
+        let above = (below + 1).min(last);
+        sorted[below] + (h - below as f64) * (sorted[above] - sorted[below])
+    };
+    let interior = count - SPLINE_DEGREE;
+    let mut knots = Vec::with_capacity(interior + 2);
+    knots.push(sorted[0]);
+    knots.extend((1..=interior).map(|i| quantile(i as f64 / (interior + 1) as f64)));
+    knots.push(sorted[last]);
+    knots
+}
+
+/// Evaluate B-spline basis function `basis` at `v` by the Cox-de Boor
+/// recurrence, over the full knot vector `knots` (boundary knots repeated)
+fn bspline_value(v: f64, knots: &[f64], basis: usize) -> f64 {
+    if v.is_nan() {
+        return f64::NAN;
+    }
+    // The knot span holding `v`; the upper boundary belongs to the last span
+    let functions = knots.len() - SPLINE_DEGREE - 1;
+    let span = (SPLINE_DEGREE..functions)
+        .rev()
+        .find(|&span| knots[span] <= v && knots[span] < knots[span + 1])
+        .unwrap_or(SPLINE_DEGREE);
+    let first = span - SPLINE_DEGREE;
+    if basis < first || basis > span {
+        return 0.0;
+    }
+    // values[r] is basis function `first + r` at `v`
+    let mut values = [0.0; SPLINE_DEGREE + 1];
+    let mut left = [0.0; SPLINE_DEGREE + 1];
+    let mut right = [0.0; SPLINE_DEGREE + 1];
+    values[0] = 1.0;
+    for j in 1..=SPLINE_DEGREE {
+        left[j] = v - knots[span + 1 - j];
+        right[j] = knots[span + j] - v;
+        let mut saved = 0.0;
+        for r in 0..j {
+            let temp = values[r] / (right[r + 1] + left[j - r]);
+            values[r] = saved + right[r + 1] * temp;
+            saved = left[j - r] * temp;
+        }
+        values[j] = saved;
+    }
+    values[basis - first]
+}
+
+/// Fit orthogonal polynomials of degree 1..=degree (as R's `poly()`) by the
+/// three-term recurrence, returning `[alpha_0..alpha_{d-1}, norm2_0..norm2_d]`
+fn poly_fit(x: &[f64], degree: usize) -> Vec<f64> {
+    let mut alpha = Vec::with_capacity(degree);
+    let mut norm2 = vec![x.len() as f64];
+    let mut previous = vec![0.0; x.len()];
+    let mut current = vec![1.0; x.len()];
+    for k in 0..degree {
+        let a = x
+            .iter()
+            .zip(&current)
+            .map(|(v, p)| v * p * p)
+            .sum::<f64>()
+            / norm2[k];
+        let beta = if k == 0 { 0.0 } else { norm2[k] / norm2[k - 1] };
+        let next: Vec<f64> = x
+            .iter()
+            .zip(current.iter().zip(&previous))
+            .map(|(v, (p, q))| (v - a) * p - beta * q)
+            .collect();
+        alpha.push(a);
+        norm2.push(next.iter().map(|p| p * p).sum());
+        previous = current;
+        current = next;
+    }
+    alpha.extend(norm2);
+    alpha
+}
+
+/// Evaluate orthogonal polynomial output `index` (degree `index + 1`) at `v`
+fn poly_value(v: f64, alpha: &[f64], norm2: &[f64], index: usize) -> f64 {
+    let (mut previous, mut current) = (0.0, 1.0);
+    for k in 0..=index {
+        let beta = if k == 0 { 0.0 } else { norm2[k] / norm2[k - 1] };
+        let next = (v - alpha[k]) * current - beta * previous;
+        previous = current;
+        current = next;
+    }
+    current / norm2[index + 1].sqrt()
+}
@@ -0,0 +1,169 @@
+//! Optional on-disk parse cache shared between processes.
+//!
+//! Each entry is one file named by a 128-bit hash of the package version,
+//! the fiasto parser version (both recorded by build.rs), the encoding
+//! version and the formula. It holds the formula followed by the `dumps`
+//! encoding of its parse result, and is read through a memory map, so
+//! processes on one machine share the page cache instead of each parsing
+//! the formula. Entries are written to a unique temporary file, synced and
+//! renamed into place, which is atomic: concurrent writers of the same entry
+//! produce identical bytes, and readers never see a partial file.
+
+use std::fs::{self, File};
+use std::io::Write;
+use std::path::{Path, PathBuf};
+use std::sync::atomic::{AtomicBool, AtomicU64, Ordering};
+use std::sync::{RwLock, RwLockReadGuard};
+
+use memmap2::Mmap;
+use pyo3::exceptions::PyOSError;
+use pyo3::prelude::*;
+use serde_json::Value;
+
+use crate::{binary, stats};
+use crate::canonical::fnv1a_128;
+
+const MAGIC: &[u8; 4] = b"FIAC";
+const EXTENSION: &str = "fpc";
+
+/// Environment variable naming a cache directory to use from import
+pub(crate) const ENV_VAR: &str = "FIASTO_PY_CACHE_DIR";
+
+static DIRECTORY: RwLock<Option<PathBuf>> = RwLock::new(None);
+
+/// Whether `DIRECTORY` is set, so lookups with the disk cache disabled never take the lock
+static ENABLED: AtomicBool = AtomicBool::new(false);
+
+/// Distinguishes temporary files written by threads of one process
+static TEMP_COUNTER: AtomicU64 = AtomicU64::new(0);
+
+fn directory() -> RwLockReadGuard<'static, Option<PathBuf>> {
+    DIRECTORY.read().unwrap_or_else(|e| e.into_inner())
+}
+
+fn entry_path(directory: &Path, formula: &str) -> PathBuf {
+    let hash = fnv1a_128(&[
+        env!("FIASTO_PY_VERSION").as_bytes(),
+        env!("FIASTO_VERSION").as_bytes(),
+        &[binary::FORMAT_VERSION],
+        formula.as_bytes(),
+    ]);
+    directory.join(format!("{:032x}.{}", hash, EXTENSION))
+}
+
+/// Read an entry if present and valid for this formula
+fn read_entry(path: &Path, formula: &str) -> Option<Value> {
+    let file = File::open(path).ok()?;
+    // Safety: entries are only ever replaced by rename, never modified in place
+    let map = unsafe { Mmap::map(&file) }.ok()?;
+    let rest = map.strip_prefix(MAGIC.as_slice())?;
+    let length = u32::from_le_bytes(rest.get(..4)?.try_into().ok()?) as usize;
+    let stored = rest.get(4..4 + length)?;
+    // Guard against hash collisions
+    if stored != formula.as_bytes() {
+        return None;
+    }
+    binary::decode(&rest[4 + length..]).ok()
+}
+
+/// Write an entry atomically; failures only cost a future cache miss
+fn write_entry(path: &Path, formula: &str, value: &Value) -> std::io::Result<()> {
+    let payload = binary::encode(value);
+    let temp = path.with_extension(format!(
+        "{}.{}.tmp",
+        std::process::id(),
+        TEMP_COUNTER.fetch_add(1, Ordering::Relaxed)
+    ));
+    let result = (|| {
+        let mut file = File::create(&temp)?;
+        file.write_all(MAGIC)?;
+        file.write_all(&(formula.len() as u32).to_le_bytes())?;
+        file.write_all(formula.as_bytes())?;
+        file.write_all(&payload)?;
+        // Flush to disk before the rename publishes the entry, so a crash
+        // cannot leave a complete-looking name over incomplete contents
+        file.sync_all()?;
+        fs::rename(&temp, path)
+    })();
+    if result.is_err() {
+        let _ = fs::remove_file(&temp);
+    }
+    result
+}
+
+/// Look up a formula in the disk cache, if one is configured
+pub(crate) fn get(formula: &str) -> Option<Value> {
+    if !ENABLED.load(Ordering::Acquire) {
+        return None;
+    }
+    let directory = directory();
+    let value = read_entry(&entry_path(directory.as_ref()?, formula), formula);
+    let counter = if value.is_some() { &stats::DISK_HITS } else { &stats::DISK_MISSES };
+    stats::increment(counter, 1);
+    value
+}
+
+/// Store a parse result in the disk cache, if one is configured
+pub(crate) fn put(formula: &str, value: &Value) {
+    if !ENABLED.load(Ordering::Acquire) {
+        return;
+    }
+    let directory = directory();
+    if let Some(directory) = directory.as_ref() {
+        if formula.len() <= u32::MAX as usize {
+            if write_entry(&entry_path(directory, formula), formula, value).is_ok() {
+                stats::increment(&stats::DISK_WRITES, 1);
+            }
+        }
+    }
+}
+
+/// Point the disk cache at `path`, creating the directory if needed
+pub(crate) fn set_directory(path: Option<PathBuf>) -> std::io::Result<()> {
+    if let Some(path) = &path {
+        fs::create_dir_all(path)?;
+    }
+    let mut directory = DIRECTORY.write().unwrap_or_else(|e| e.into_inner());
+    ENABLED.store(path.is_some(), Ordering::Release);
+    *directory = path;
+    Ok(())
+}
+
+/// Enable or disable the on-disk parse cache shared between processes
+///
+/// Parse results are stored under `path` (created if missing) and reused
+/// by every process that configures the same directory, including through
+/// the `FIASTO_PY_CACHE_DIR` environment variable read at import. Entries
+/// are keyed by the formula, the package version and the fiasto parser
+/// version, so upgrades of either never read stale results. `None`
+/// disables the disk cache.
+#[pyfunction]
+#[pyo3(signature = (path = None))]
+pub fn configure_disk_cache(path: Option<PathBuf>) -> PyResult<()> {
+    set_directory(path).map_err(|e| PyOSError::new_err(e.to_string()))
+}
+
+/// The directory of the disk cache, or `None` when it is disabled
+#[pyfunction]
+pub fn disk_cache_path() -> Option<PathBuf> {
+    directory().clone()
+}
+
+/// Delete all entries from the disk cache directory
+///
+/// Returns the number of entries removed. Processes reading an entry while
+/// it is removed keep their mapping.
+#[pyfunction]
+pub fn disk_cache_clear() -> PyResult<usize> {
+    let Some(directory) = directory().clone() else {
+        return Ok(0);
+    };
+    let mut removed = 0;
+    for entry in fs::read_dir(&directory).map_err(|e| PyOSError::new_err(e.to_string()))? {
+        let path = entry.map_err(|e| PyOSError::new_err(e.to_string()))?.path();
+        if path.extension().is_some_and(|extension| extension == EXTENSION) && fs::remove_file(&path).is_ok() {
+            removed += 1;
+        }
+    }
+    Ok(removed)
+}
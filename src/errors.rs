@@ -0,0 +1,311 @@
+//! The `FormulaError` exceptions raised for formulas that fail to lex or parse.
+//!
+//! `FormulaError` subclasses `ValueError`, with `FormulaLexError` and
+//! `FormulaParseError` below it. Raising one stores only the formula and
+//! fiasto's reason: the message is formatted when `str()` is called, and the
+//! span, offending token and expected tokens are worked out from the
+//! formula's tokens on first access, never from the wording of the reason.
+//! Failing therefore costs little more than succeeding, which matters when
+//! validating in bulk.
+
+use std::sync::OnceLock;
+
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+
+use crate::stats;
+use crate::tokens::{kind_name, Tokens};
+
+/// Which stage rejected the formula
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub(crate) enum ErrorKind {
+    Lex,
+    Parse,
+}
+
+impl ErrorKind {
+    fn name(self) -> &'static str {
+        match self {
+            ErrorKind::Lex => "lex",
+            ErrorKind::Parse => "parse",
+        }
+    }
+}
+
+/// Where a formula failed and what would have been accepted there
+#[derive(Debug)]
+struct Location {
+    /// Byte range of the offending text in the formula
+    span: Option<(usize, usize)>,
+    /// The offending text
+    token: Option<String>,
+    /// Token kinds that would have been accepted there
+    expected: Vec<String>,
+}
+
+/// How a token kind takes part in the formula grammar
+#[derive(Clone, Copy, PartialEq, Eq)]
+enum Role {
+    Operand,
+    Open,
+    Close,
+    Operator,
+}
+
+fn role(kind: &str) -> Option<Role> {
+    match kind {
+        "ColumnName" | "One" | "Zero" | "Integer" => Some(Role::Operand),
+        "FunctionStart" => Some(Role::Open),
+        "FunctionEnd" => Some(Role::Close),
+        "Tilde" | "Plus" | "Minus" | "InteractionAndEffect" | "InteractionOnly" | "Pipe" | "DoublePipe"
+        | "Comma" => Some(Role::Operator),
+        _ => None,
+    }
+}
+
+const OPERANDS: &[&str] = &["ColumnName", "One", "Zero", "Integer", "FunctionStart"];
+
+/// The operators accepted after an operand at `depth` parentheses, given
+/// whether `~` was already seen and whether the operand can be called
+fn operators_after(depth: usize, tilde: bool, callable: bool) -> Vec<&'static str> {
+    let mut expected = Vec::new();
+    if !tilde && depth == 0 {
+        expected.push("Tilde");
+    }
+    expected.extend(["Plus", "Minus", "InteractionAndEffect", "InteractionOnly"]);
+    if depth > 0 {
+        expected.extend(["Pipe", "DoublePipe", "Comma", "FunctionEnd"]);
+    }
+    if callable {
+        expected.push("FunctionStart");
+    }
+    expected
+}
+
+/// Find the first token that cannot follow the ones before it
+///
+/// Walks the token kinds with the shape of a formula (operands separated by
+/// operators, balanced parentheses, one `~`, `|` and `,` only inside
+/// parentheses) and returns the offending span and what would have been
+/// accepted there; a failure at the end of the formula has an empty span at
+/// its end. Returns `None` for token kinds outside that shape, or when the
+/// tokens have the right shape and fiasto rejected the formula for another
+/// reason.
+fn first_bad_token(formula: &str, tokens: &Tokens) -> Option<((usize, usize), Vec<&'static str>)> {
+    let (mut depth, mut tilde, mut want_operand, mut callable) = (0usize, false, true, false);
+    for (index, &code) in tokens.kinds.iter().enumerate() {
+        let kind = kind_name(code);
+        let span = (tokens.starts[index] as usize, tokens.ends[index] as usize);
+        let role = role(&kind)?;
+        let accepted = match role {
+            Role::Operand => want_operand,
+            Role::Open => want_operand || callable,
+            Role::Close => !want_operand && depth > 0,
+            Role::Operator => match kind.as_str() {
+                // A leading `~` gives a one-sided formula, a leading `-` removes a term
+                "Tilde" => !tilde && depth == 0 && (!want_operand || index == 0),
+                "Minus" => true,
+                "Pipe" | "DoublePipe" | "Comma" => !want_operand && depth > 0,
+                _ => !want_operand,
+            },
+        };
+        if !accepted {
+            let expected = if want_operand {
+                OPERANDS.to_vec()
+            } else {
+                operators_after(depth, tilde, callable)
+            };
+            return Some((span, expected));
+        }
+        callable = kind == "ColumnName";
+        match role {
+            Role::Operand => want_operand = false,
+            Role::Open => {
+                depth += 1;
+                want_operand = true;
+            }
+            Role::Close => depth -= 1,
+            Role::Operator => {
+                tilde |= kind == "Tilde";
+                want_operand = true;
+            }
+        }
+    }
+    let end = (formula.len(), formula.len());
+    if want_operand {
+        Some((end, OPERANDS.to_vec()))
+    } else if depth > 0 {
+        Some((end, vec!["FunctionEnd"]))
+    } else {
+        None
+    }
+}
+
+/// The span of the character at which lexing first fails
+///
+/// Lexes growing prefixes of the formula (by bisection over character
+/// boundaries) to find the shortest one that fiasto rejects; its last
+/// character is the one the lexer could not read.
+fn first_bad_character(formula: &str) -> Option<(usize, usize)> {
+    let ends: Vec<usize> = formula.char_indices().map(|(i, c)| i + c.len_utf8()).collect();
+    let bad = ends.partition_point(|&end| fiasto::lex_formula(&formula[..end]).is_ok());
+    let end = *ends.get(bad)?;
+    let start = formula[..end].char_indices().next_back()?.0;
+    Some((start, end))
+}
+
+/// Locate the failure of `formula` from its tokens, not from fiasto's message
+fn locate(formula: &str) -> Location {
+    let (span, expected) = match fiasto::lex_formula(formula)
+        .map_err(|e| e.to_string())
+        .and_then(|lexed| Tokens::from_lexed(formula, &lexed))
+    {
+        Ok(tokens) => match first_bad_token(formula, &tokens) {
+            Some((span, expected)) => (Some(span), expected.into_iter().map(str::to_owned).collect()),
+            None => (None, Vec::new()),
+        },
+        Err(_) => (first_bad_character(formula), Vec::new()),
+    };
+    Location {
+        token: span
+            .filter(|(start, end)| end > start)
+            .map(|(start, end)| formula[start..end].to_owned()),
+        span,
+        expected,
+    }
+}
+
+/// Lex and parse `formula`, dropping the result without converting or caching it
+///
+/// fiasto only exposes a parse that builds its full result, so this still
+/// builds (and drops) the `serde_json::Value`; it is timed separately from
+/// `PARSE` so validation does not skew the parse statistics.
+pub(crate) fn check(formula: &str) -> Result<(), String> {
+    stats::VALIDATE
+        .time(|| fiasto::parse_formula(formula))
+        .map(drop)
+        .map_err(|e| e.to_string())
+}
+
+/// Base class of the errors raised for invalid formulas; a `ValueError`
+///
+/// `formula` is the formula, `reason` fiasto's description of the problem
+/// and `kind` the stage that failed (`"lex"` or `"parse"`). `span` and
+/// `char_span` are the `(start, end)` byte and character offsets of the
+/// offending text, `token` is that text, and `expected` lists the token
+/// kinds (as in `token_kinds()`) that would have been accepted there. They
+/// are found by re-lexing the formula: the first character the lexer
+/// rejects, or the first token that cannot follow the ones before it. Each
+/// is `None` (or empty) when the tokens do not pin down the failure.
+#[pyclass(extends = PyValueError, subclass, frozen, module = "fiasto_py")]
+pub struct FormulaError {
+    formula: String,
+    reason: String,
+    kind: ErrorKind,
+    location: OnceLock<Location>,
+}
+
+impl FormulaError {
+    fn with_kind(formula: String, reason: String, kind: ErrorKind) -> Self {
+        FormulaError {
+            formula,
+            reason,
+            kind,
+            location: OnceLock::new(),
+        }
+    }
+
+    fn location(&self) -> &Location {
+        self.location
+            .get_or_init(|| locate(&self.formula))
+    }
+}
+
+#[pymethods]
+impl FormulaError {
+    #[new]
+    #[pyo3(signature = (formula, reason, kind = "parse"))]
+    fn new(formula: String, reason: String, kind: &str) -> PyResult<Self> {
+        let kind = match kind {
+            "lex" => ErrorKind::Lex,
+            "parse" => ErrorKind::Parse,
+            other => {
+                return Err(PyValueError::new_err(format!(
+                    "kind must be 'lex' or 'parse', not {:?}",
+                    other
+                )))
+            }
+        };
+        Ok(FormulaError::with_kind(formula, reason, kind))
+    }
+
+    #[getter]
+    fn formula(&self) -> &str {
+        &self.formula
+    }
+
+    #[getter]
+    fn reason(&self) -> &str {
+        &self.reason
+    }
+
+    #[getter]
+    fn kind(&self) -> &'static str {
+        self.kind.name()
+    }
+
+    #[getter]
+    fn span(&self) -> Option<(usize, usize)> {
+        self.location().span
+    }
+
+    #[getter]
+    fn char_span(&self) -> Option<(usize, usize)> {
+        let (start, end) = self.location().span?;
+        let start_chars = self.formula[..start].chars().count();
+        Some((start_chars, start_chars + self.formula[start..end].chars().count()))
+    }
+
+    #[getter]
+    fn token(&self) -> Option<String> {
+        self.location().token.clone()
+    }
+
+    #[getter]
+    fn expected(&self) -> Vec<String> {
+        self.location().expected.clone()
+    }
+
+    fn __str__(&self) -> String {
+        match self.kind {
+            ErrorKind::Lex => format!("Formula lexing error: {}", self.reason),
+            ErrorKind::Parse => format!("Formula parsing error: {}", self.reason),
+        }
+    }
+}
+
+/// Raised when a formula fails to tokenize
+#[pyclass(extends = FormulaError, frozen, module = "fiasto_py")]
+pub struct FormulaLexError;
+
+#[pymethods]
+impl FormulaLexError {
+    #[new]
+    fn new(formula: String, reason: String) -> PyClassInitializer<Self> {
+        PyClassInitializer::from(FormulaError::with_kind(formula, reason, ErrorKind::Lex))
+            .add_subclass(FormulaLexError)
+    }
+}
+
+/// Raised when a formula fails to parse
+#[pyclass(extends = FormulaError, frozen, module = "fiasto_py")]
+pub struct FormulaParseError;
+
+#[pymethods]
+impl FormulaParseError {
+    #[new]
+    fn new(formula: String, reason: String) -> PyClassInitializer<Self> {
+        PyClassInitializer::from(FormulaError::with_kind(formula, reason, ErrorKind::Parse))
+            .add_subclass(FormulaParseError)
+    }
+}
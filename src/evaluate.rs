@@ -0,0 +1,190 @@
+//! Fused evaluation of a formula's transformation terms into caller-owned buffers.
+//!
+//! Every column generated by a transformation (`log(x)`, `poly(x, 3)`,
+//! `s(z)`, `scale(z)`, ...) is written straight into one output array. Work is split
+//! into row blocks, each computing all generated columns while its input
+//! rows are in cache, or into whole columns; either way blocks can run on
+//! the rayon pool with the GIL released.
+
+use std::collections::HashSet;
+
+use numpy::ndarray::{ArrayViewMut1, ArrayViewMut2, Axis};
+use numpy::{PyArray2, PyArrayMethods, PyReadwriteArray2, PyUntypedArrayMethods};
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+use rayon::prelude::*;
+use serde_json::Value;
+
+use crate::data::InputColumns;
+use crate::design::{fill_term, transformation_columns, ColumnSet, FittedState, Plan, Term, PARALLEL_THRESHOLD};
+use crate::matrix::state_from_python;
+use crate::parsed::{columns_in_order, formula_value};
+use crate::stats;
+
+/// Rows per block when splitting by rows
+const BLOCK_ROWS: usize = 4096;
+
+/// How the work is split across threads
+#[derive(Clone, Copy, PartialEq)]
+enum Split {
+    Serial,
+    Rows,
+    Columns,
+}
+
+/// A plan with one term per generated transformation column, in formula order
+fn transformation_plan(value: &Value) -> Plan {
+    let mut seen = HashSet::new();
+    let mut plan = Plan {
+        response: Vec::new(),
+        response_terms: Vec::new(),
+        names: Vec::new(),
+        terms: Vec::new(),
+    };
+    for (name, info) in columns_in_order(value) {
+        for transformation in info["transformations"].as_array().into_iter().flatten() {
+            for (_, column, term) in transformation_columns(name, transformation) {
+                if seen.insert(column.clone()) {
+                    plan.names.push(column);
+                    plan.terms.push(term);
+                }
+            }
+        }
+    }
+    plan
+}
+
+/// Write one term for `rows` into a column view, through a scratch buffer if it is strided
+fn fill_column(
+    term: &Term,
+    state: &FittedState,
+    columns: &ColumnSet,
+    rows: std::ops::Range<usize>,
+    mut column: ArrayViewMut1<f64>,
+    scratch: &mut Vec<f64>,
+) -> Result<(), String> {
+    if let Some(out) = column.as_slice_mut() {
+        return fill_term(term, state, columns, rows, out);
+    }
+    scratch.resize(rows.len(), 0.0);
+    fill_term(term, state, columns, rows, scratch)?;
+    column.iter_mut().zip(scratch.iter()).for_each(|(o, s)| *o = *s);
+    Ok(())
+}
+
+/// Write every term into `out` (rows x terms), in any memory layout
+fn fill_view(
+    terms: &[Term],
+    state: &FittedState,
+    columns: &ColumnSet,
+    mut out: ArrayViewMut2<f64>,
+    split: Split,
+) -> Result<(), String> {
+    let nrows = out.nrows();
+    match split {
+        Split::Columns => out
+            .axis_iter_mut(Axis(1))
+            .collect::<Vec<_>>()
+            .into_par_iter()
+            .zip(terms)
+            .try_for_each_init(Vec::new, |scratch, (column, term)| {
+                fill_column(term, state, columns, 0..nrows, column, scratch)
+            }),
+        Split::Rows | Split::Serial => {
+            let fill_block = |scratch: &mut Vec<f64>, (block, mut view): (usize, ArrayViewMut2<f64>)| {
+                let start = block * BLOCK_ROWS;
+                let rows = start..start + view.nrows();
+                terms.iter().zip(view.axis_iter_mut(Axis(1))).try_for_each(|(term, column)| {
+                    fill_column(term, state, columns, rows.clone(), column, scratch)
+                })
+            };
+            let blocks = out.axis_chunks_iter_mut(Axis(0), BLOCK_ROWS).enumerate();
+            if split == Split::Rows {
+                blocks
+                    .collect::<Vec<_>>()
+                    .into_par_iter()
+                    .try_for_each_init(Vec::new, fill_block)
+            } else {
+                let mut scratch = Vec::new();
+                blocks.into_iter().try_for_each(|block| fill_block(&mut scratch, block))
+            }
+        }
+    }
+}
+
+/// Evaluate every transformation-generated column into one float64 matrix
+///
+/// `data` is a mapping of 1-D columns (NumPy arrays or any buffer NumPy can
+/// view as float64; contiguous float64 inputs are not copied) or an Arrow
+/// object. The columns listed in each transformation's `generates_columns`
+/// (a spline smooth such as `s(z)` stands for its basis columns `z_s_1`,
+/// `z_s_2`, ...) are written, in formula order, into `out` when given: a
+/// writable float64 array of shape `(rows, columns)` in any memory layout.
+/// Otherwise a new Fortran-ordered array is allocated. `parallel` splits the
+/// work across threads by row block (`"rows"`), by column (`"columns"`), by
+/// whichever suits the layout of `out` (`"auto"`), or not at all (`None`).
+/// Returns the array and the generated column names.
+#[pyfunction]
+#[pyo3(signature = (formula, data, out = None, state = None, parallel = Some("auto")))]
+pub fn evaluate_transformations<'py>(
+    py: Python<'py>,
+    formula: &Bound<'py, PyAny>,
+    data: &Bound<'py, PyAny>,
+    out: Option<Bound<'py, PyArray2<f64>>>,
+    state: Option<&Bound<'py, PyAny>>,
+    parallel: Option<&str>,
+) -> PyResult<(Bound<'py, PyArray2<f64>>, Vec<String>)> {
+    let value = formula_value(formula)?;
+    let plan = transformation_plan(&value);
+    let inputs = InputColumns::extract(data, &plan.required_columns(), &[])?;
+    let columns = inputs.column_set()?;
+    let nrows = columns.nrows();
+    let shape = (nrows, plan.terms.len());
+
+    let out = match out {
+        Some(out) => {
+            if out.shape() != [shape.0, shape.1] {
+                return Err(PyValueError::new_err(format!(
+                    "out has shape {:?}, expected ({}, {})",
+                    out.shape(),
+                    shape.0,
+                    shape.1
+                )));
+            }
+            out
+        }
+        // Every element is written below before the array is returned
+        None => unsafe { PyArray2::<f64>::new_bound(py, [shape.0, shape.1], true) },
+    };
+    let mut writable: PyReadwriteArray2<f64> = out.try_readwrite()?;
+    let view = writable.as_array_mut();
+
+    let split = match parallel {
+        None => Split::Serial,
+        Some("rows") => Split::Rows,
+        Some("columns") => Split::Columns,
+        Some("auto") if view.is_standard_layout() => Split::Rows,
+        Some("auto") => Split::Columns,
+        Some(other) => {
+            return Err(PyValueError::new_err(format!(
+                "parallel must be 'auto', 'rows', 'columns' or None, not {:?}",
+                other
+            )))
+        }
+    };
+    // Small inputs finish faster than the threads start
+    let split = if nrows * plan.terms.len() < PARALLEL_THRESHOLD {
+        Split::Serial
+    } else {
+        split
+    };
+
+    let state = match state {
+        Some(state) => state_from_python(state)?,
+        None => py.allow_threads(|| plan.fit(&columns)).map_err(PyValueError::new_err)?,
+    };
+    py.allow_threads(|| stats::EVALUATE.time(|| fill_view(&plan.terms, &state, &columns, view, split)))
+        .map_err(PyValueError::new_err)?;
+    drop(writable);
+    Ok((out, plan.names))
+}
@@ -0,0 +1,321 @@
+//! Incremental re-parsing for editors: apply a text edit to a previous result.
+//!
+//! Only the tokens around the edit are lexed again; the rest of the token
+//! stream is reused with shifted offsets. When the edit leaves the token
+//! sequence unchanged (whitespace), the previous parse result is reused as
+//! well. Otherwise the formula is parsed again, since fiasto resolves
+//! column ids and generated names across the whole formula; the result
+//! comes with a diff of the columns and terms that changed.
+
+use std::sync::Arc;
+
+use pyo3::exceptions::PyIndexError;
+use pyo3::prelude::*;
+use serde_json::Value;
+
+use crate::cache;
+use crate::parsed::ParsedFormula;
+use crate::tokens::{lex_tokens, TokenStream, Tokens};
+
+/// A formula with its tokens and parse result, which may be invalid mid-edit
+#[pyclass(frozen, module = "fiasto_py")]
+pub struct IncrementalFormula {
+    formula: String,
+    tokens: Option<Tokens>,
+    value: Option<Arc<Value>>,
+    error: Option<String>,
+}
+
+impl IncrementalFormula {
+    fn build(formula: String, tokens: Result<Tokens, String>, value: Result<Arc<Value>, String>) -> Self {
+        let (tokens, lex_error) = match tokens {
+            Ok(tokens) => (Some(tokens), None),
+            Err(e) => (None, Some(format!("Formula lexing error: {}", e))),
+        };
+        let (value, parse_error) = match value {
+            Ok(value) => (Some(value), None),
+            Err(e) => (None, Some(format!("Formula parsing error: {}", e))),
+        };
+        IncrementalFormula {
+            formula,
+            tokens,
+            value,
+            error: lex_error.or(parse_error),
+        }
+    }
+
+    fn from_formula(formula: String) -> Self {
+        let tokens = lex_tokens(&formula);
+        let value = cache::parse_cached(&formula);
+        IncrementalFormula::build(formula, tokens, value)
+    }
+
+    /// `(kind, lexeme)` of every token, for comparing token sequences
+    fn lexemes<'a>(formula: &'a str, tokens: &Tokens) -> Vec<(u8, &'a str)> {
+        (0..tokens.kinds.len())
+            .map(|i| (tokens.kinds[i], &formula[tokens.starts[i] as usize..tokens.ends[i] as usize]))
+            .collect()
+    }
+}
+
+/// Convert a code point index into a byte offset of `text`
+fn byte_offset(text: &str, index: usize) -> PyResult<usize> {
+    text.char_indices()
+        .map(|(offset, _)| offset)
+        .chain(std::iter::once(text.len()))
+        .nth(index)
+        .ok_or_else(|| PyIndexError::new_err(format!("offset {} is past the end of the formula", index)))
+}
+
+/// Re-lex the tokens of `old` that overlap the edit of bytes `start..old_end`
+///
+/// Returns the new token stream and the range of token indices in it that
+/// were lexed again. Falls back to lexing the whole formula if the window
+/// cannot be lexed on its own.
+fn relex(
+    old: &Tokens,
+    new_formula: &str,
+    start: usize,
+    old_end: usize,
+    delta: i64,
+) -> Result<(Tokens, (usize, usize)), String> {
+    let count = old.kinds.len();
+    // One token of context on each side, so tokens that merge or split at
+    // the edges of the edit are lexed together
+    let first = old.ends.partition_point(|&end| (end as usize) < start).saturating_sub(1);
+    let last = (old.starts.partition_point(|&s| (s as usize) <= old_end) + 1).min(count);
+    let window_start = old.starts.get(first).map_or(start, |&s| (s as usize).min(start));
+    let old_window_end = if last > first {
+        (old.ends[last - 1] as usize).max(old_end)
+    } else {
+        old_end
+    };
+    let window_end = (old_window_end as i64 + delta) as usize;
+
+    let window = match new_formula
+        .get(window_start..window_end)
+        .ok_or_else(String::new)
+        .and_then(lex_tokens)
+    {
+        Ok(window) => window,
+        Err(_) => {
+            let tokens = lex_tokens(new_formula)?;
+            let count = tokens.kinds.len();
+            return Ok((tokens, (0, count)));
+        }
+    };
+
+    let shift = |offset: u32| (offset as i64 + delta) as u32;
+    let mut tokens = Tokens {
+        kinds: old.kinds[..first].to_vec(),
+        starts: old.starts[..first].to_vec(),
+        ends: old.ends[..first].to_vec(),
+    };
+    tokens.kinds.extend(&window.kinds);
+    tokens.starts.extend(window.starts.iter().map(|s| s + window_start as u32));
+    tokens.ends.extend(window.ends.iter().map(|e| e + window_start as u32));
+    tokens.kinds.extend(&old.kinds[last..]);
+    tokens.starts.extend(old.starts[last..].iter().map(|&s| shift(s)));
+    tokens.ends.extend(old.ends[last..].iter().map(|&e| shift(e)));
+    Ok((tokens, (first, first + window.kinds.len())))
+}
+
+/// What changed between two versions of a formula
+#[pyclass(frozen, get_all, module = "fiasto_py")]
+pub struct FormulaDiff {
+    /// Columns present only in the new formula
+    added_columns: Vec<String>,
+    /// Columns present only in the old formula
+    removed_columns: Vec<String>,
+    /// Columns present in both whose roles, interactions or transformations changed
+    changed_columns: Vec<String>,
+    /// Generated columns (terms) present only in the new formula
+    added_terms: Vec<String>,
+    /// Generated columns (terms) present only in the old formula
+    removed_terms: Vec<String>,
+    /// `(first, last)` indices of the tokens that were lexed again
+    token_range: (usize, usize),
+    /// Whether the formula had to be parsed again
+    reparsed: bool,
+}
+
+#[pymethods]
+impl FormulaDiff {
+    /// Whether the parse result is unchanged
+    fn is_empty(&self) -> bool {
+        self.added_columns.is_empty()
+            && self.removed_columns.is_empty()
+            && self.changed_columns.is_empty()
+            && self.added_terms.is_empty()
+            && self.removed_terms.is_empty()
+    }
+
+    fn __repr__(&self) -> String {
+        format!(
+            concat!(
+                "FormulaDiff(added_columns={:?}, removed_columns={:?}, changed_columns={:?}, ",
+                "added_terms={:?}, removed_terms={:?})"
+            ),
+            self.added_columns,
+            self.removed_columns,
+            self.changed_columns,
+            self.added_terms,
+            self.removed_terms
+        )
+    }
+}
+
+/// Names in `a` that are not in `b`, in the order of `a`
+fn missing_from<'a>(a: &[&'a str], b: &[&str]) -> Vec<String> {
+    a.iter().filter(|name| !b.contains(name)).map(|name| (*name).to_owned()).collect()
+}
+
+/// Compare two parse results; a missing result counts as empty
+fn diff(old: Option<&Value>, new: Option<&Value>, token_range: (usize, usize), reparsed: bool) -> FormulaDiff {
+    let columns = |value: Option<&Value>| {
+        value
+            .and_then(|value| value["columns"].as_object())
+            .map(|columns| columns.iter().map(|(name, info)| (name.as_str(), info)).collect::<Vec<_>>())
+            .unwrap_or_default()
+    };
+    let terms = |value: Option<&Value>| {
+        value
+            .and_then(|value| value["all_generated_columns"].as_array())
+            .map(|names| names.iter().filter_map(Value::as_str).collect::<Vec<_>>())
+            .unwrap_or_default()
+    };
+    let (old_columns, new_columns) = (columns(old), columns(new));
+    let old_names: Vec<&str> = old_columns.iter().map(|(name, _)| *name).collect();
+    let new_names: Vec<&str> = new_columns.iter().map(|(name, _)| *name).collect();
+    // Ids renumber when columns are inserted before others; compare the rest
+    let without_id = |info: &Value| {
+        let mut info = info.clone();
+        if let Some(info) = info.as_object_mut() {
+            info.remove("id");
+        }
+        info
+    };
+    let changed_columns = new_columns
+        .iter()
+        .filter_map(|(name, info)| {
+            let (_, old_info) = old_columns.iter().find(|(old_name, _)| old_name == name)?;
+            (without_id(old_info) != without_id(info)).then(|| (*name).to_owned())
+        })
+        .collect();
+    let (old_terms, new_terms) = (terms(old), terms(new));
+    FormulaDiff {
+        added_columns: missing_from(&new_names, &old_names),
+        removed_columns: missing_from(&old_names, &new_names),
+        changed_columns,
+        added_terms: missing_from(&new_terms, &old_terms),
+        removed_terms: missing_from(&old_terms, &new_terms),
+        token_range,
+        reparsed,
+    }
+}
+
+#[pymethods]
+impl IncrementalFormula {
+    /// The current formula text
+    #[getter]
+    fn formula(&self) -> &str {
+        &self.formula
+    }
+
+    /// Whether the formula currently lexes and parses
+    #[getter]
+    fn is_valid(&self) -> bool {
+        self.error.is_none()
+    }
+
+    /// The lexing or parsing error message, or `None` when valid
+    #[getter]
+    fn error(&self) -> Option<&str> {
+        self.error.as_deref()
+    }
+
+    /// The parse result, or `None` when the formula does not parse
+    #[getter]
+    fn parsed(&self) -> Option<ParsedFormula> {
+        self.value.as_ref().map(|value| ParsedFormula::new(Arc::clone(value)))
+    }
+
+    /// The tokens, or `None` when the formula does not lex
+    #[getter]
+    fn tokens(&self, py: Python) -> PyResult<Option<TokenStream>> {
+        self.tokens
+            .as_ref()
+            .map(|tokens| TokenStream::new(py, self.formula.clone(), tokens))
+            .transpose()
+    }
+
+    /// Replace `deleted` characters at `offset` with `inserted`
+    ///
+    /// Offsets count characters, like Python string indices. Returns the
+    /// updated `IncrementalFormula` and a `FormulaDiff` against this one,
+    /// which is left unchanged.
+    #[pyo3(signature = (offset, deleted, inserted = ""))]
+    fn edit(
+        &self,
+        py: Python,
+        offset: usize,
+        deleted: usize,
+        inserted: &str,
+    ) -> PyResult<(IncrementalFormula, FormulaDiff)> {
+        let start = byte_offset(&self.formula, offset)?;
+        let old_end = start + byte_offset(&self.formula[start..], deleted)?;
+        let mut formula = String::with_capacity(self.formula.len() - (old_end - start) + inserted.len());
+        formula.push_str(&self.formula[..start]);
+        formula.push_str(inserted);
+        formula.push_str(&self.formula[old_end..]);
+        let delta = inserted.len() as i64 - (old_end - start) as i64;
+
+        Ok(py.allow_threads(|| {
+            let Some(old_tokens) = &self.tokens else {
+                let updated = IncrementalFormula::from_formula(formula);
+                let count = updated.tokens.as_ref().map_or(0, |tokens| tokens.kinds.len());
+                let diff = diff(self.value.as_deref(), updated.value.as_deref(), (0, count), true);
+                return (updated, diff);
+            };
+            let (tokens, token_range) = match relex(old_tokens, &formula, start, old_end, delta) {
+                Ok(relexed) => relexed,
+                Err(e) => {
+                    let value = cache::parse_cached(&formula);
+                    let diff = diff(self.value.as_deref(), value.as_deref().ok(), (0, 0), true);
+                    return (IncrementalFormula::build(formula, Err(e), value), diff);
+                }
+            };
+
+            // Same tokens: only whitespace changed, so the parse result carries over
+            let unchanged = self.value.is_some()
+                && IncrementalFormula::lexemes(&self.formula, old_tokens)
+                    == IncrementalFormula::lexemes(&formula, &tokens);
+            let value = match (&self.value, unchanged) {
+                (Some(previous), true) => {
+                    let mut value = (**previous).clone();
+                    value["formula"] = Value::from(formula.as_str());
+                    Ok(Arc::new(value))
+                }
+                _ => cache::parse_cached(&formula),
+            };
+            let diff = diff(self.value.as_deref(), value.as_deref().ok(), token_range, !unchanged);
+            (IncrementalFormula::build(formula, Ok(tokens), value), diff)
+        }))
+    }
+
+    fn __repr__(&self) -> String {
+        match &self.error {
+            None => format!("IncrementalFormula({:?})", self.formula),
+            Some(_) => format!("IncrementalFormula({:?}, valid=False)", self.formula),
+        }
+    }
+}
+
+/// Start an incremental editing session on `formula`
+///
+/// Never raises for an invalid formula: check `is_valid` and `error`, then
+/// keep calling `edit` as the text changes.
+#[pyfunction]
+pub fn parse_incremental(py: Python, formula: String) -> IncrementalFormula {
+    py.allow_threads(|| IncrementalFormula::from_formula(formula))
+}
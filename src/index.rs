@@ -0,0 +1,624 @@
+//! Inverted index over a set of formulas for fast structural queries.
+//!
+//! Every formula is parsed once and reduced to the keys it contains: its
+//! columns, each column's roles, the transformations applied, the
+//! interactions and their order, and the random intercepts and slopes per
+//! grouping variable. Each key maps to the sorted ids of the formulas that
+//! contain it, so a query is a merge of sorted id lists and never touches
+//! the formulas themselves. Formula ids are assigned in insertion order and
+//! are never reused.
+
+use std::collections::{HashMap, HashSet};
+use std::path::PathBuf;
+use std::sync::{RwLock, RwLockReadGuard, RwLockWriteGuard};
+
+use pyo3::exceptions::{PyIndexError, PyOSError, PyValueError};
+use pyo3::prelude::*;
+use pyo3::types::{PyBytes, PyType};
+use serde_json::Value;
+
+use crate::batch::run_batch;
+use crate::binary::{write_varint, Reader};
+use crate::parsed::{columns_in_order, is_fixed_effect, str_list};
+use crate::{cache, parse_error};
+
+const MAGIC: &[u8; 4] = b"FIAX";
+
+/// Bump when the layout changes; `decode` rejects versions it does not know
+const FORMAT_VERSION: u8 = 1;
+
+/// One indexed property of a formula; `None` fields match any value
+#[derive(Clone, Debug, PartialEq, Eq, Hash)]
+enum Key {
+    Column(String),
+    Role { column: String, role: String },
+    Transformation { function: String, column: Option<String> },
+    Interaction { order: Option<u32>, column: Option<String> },
+    RandomIntercept { group: String },
+    RandomSlope { group: String, variable: Option<String> },
+}
+
+/// Every key of a parse result, including the any-value variants
+fn keys_of(value: &Value) -> HashSet<Key> {
+    let mut keys = HashSet::new();
+    for (name, info) in columns_in_order(value) {
+        keys.insert(Key::Column(name.to_owned()));
+        let mut roles = str_list(&info["roles"]);
+        // Plain predictors are fixed effects whatever fiasto calls their role
+        if is_fixed_effect(info) {
+            roles.push("FixedEffect");
+        }
+        for role in roles {
+            keys.insert(Key::Role {
+                column: name.to_owned(),
+                role: role.to_owned(),
+            });
+        }
+        for transformation in info["transformations"].as_array().into_iter().flatten() {
+            let function = transformation["function"].as_str().unwrap_or_default();
+            for column in [None, Some(name.to_owned())] {
+                keys.insert(Key::Transformation {
+                    function: function.to_owned(),
+                    column,
+                });
+            }
+        }
+        for interaction in info["interactions"].as_array().into_iter().flatten() {
+            let mut members = vec![name];
+            members.extend(str_list(&interaction["with"]));
+            let order = members.len() as u32;
+            for order in [None, Some(order)] {
+                keys.insert(Key::Interaction { order, column: None });
+                for member in &members {
+                    keys.insert(Key::Interaction {
+                        order,
+                        column: Some((*member).to_owned()),
+                    });
+                }
+            }
+        }
+        for effect in info["random_effects"].as_array().into_iter().flatten() {
+            let Some(group) = effect["grouping_variable"].as_str() else {
+                continue;
+            };
+            if effect["has_intercept"].as_bool().unwrap_or(true) {
+                keys.insert(Key::RandomIntercept { group: group.to_owned() });
+            }
+            for variable in str_list(&effect["variables"]) {
+                for variable in [None, Some(variable.to_owned())] {
+                    keys.insert(Key::RandomSlope {
+                        group: group.to_owned(),
+                        variable,
+                    });
+                }
+            }
+        }
+    }
+    keys
+}
+
+/// Parse formulas (through the cache) with the GIL released and collect their keys
+fn parse_keys(py: Python, formulas: &[String], parallel: bool) -> Vec<Result<HashSet<Key>, String>> {
+    run_batch(py, formulas, parallel, |formula| {
+        cache::parse_cached(formula).map(|value| keys_of(&value))
+    })
+}
+
+/// Sorted ids in both lists
+fn intersect(a: &[u32], b: &[u32]) -> Vec<u32> {
+    let (mut i, mut j, mut out) = (0, 0, Vec::with_capacity(a.len().min(b.len())));
+    while i < a.len() && j < b.len() {
+        match a[i].cmp(&b[j]) {
+            std::cmp::Ordering::Less => i += 1,
+            std::cmp::Ordering::Greater => j += 1,
+            std::cmp::Ordering::Equal => {
+                out.push(a[i]);
+                i += 1;
+                j += 1;
+            }
+        }
+    }
+    out
+}
+
+/// Sorted ids in either list
+fn union(a: &[u32], b: &[u32]) -> Vec<u32> {
+    let (mut i, mut j, mut out) = (0, 0, Vec::with_capacity(a.len() + b.len()));
+    while i < a.len() && j < b.len() {
+        match a[i].cmp(&b[j]) {
+            std::cmp::Ordering::Less => {
+                out.push(a[i]);
+                i += 1;
+            }
+            std::cmp::Ordering::Greater => {
+                out.push(b[j]);
+                j += 1;
+            }
+            std::cmp::Ordering::Equal => {
+                out.push(a[i]);
+                i += 1;
+                j += 1;
+            }
+        }
+    }
+    out.extend_from_slice(&a[i..]);
+    out.extend_from_slice(&b[j..]);
+    out
+}
+
+/// Sorted ids in `a` but not in `b`
+fn difference(a: &[u32], b: &[u32]) -> Vec<u32> {
+    let mut j = 0;
+    a.iter()
+        .copied()
+        .filter(|id| {
+            while j < b.len() && b[j] < *id {
+                j += 1;
+            }
+            j == b.len() || b[j] != *id
+        })
+        .collect()
+}
+
+/// A boolean query tree
+#[derive(Clone, Debug)]
+enum Expr {
+    Key(Key),
+    And(Box<Expr>, Box<Expr>),
+    Or(Box<Expr>, Box<Expr>),
+    Not(Box<Expr>),
+}
+
+/// The indexed formulas and their posting lists
+#[derive(Default)]
+struct Index {
+    /// Formula by id; `None` once removed
+    formulas: Vec<Option<String>>,
+    live: usize,
+    keys: Vec<Key>,
+    key_ids: HashMap<Key, u32>,
+    /// Sorted formula ids per key id
+    postings: Vec<Vec<u32>>,
+    /// Key ids per formula id, to unindex it on removal
+    formula_keys: Vec<Vec<u32>>,
+}
+
+impl Index {
+    fn key_id(&mut self, key: Key) -> u32 {
+        if let Some(&id) = self.key_ids.get(&key) {
+            return id;
+        }
+        let id = self.keys.len() as u32;
+        self.keys.push(key.clone());
+        self.key_ids.insert(key, id);
+        self.postings.push(Vec::new());
+        id
+    }
+
+    /// Index a formula under its key ids; ids only grow, so postings stay sorted
+    fn insert(&mut self, formula: String, key_ids: Vec<u32>) -> u32 {
+        let id = self.formulas.len() as u32;
+        for &key_id in &key_ids {
+            self.postings[key_id as usize].push(id);
+        }
+        self.formulas.push(Some(formula));
+        self.formula_keys.push(key_ids);
+        self.live += 1;
+        id
+    }
+
+    fn add(&mut self, formula: String, keys: HashSet<Key>) -> u32 {
+        let key_ids = keys.into_iter().map(|key| self.key_id(key)).collect();
+        self.insert(formula, key_ids)
+    }
+
+    fn remove(&mut self, id: u32) -> bool {
+        match self.formulas.get_mut(id as usize) {
+            Some(slot @ Some(_)) => *slot = None,
+            _ => return false,
+        }
+        for key_id in std::mem::take(&mut self.formula_keys[id as usize]) {
+            let posting = &mut self.postings[key_id as usize];
+            if let Ok(position) = posting.binary_search(&id) {
+                posting.remove(position);
+            }
+        }
+        self.live -= 1;
+        true
+    }
+
+    fn all_ids(&self) -> Vec<u32> {
+        (0..self.formulas.len() as u32)
+            .filter(|&id| self.formulas[id as usize].is_some())
+            .collect()
+    }
+
+    fn evaluate(&self, expr: &Expr) -> Vec<u32> {
+        match expr {
+            Expr::Key(key) => self
+                .key_ids
+                .get(key)
+                .map(|&key_id| self.postings[key_id as usize].clone())
+                .unwrap_or_default(),
+            Expr::And(a, b) => match (&**a, &**b) {
+                // `a & ~b` without materializing the complement
+                (a, Expr::Not(b)) | (Expr::Not(b), a) => difference(&self.evaluate(a), &self.evaluate(b)),
+                (a, b) => intersect(&self.evaluate(a), &self.evaluate(b)),
+            },
+            Expr::Or(a, b) => union(&self.evaluate(a), &self.evaluate(b)),
+            Expr::Not(a) => difference(&self.all_ids(), &self.evaluate(a)),
+        }
+    }
+
+    fn encode(&self) -> Vec<u8> {
+        fn write_str(out: &mut Vec<u8>, s: &str) {
+            write_varint(out, s.len() as u64);
+            out.extend_from_slice(s.as_bytes());
+        }
+        fn write_opt(out: &mut Vec<u8>, s: &Option<String>) {
+            match s {
+                None => out.push(0),
+                Some(s) => {
+                    out.push(1);
+                    write_str(out, s);
+                }
+            }
+        }
+
+        let mut out = Vec::new();
+        out.extend_from_slice(MAGIC);
+        out.push(FORMAT_VERSION);
+        write_varint(&mut out, self.keys.len() as u64);
+        for key in &self.keys {
+            match key {
+                Key::Column(column) => {
+                    out.push(0);
+                    write_str(&mut out, column);
+                }
+                Key::Role { column, role } => {
+                    out.push(1);
+                    write_str(&mut out, column);
+                    write_str(&mut out, role);
+                }
+                Key::Transformation { function, column } => {
+                    out.push(2);
+                    write_str(&mut out, function);
+                    write_opt(&mut out, column);
+                }
+                Key::Interaction { order, column } => {
+                    out.push(3);
+                    write_varint(&mut out, order.map_or(0, |order| u64::from(order) + 1));
+                    write_opt(&mut out, column);
+                }
+                Key::RandomIntercept { group } => {
+                    out.push(4);
+                    write_str(&mut out, group);
+                }
+                Key::RandomSlope { group, variable } => {
+                    out.push(5);
+                    write_str(&mut out, group);
+                    write_opt(&mut out, variable);
+                }
+            }
+        }
+        write_varint(&mut out, self.formulas.len() as u64);
+        for (formula, key_ids) in self.formulas.iter().zip(&self.formula_keys) {
+            match formula {
+                None => out.push(0),
+                Some(formula) => {
+                    out.push(1);
+                    write_str(&mut out, formula);
+                    write_varint(&mut out, key_ids.len() as u64);
+                    key_ids.iter().for_each(|&key_id| write_varint(&mut out, u64::from(key_id)));
+                }
+            }
+        }
+        out
+    }
+
+    fn decode(bytes: &[u8]) -> Result<Index, String> {
+        fn read_str(reader: &mut Reader) -> Result<String, String> {
+            let len = reader.len()?;
+            String::from_utf8(reader.take(len)?.to_vec()).map_err(|e| e.to_string())
+        }
+        fn read_opt(reader: &mut Reader) -> Result<Option<String>, String> {
+            match reader.byte()? {
+                0 => Ok(None),
+                _ => read_str(reader).map(Some),
+            }
+        }
+
+        let mut reader = Reader::new(bytes);
+        if reader.take(MAGIC.len()).ok() != Some(MAGIC.as_slice()) {
+            return Err("not a FormulaIndex payload".to_owned());
+        }
+        let version = reader.byte()?;
+        if version != FORMAT_VERSION {
+            return Err(format!(
+                "unsupported index version {} (this build reads version {})",
+                version, FORMAT_VERSION
+            ));
+        }
+        let mut index = Index::default();
+        for _ in 0..reader.len()? {
+            let key = match reader.byte()? {
+                0 => Key::Column(read_str(&mut reader)?),
+                1 => Key::Role {
+                    column: read_str(&mut reader)?,
+                    role: read_str(&mut reader)?,
+                },
+                2 => Key::Transformation {
+                    function: read_str(&mut reader)?,
+                    column: read_opt(&mut reader)?,
+                },
+                3 => Key::Interaction {
+                    order: match reader.varint()? {
+                        0 => None,
+                        n => Some(u32::try_from(n - 1).map_err(|e| e.to_string())?),
+                    },
+                    column: read_opt(&mut reader)?,
+                },
+                4 => Key::RandomIntercept {
+                    group: read_str(&mut reader)?,
+                },
+                5 => Key::RandomSlope {
+                    group: read_str(&mut reader)?,
+                    variable: read_opt(&mut reader)?,
+                },
+                tag => return Err(format!("unknown key tag {}", tag)),
+            };
+            index.key_id(key);
+        }
+        for _ in 0..reader.len()? {
+            if reader.byte()? == 0 {
+                index.formulas.push(None);
+                index.formula_keys.push(Vec::new());
+                continue;
+            }
+            let formula = read_str(&mut reader)?;
+            let key_ids = (0..reader.len()?)
+                .map(|_| match reader.varint()? {
+                    key_id if key_id < index.keys.len() as u64 => Ok(key_id as u32),
+                    key_id => Err(format!("key index {} out of range", key_id)),
+                })
+                .collect::<Result<Vec<u32>, String>>()?;
+            index.insert(formula, key_ids);
+        }
+        if !reader.is_done() {
+            return Err("trailing bytes after index".to_owned());
+        }
+        Ok(index)
+    }
+}
+
+/// A structural query for `FormulaIndex.search`, combined with `&`, `|`, `~` and `-`
+///
+/// ```python
+/// from fiasto_py import IndexQuery as Q
+/// Q.column("price", role="FixedEffect") & Q.random_slope("store") & ~Q.transformation("log")
+/// ```
+#[pyclass(frozen, module = "fiasto_py")]
+#[derive(Clone)]
+pub struct IndexQuery {
+    expr: Expr,
+}
+
+impl IndexQuery {
+    fn key(key: Key) -> Self {
+        IndexQuery { expr: Expr::Key(key) }
+    }
+}
+
+#[pymethods]
+impl IndexQuery {
+    /// Formulas using `name`, optionally only in `role` (e.g. `"Response"`,
+    /// `"FixedEffect"`, `"GroupingVariable"`)
+    #[staticmethod]
+    #[pyo3(signature = (name, role = None))]
+    fn column(name: String, role: Option<String>) -> Self {
+        match role {
+            None => IndexQuery::key(Key::Column(name)),
+            Some(role) => IndexQuery::key(Key::Role { column: name, role }),
+        }
+    }
+
+    /// Formulas applying `function` (e.g. `"log"`, `"poly"`), optionally to `column`
+    #[staticmethod]
+    #[pyo3(signature = (function, column = None))]
+    fn transformation(function: String, column: Option<String>) -> Self {
+        IndexQuery::key(Key::Transformation { function, column })
+    }
+
+    /// Formulas with an interaction, optionally of exactly `order` terms and involving `column`
+    #[staticmethod]
+    #[pyo3(signature = (order = None, column = None))]
+    fn interaction(order: Option<u32>, column: Option<String>) -> Self {
+        IndexQuery::key(Key::Interaction { order, column })
+    }
+
+    /// Formulas with a random intercept for grouping variable `group`
+    #[staticmethod]
+    fn random_intercept(group: String) -> Self {
+        IndexQuery::key(Key::RandomIntercept { group })
+    }
+
+    /// Formulas with a random slope within `group`, optionally on `variable`
+    #[staticmethod]
+    #[pyo3(signature = (group, variable = None))]
+    fn random_slope(group: String, variable: Option<String>) -> Self {
+        IndexQuery::key(Key::RandomSlope { group, variable })
+    }
+
+    fn __and__(&self, other: &IndexQuery) -> Self {
+        IndexQuery {
+            expr: Expr::And(Box::new(self.expr.clone()), Box::new(other.expr.clone())),
+        }
+    }
+
+    fn __or__(&self, other: &IndexQuery) -> Self {
+        IndexQuery {
+            expr: Expr::Or(Box::new(self.expr.clone()), Box::new(other.expr.clone())),
+        }
+    }
+
+    fn __sub__(&self, other: &IndexQuery) -> Self {
+        self.__and__(&other.__invert__())
+    }
+
+    fn __invert__(&self) -> Self {
+        IndexQuery {
+            expr: Expr::Not(Box::new(self.expr.clone())),
+        }
+    }
+
+    fn __repr__(&self) -> String {
+        format!("IndexQuery({:?})", self.expr)
+    }
+}
+
+/// An inverted index over formulas for queries by column, role,
+/// transformation, interaction and random effect
+///
+/// `FormulaIndex(formulas)` parses the formulas in parallel with the GIL
+/// released and assigns them ids `0, 1, ...` in order. Formulas can be added
+/// and removed later; ids are never reused. The index pickles and can be
+/// saved to and loaded from a file without re-parsing.
+#[pyclass(frozen, module = "fiasto_py")]
+pub struct FormulaIndex {
+    index: RwLock<Index>,
+}
+
+impl FormulaIndex {
+    fn read(&self) -> RwLockReadGuard<'_, Index> {
+        self.index.read().unwrap_or_else(|e| e.into_inner())
+    }
+
+    fn write(&self) -> RwLockWriteGuard<'_, Index> {
+        self.index.write().unwrap_or_else(|e| e.into_inner())
+    }
+}
+
+#[pymethods]
+impl FormulaIndex {
+    /// Raises `FormulaParseError` for the first formula that fails to parse
+    #[new]
+    #[pyo3(signature = (formulas = Vec::new(), parallel = true))]
+    fn new(py: Python, formulas: Vec<String>, parallel: bool) -> PyResult<Self> {
+        let mut index = Index::default();
+        for (formula, keys) in formulas.iter().zip(parse_keys(py, &formulas, parallel)) {
+            let keys = keys.map_err(|e| parse_error(formula, e))?;
+            index.add(formula.clone(), keys);
+        }
+        Ok(FormulaIndex {
+            index: RwLock::new(index),
+        })
+    }
+
+    /// Parse and index one formula, returning its id
+    fn add(&self, py: Python, formula: String) -> PyResult<u32> {
+        let keys = py
+            .allow_threads(|| cache::parse_cached(&formula).map(|value| keys_of(&value)))
+            .map_err(|e| parse_error(&formula, e))?;
+        Ok(self.write().add(formula, keys))
+    }
+
+    /// Parse and index many formulas with the GIL released
+    ///
+    /// Returns the new ids in input order, with `None` in the slot of each
+    /// formula that fails to parse (which is not indexed).
+    #[pyo3(signature = (formulas, parallel = true))]
+    fn add_many(&self, py: Python, formulas: Vec<String>, parallel: bool) -> Vec<Option<u32>> {
+        let results = parse_keys(py, &formulas, parallel);
+        py.allow_threads(|| {
+            let mut index = self.write();
+            formulas
+                .into_iter()
+                .zip(results)
+                .map(|(formula, keys)| keys.ok().map(|keys| index.add(formula, keys)))
+                .collect()
+        })
+    }
+
+    /// Remove a formula from the index; raises `IndexError` for unknown ids
+    fn remove(&self, id: u32) -> PyResult<()> {
+        if self.write().remove(id) {
+            Ok(())
+        } else {
+            Err(PyIndexError::new_err(format!("no formula with id {}", id)))
+        }
+    }
+
+    /// Ids of the formulas matching `query`, in ascending order
+    fn search(&self, py: Python, query: &IndexQuery) -> Vec<u32> {
+        py.allow_threads(|| self.read().evaluate(&query.expr))
+    }
+
+    /// Number of formulas matching `query`
+    fn count(&self, py: Python, query: &IndexQuery) -> usize {
+        self.search(py, query).len()
+    }
+
+    /// Ids of all indexed formulas, in ascending order
+    fn ids(&self) -> Vec<u32> {
+        self.read().all_ids()
+    }
+
+    /// Serialize the index, including its keys, to bytes
+    fn to_bytes<'py>(&self, py: Python<'py>) -> Bound<'py, PyBytes> {
+        let payload = py.allow_threads(|| self.read().encode());
+        PyBytes::new_bound(py, &payload)
+    }
+
+    /// Restore an index from `to_bytes()` output without parsing again
+    #[classmethod]
+    fn from_bytes(_cls: &Bound<PyType>, py: Python, data: &[u8]) -> PyResult<Self> {
+        let index = py.allow_threads(|| Index::decode(data)).map_err(PyValueError::new_err)?;
+        Ok(FormulaIndex {
+            index: RwLock::new(index),
+        })
+    }
+
+    /// Write the index to `path`
+    fn save(&self, py: Python, path: PathBuf) -> PyResult<()> {
+        py.allow_threads(|| std::fs::write(&path, self.read().encode()))
+            .map_err(|e| PyOSError::new_err(e.to_string()))
+    }
+
+    /// Read an index written by `save`
+    #[classmethod]
+    fn load(cls: &Bound<PyType>, py: Python, path: PathBuf) -> PyResult<Self> {
+        let data = py
+            .allow_threads(|| std::fs::read(&path))
+            .map_err(|e| PyOSError::new_err(e.to_string()))?;
+        FormulaIndex::from_bytes(cls, py, &data)
+    }
+
+    fn __reduce__(slf: &Bound<Self>) -> PyResult<(PyObject, (PyObject,))> {
+        let py = slf.py();
+        let restore = slf.get_type().getattr("from_bytes")?.unbind();
+        Ok((restore, (slf.get().to_bytes(py).into_any().unbind(),)))
+    }
+
+    /// The formula with id `id`
+    fn __getitem__(&self, id: u32) -> PyResult<String> {
+        self.read()
+            .formulas
+            .get(id as usize)
+            .cloned()
+            .flatten()
+            .ok_or_else(|| PyIndexError::new_err(format!("no formula with id {}", id)))
+    }
+
+    fn __contains__(&self, id: u32) -> bool {
+        matches!(self.read().formulas.get(id as usize), Some(Some(_)))
+    }
+
+    fn __len__(&self) -> usize {
+        self.read().live
+    }
+
+    fn __repr__(&self) -> String {
+        let index = self.read();
+        format!("FormulaIndex(formulas={}, keys={})", index.live, index.keys.len())
+    }
+}
@@ -1,81 +1,126 @@
 use pyo3::prelude::*;
-use pyo3::types::{PyDict, PyList};
-use serde_json::Value;
+
+mod aio;
+mod batch;
+mod binary;
+mod cache;
+mod canonical;
+mod compiled;
+mod convert;
+mod data;
+mod design;
+mod disk_cache;
+mod errors;
+mod evaluate;
+mod incremental;
+mod index;
+mod matrix;
+mod parsed;
+mod shared;
+mod sparse;
+mod stats;
+mod stream;
+mod tokens;
+mod validate;
+
+use convert::json_value_to_python;
 
 /// Parse a Wilkinson's formula string and return structured JSON metadata as a Python dictionary
 #[pyfunction]
-fn parse_formula(formula: &str) -> PyResult<PyObject> {
-    Python::with_gil(|py| {
-        match fiasto::parse_formula(formula) {
-            Ok(json_value) => {
-                // Convert serde_json::Value to Python object
-                let py_dict = json_value_to_python(py, &json_value)?;
-                Ok(py_dict.into())
-            }
-            Err(e) => Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
-                "Formula parsing error: {}",
-                e
-            ))),
-        }
-    })
+fn parse_formula(py: Python, formula: &str) -> PyResult<PyObject> {
+    match cache::parse_cached(formula) {
+        // Convert serde_json::Value to Python object
+        Ok(json_value) => json_value_to_python(py, &json_value),
+        Err(e) => Err(parse_error(formula, e)),
+    }
 }
 
 /// Tokenize a formula string and return JSON describing each token as a Python dictionary
 #[pyfunction]
-fn lex_formula(formula: &str) -> PyResult<PyObject> {
-    Python::with_gil(|py| {
-        match fiasto::lex_formula(formula) {
-            Ok(json_value) => {
-                // Convert serde_json::Value to Python object
-                let py_dict = json_value_to_python(py, &json_value)?;
-                Ok(py_dict.into())
-            }
-            Err(e) => Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
-                "Formula lexing error: {}",
-                e
-            ))),
-        }
-    })
+fn lex_formula(py: Python, formula: &str) -> PyResult<PyObject> {
+    match tokens::lex_value(formula) {
+        // Convert serde_json::Value to Python object
+        Ok(json_value) => json_value_to_python(py, &json_value),
+        Err(e) => Err(lex_error(formula, e)),
+    }
 }
 
-/// Convert a serde_json::Value to a Python object
-fn json_value_to_python(py: Python, value: &Value) -> PyResult<PyObject> {
-    match value {
-        Value::Null => Ok(py.None()),
-        Value::Bool(b) => Ok(b.into_py(py)),
-        Value::Number(n) => {
-            if let Some(i) = n.as_i64() {
-                Ok(i.into_py(py))
-            } else if let Some(f) = n.as_f64() {
-                Ok(f.into_py(py))
-            } else {
-                Ok(n.to_string().into_py(py))
-            }
-        }
-        Value::String(s) => Ok(s.into_py(py)),
-        Value::Array(arr) => {
-            let py_list = PyList::empty_bound(py);
-            for item in arr {
-                let py_item = json_value_to_python(py, item)?;
-                py_list.append(py_item)?;
-            }
-            Ok(py_list.into())
-        }
-        Value::Object(obj) => {
-            let py_dict = PyDict::new_bound(py);
-            for (key, value) in obj {
-                let py_value = json_value_to_python(py, value)?;
-                py_dict.set_item(key, py_value)?;
-            }
-            Ok(py_dict.into())
-        }
-    }
+/// Build the FormulaParseError raised when a formula fails to parse
+///
+/// The exception object is only created when Python needs it.
+fn parse_error(formula: &str, e: impl std::fmt::Display) -> PyErr {
+    PyErr::new::<errors::FormulaParseError, _>((formula.to_owned(), e.to_string()))
+}
+
+/// Build the FormulaLexError raised when a formula fails to lex
+fn lex_error(formula: &str, e: impl std::fmt::Display) -> PyErr {
+    PyErr::new::<errors::FormulaLexError, _>((formula.to_owned(), e.to_string()))
 }
 
 /// A Python module implemented in Rust.
-#[pymodule]
-fn fiasto_py(_py: Python, m: &Bound<PyModule>) -> PyResult<()> {
+///
+/// All shared state (parse caches, token kinds, instrumentation counters) is
+/// behind Rust locks or atomics, so the module is safe to use without the GIL
+/// on free-threaded CPython builds.
+#[pymodule(gil_used = false)]
+fn fiasto_py(py: Python, m: &Bound<PyModule>) -> PyResult<()> {
+    // Create the shared key objects now rather than on the first call
+    convert::init(py);
+    if let Some(path) = std::env::var_os(disk_cache::ENV_VAR) {
+        // An unusable cache directory must not make the import fail
+        let _ = disk_cache::set_directory(Some(path.into()));
+    }
     m.add_function(wrap_pyfunction!(parse_formula, m)?)?;
     m.add_function(wrap_pyfunction!(lex_formula, m)?)?;
+    m.add_function(wrap_pyfunction!(stats::stats, m)?)?;
+    m.add_function(wrap_pyfunction!(stats::enable_stats, m)?)?;
+    m.add_function(wrap_pyfunction!(stats::reset_stats, m)?)?;
+    m.add_function(wrap_pyfunction!(validate::validate, m)?)?;
+    m.add_function(wrap_pyfunction!(validate::validate_many, m)?)?;
+    m.add_class::<errors::FormulaError>()?;
+    m.add_class::<errors::FormulaLexError>()?;
+    m.add_class::<errors::FormulaParseError>()?;
+    m.add_function(wrap_pyfunction!(batch::parse_formulas, m)?)?;
+    m.add_function(wrap_pyfunction!(batch::lex_formulas, m)?)?;
+    m.add_function(wrap_pyfunction!(aio::aparse_formula, m)?)?;
+    m.add_function(wrap_pyfunction!(aio::aparse_formulas, m)?)?;
+    m.add_function(wrap_pyfunction!(cache::configure_cache, m)?)?;
+    m.add_function(wrap_pyfunction!(cache::cache_info, m)?)?;
+    m.add_function(wrap_pyfunction!(cache::cache_clear, m)?)?;
+    m.add_class::<cache::CacheInfo>()?;
+    m.add_function(wrap_pyfunction!(disk_cache::configure_disk_cache, m)?)?;
+    m.add_function(wrap_pyfunction!(disk_cache::disk_cache_path, m)?)?;
+    m.add_function(wrap_pyfunction!(disk_cache::disk_cache_clear, m)?)?;
+    m.add_function(wrap_pyfunction!(parsed::parse, m)?)?;
+    m.add_class::<parsed::ParsedFormula>()?;
+    m.add_class::<parsed::Column>()?;
+    m.add_function(wrap_pyfunction!(binary::dumps, m)?)?;
+    m.add_function(wrap_pyfunction!(binary::loads, m)?)?;
+    m.add_function(wrap_pyfunction!(tokens::lex, m)?)?;
+    m.add_function(wrap_pyfunction!(tokens::token_kinds, m)?)?;
+    m.add_class::<tokens::TokenStream>()?;
+    m.add_function(wrap_pyfunction!(incremental::parse_incremental, m)?)?;
+    m.add_class::<incremental::IncrementalFormula>()?;
+    m.add_class::<incremental::FormulaDiff>()?;
+    m.add_function(wrap_pyfunction!(matrix::model_matrix, m)?)?;
+    m.add_function(wrap_pyfunction!(matrix::design_matrices, m)?)?;
+    m.add_function(wrap_pyfunction!(matrix::fit_state, m)?)?;
+    m.add_function(wrap_pyfunction!(evaluate::evaluate_transformations, m)?)?;
+    m.add_function(wrap_pyfunction!(stream::iter_model_matrix, m)?)?;
+    m.add_class::<stream::ModelMatrixChunks>()?;
+    m.add_function(wrap_pyfunction!(canonical::canonicalize, m)?)?;
+    m.add_function(wrap_pyfunction!(canonical::formula_hash, m)?)?;
+    m.add_function(wrap_pyfunction!(canonical::canonicalize_formulas, m)?)?;
+    m.add_function(wrap_pyfunction!(canonical::formula_hashes, m)?)?;
+    m.add_function(wrap_pyfunction!(canonical::unique_formulas, m)?)?;
+    m.add_class::<index::FormulaIndex>()?;
+    m.add_class::<index::IndexQuery>()?;
+    m.add_function(wrap_pyfunction!(compiled::compile, m)?)?;
+    m.add_class::<compiled::CompiledFormula>()?;
+    m.add_function(wrap_pyfunction!(sparse::random_effects_matrix, m)?)?;
+    m.add_function(wrap_pyfunction!(sparse::sparse_model_matrix, m)?)?;
+    m.add_class::<sparse::SparseMatrix>()?;
+    m.add_function(wrap_pyfunction!(shared::shared_model_matrices, m)?)?;
+    m.add_class::<shared::SharedModelMatrices>()?;
     Ok(())
 }
@@ -0,0 +1,269 @@
+//! Python entry points that build model matrices from a formula and data.
+
+use std::collections::{HashMap, HashSet};
+
+use numpy::ndarray::{Array2, ShapeBuilder};
+use numpy::IntoPyArray;
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+use pyo3::types::PyDict;
+
+use crate::data::{Factor, InputColumns, Table};
+use crate::design::{ColumnSet, FittedState, Plan};
+use crate::parsed::formula_value;
+
+/// Wrap a column-major buffer as a Fortran-ordered NumPy array without copying
+pub(crate) fn to_numpy(py: Python, values: Vec<f64>, nrows: usize, ncols: usize) -> PyResult<PyObject> {
+    let array = Array2::from_shape_vec((nrows, ncols).f(), values)
+        .map_err(|e| PyValueError::new_err(e.to_string()))?;
+    Ok(array.into_pyarray_bound(py).into_any().unbind())
+}
+
+/// Convert a fitted state to `{"function(column, arguments)": [constants, ...]}`,
+/// with the levels of each categorical column under `"factor(column)"`
+pub(crate) fn state_to_python(py: Python, state: &FittedState) -> PyResult<PyObject> {
+    let mut entries: Vec<_> = state.params.iter().collect();
+    entries.sort_by(|a, b| a.0.cmp(b.0));
+    let py_dict = PyDict::new_bound(py);
+    for (key, params) in entries {
+        py_dict.set_item(key, params)?;
+    }
+    let mut levels: Vec<_> = state.levels.iter().collect();
+    levels.sort_by(|a, b| a.0.cmp(b.0));
+    for (column, labels) in levels {
+        py_dict.set_item(format!("factor({})", column), labels)?;
+    }
+    Ok(py_dict.into())
+}
+
+/// Read a state produced by `state_to_python`
+pub(crate) fn state_from_python(state: &Bound<PyAny>) -> PyResult<FittedState> {
+    let mut fitted = FittedState::default();
+    for (key, value) in state.downcast::<PyDict>()?.iter() {
+        let key: String = key.extract()?;
+        if !key.ends_with(')') || !key.contains('(') {
+            return Err(PyValueError::new_err(format!("invalid state key '{}'", key)));
+        }
+        match key.strip_prefix("factor(").and_then(|rest| rest.strip_suffix(')')) {
+            Some(column) => {
+                let mut labels = Vec::new();
+                for label in value.iter()? {
+                    labels.push(label?.str()?.extract::<String>()?);
+                }
+                fitted.levels.insert(column.to_owned(), labels);
+            }
+            None => {
+                fitted.params.insert(key, value.extract()?);
+            }
+        }
+    }
+    Ok(fitted)
+}
+
+/// Read the categorical columns of `plans` from `table` as factors
+///
+/// Columns wrapped in `factor()`/`c()` are categorical, as are the bare
+/// columns listed in `explicit`, holding non-numeric data, or with levels
+/// in `levels`. When `levels` (a fitted state's) is given, codes index into
+/// those levels and a value not among them raises `ValueError`; otherwise
+/// the levels are the sorted values found in the data.
+pub(crate) fn read_factors(
+    table: &Table,
+    plans: &[&Plan],
+    explicit: &[String],
+    levels: Option<&HashMap<String, Vec<String>>>,
+) -> PyResult<Vec<(String, Factor)>> {
+    let mut factors: Vec<(String, Factor)> = Vec::new();
+    for plan in plans {
+        let mut categorical = HashSet::new();
+        for name in plan.required_columns() {
+            let listed = explicit.iter().any(|column| column == name)
+                || levels.is_some_and(|levels| levels.contains_key(name));
+            if listed || !table.is_numeric(name)? {
+                categorical.insert(name);
+            }
+        }
+        for column in plan.factor_columns(&categorical) {
+            if factors.iter().any(|(existing, _)| existing == column) {
+                continue;
+            }
+            let factor = table.factor(column)?;
+            let factor = match levels {
+                None => factor,
+                Some(levels) => match levels.get(column) {
+                    Some(fitted) => factor.recode(column, fitted)?,
+                    None => {
+                        return Err(PyValueError::new_err(format!(
+                            "the state has no levels for categorical column '{}'",
+                            column
+                        )))
+                    }
+                },
+            };
+            factors.push((column.to_owned(), factor));
+        }
+    }
+    Ok(factors)
+}
+
+/// A plan with its categorical columns expanded, and the data to evaluate it on
+pub(crate) struct Prepared<'py> {
+    pub(crate) plan: Plan,
+    pub(crate) levels: HashMap<String, Vec<String>>,
+    pub(crate) inputs: InputColumns<'py>,
+}
+
+impl Prepared<'_> {
+    /// Learn the constants of the expanded plan, keeping its levels
+    pub(crate) fn fit(&self, py: Python, columns: &ColumnSet) -> PyResult<FittedState> {
+        let mut state = py
+            .allow_threads(|| self.plan.fit(columns))
+            .map_err(PyValueError::new_err)?;
+        state.levels = self.levels.clone();
+        Ok(state)
+    }
+}
+
+/// Read the columns `plan` needs from `data`, expanding its categorical
+/// columns with the given `levels` or with the levels found in `data`
+///
+/// The response columns are required when `response` is true and read if
+/// present otherwise.
+pub(crate) fn prepare<'py>(
+    data: &Bound<'py, PyAny>,
+    plan: &Plan,
+    levels: Option<&HashMap<String, Vec<String>>>,
+    response: bool,
+) -> PyResult<Prepared<'py>> {
+    let table = Table::new(data)?;
+    let factors = read_factors(&table, &[plan], &[], levels)?;
+    let levels: HashMap<String, Vec<String>> = factors
+        .iter()
+        .map(|(column, factor)| (column.clone(), factor.levels.clone()))
+        .collect();
+    let plan = plan.expand(&levels).map_err(PyValueError::new_err)?;
+    let mut required = plan.required_columns();
+    let mut optional = plan.response_columns();
+    if response {
+        required.append(&mut optional);
+    }
+    let mut inputs = table.numeric(&required, &optional)?;
+    for (column, factor) in factors {
+        inputs.add_codes(&column, factor.codes);
+    }
+    Ok(Prepared { plan, levels, inputs })
+}
+
+/// Use the supplied state, or fit one on `columns`
+fn resolve_state(
+    py: Python,
+    prepared: &Prepared,
+    state: Option<FittedState>,
+    columns: &ColumnSet,
+) -> PyResult<FittedState> {
+    match state {
+        Some(state) => Ok(state),
+        None => prepared.fit(py, columns),
+    }
+}
+
+/// Learn the data-dependent constants of a formula's transformations
+///
+/// Returns a dictionary mapping each call, written as in the formula with
+/// its arguments (e.g. `"scale(z)"` or `"poly(x, degree=3)"`), to the
+/// constants used by `scale`, `center`, `poly` and friends, and each
+/// categorical column (e.g. `"factor(g)"`) to its levels. Pass it as
+/// `state=` to evaluate new data with the constants and levels learned here.
+#[pyfunction]
+pub fn fit_state(py: Python, formula: &Bound<PyAny>, data: &Bound<PyAny>) -> PyResult<PyObject> {
+    let value = formula_value(formula)?;
+    let plan = Plan::from_parsed(&value).map_err(PyValueError::new_err)?;
+    let prepared = prepare(data, &plan, None, true)?;
+    let columns = prepared.inputs.column_set()?;
+    let state = prepared.fit(py, &columns)?;
+    state_to_python(py, &state)
+}
+
+/// Build the fixed-effects model matrix for a formula
+///
+/// `formula` is a formula string or a `ParsedFormula`; `data` maps column
+/// names to 1-D arrays or implements the Arrow PyCapsule interface.
+/// Intercept, main effects, interactions and supported transformations are
+/// evaluated in Rust with the GIL released into one float64 matrix.
+/// Non-numeric columns and columns wrapped in `factor()`/`c()` are
+/// categorical: each is expanded into indicator columns named `g[b]`, with
+/// treatment contrasts as in `sparse_model_matrix`. Data-dependent
+/// constants and levels are learned from `data` unless a `state` from
+/// `fit_state` is given. Returns the matrix and its column names, taken
+/// from `all_generated_columns`.
+#[pyfunction]
+#[pyo3(signature = (formula, data, state = None))]
+pub fn model_matrix(
+    py: Python,
+    formula: &Bound<PyAny>,
+    data: &Bound<PyAny>,
+    state: Option<&Bound<PyAny>>,
+) -> PyResult<(PyObject, Vec<String>)> {
+    let value = formula_value(formula)?;
+    let plan = Plan::from_parsed(&value).map_err(PyValueError::new_err)?;
+    let state = state.map(state_from_python).transpose()?;
+    let prepared = prepare(data, &plan, state.as_ref().map(|state| &state.levels), false)?;
+    let columns = prepared.inputs.column_set()?;
+    let state = resolve_state(py, &prepared, state, &columns)?;
+    let plan = &prepared.plan;
+    let values = py
+        .allow_threads(|| plan.evaluate(&state, &columns))
+        .map_err(PyValueError::new_err)?;
+    let matrix = to_numpy(py, values, columns.nrows(), plan.terms.len())?;
+    Ok((matrix, plan.names.clone()))
+}
+
+/// Build the response and the fixed-effects model matrix for a formula
+///
+/// Accepts the same arguments as `model_matrix`. Returns the response (1-D
+/// for a single response column, otherwise one column per response), the
+/// model matrix and its column names.
+#[pyfunction]
+#[pyo3(signature = (formula, data, state = None))]
+pub fn design_matrices(
+    py: Python,
+    formula: &Bound<PyAny>,
+    data: &Bound<PyAny>,
+    state: Option<&Bound<PyAny>>,
+) -> PyResult<(PyObject, PyObject, Vec<String>)> {
+    let value = formula_value(formula)?;
+    let plan = Plan::from_parsed(&value).map_err(PyValueError::new_err)?;
+    if plan.response_terms.is_empty() {
+        return Err(PyValueError::new_err("formula has no response"));
+    }
+    let state = state.map(state_from_python).transpose()?;
+    let prepared = prepare(data, &plan, state.as_ref().map(|state| &state.levels), true)?;
+    let columns = prepared.inputs.column_set()?;
+    let state = resolve_state(py, &prepared, state, &columns)?;
+    let (response, matrix) = evaluate_with_response(py, &prepared.plan, &state, &columns)?;
+    Ok((response, matrix, prepared.plan.names.clone()))
+}
+
+/// Evaluate the response and the model matrix with the GIL released
+///
+/// The response is 1-D for a single response column.
+pub(crate) fn evaluate_with_response(
+    py: Python,
+    plan: &Plan,
+    state: &FittedState,
+    columns: &ColumnSet,
+) -> PyResult<(PyObject, PyObject)> {
+    let (response, values) = py
+        .allow_threads(|| -> Result<_, String> {
+            let mut response = vec![0.0; columns.nrows() * plan.response_terms.len()];
+            Plan::fill(&plan.response_terms, state, columns, 0..columns.nrows(), &mut response)?;
+            Ok((response, plan.evaluate(state, columns)?))
+        })
+        .map_err(PyValueError::new_err)?;
+    let nrows = columns.nrows();
+    let response = match plan.response_terms.len() {
+        1 => response.into_pyarray_bound(py).into_any().unbind(),
+        n => to_numpy(py, response, nrows, n)?,
+    };
+    Ok((response, to_numpy(py, values, nrows, plan.terms.len())?))
+}
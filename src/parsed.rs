@@ -0,0 +1,265 @@
+//! Rust-backed result objects returned by `parse()`.
+//!
+//! `ParsedFormula` keeps fiasto's parse result on the Rust side and only
+//! builds Python objects for the parts a caller actually reads. `to_dict()`
+//! produces exactly what `parse_formula()` returns.
+
+use std::sync::Arc;
+
+use pyo3::exceptions::PyKeyError;
+use pyo3::prelude::*;
+use pyo3::types::{PyBytes, PyDict};
+use serde_json::Value;
+
+use crate::convert::json_value_to_python;
+use crate::{binary, cache, parse_error};
+
+/// Roles that do not make a column a fixed-effect predictor on their own
+const NON_FIXED_ROLES: &[&str] = &["Response", "GroupingVariable", "RandomEffect"];
+
+/// Borrow the strings of a JSON array, skipping anything that is not a string
+pub(crate) fn str_list(value: &Value) -> Vec<&str> {
+    value
+        .as_array()
+        .map(|items| items.iter().filter_map(Value::as_str).collect())
+        .unwrap_or_default()
+}
+
+/// Whether a column's `roles` contain `role`
+pub(crate) fn has_role(column: &Value, role: &str) -> bool {
+    str_list(&column["roles"]).contains(&role)
+}
+
+/// Whether a column enters the fixed-effects part of the model
+pub(crate) fn is_fixed_effect(column: &Value) -> bool {
+    let roles = str_list(&column["roles"]);
+    !roles.contains(&"Response")
+        && !roles.contains(&"GroupingVariable")
+        && roles.iter().any(|role| !NON_FIXED_ROLES.contains(role))
+}
+
+/// The entries of the `columns` object, in formula order (by `id`)
+pub(crate) fn columns_in_order(value: &Value) -> Vec<(&str, &Value)> {
+    let mut columns: Vec<(&str, &Value)> = value["columns"]
+        .as_object()
+        .map(|obj| obj.iter().map(|(name, info)| (name.as_str(), info)).collect())
+        .unwrap_or_default();
+    columns.sort_by_key(|(_, info)| info["id"].as_i64().unwrap_or(i64::MAX));
+    columns
+}
+
+/// A parsed Wilkinson's formula whose parts are converted to Python objects on access
+#[pyclass(frozen, module = "fiasto_py")]
+pub struct ParsedFormula {
+    value: Arc<Value>,
+}
+
+impl ParsedFormula {
+    pub(crate) fn new(value: Arc<Value>) -> Self {
+        ParsedFormula { value }
+    }
+
+    pub(crate) fn value(&self) -> &Arc<Value> {
+        &self.value
+    }
+
+    fn names_where(&self, predicate: impl Fn(&Value) -> bool) -> Vec<&str> {
+        columns_in_order(&self.value)
+            .into_iter()
+            .filter(|(_, info)| predicate(info))
+            .map(|(name, _)| name)
+            .collect()
+    }
+}
+
+#[pymethods]
+impl ParsedFormula {
+    /// The formula string that was parsed
+    #[getter]
+    fn formula(&self) -> &str {
+        self.value["formula"].as_str().unwrap_or_default()
+    }
+
+    /// Whether the model includes an intercept
+    #[getter]
+    fn has_intercept(&self) -> bool {
+        // Wilkinson's formulas include an intercept unless it is removed
+        self.value["metadata"]["has_intercept"]
+            .as_bool()
+            .unwrap_or(true)
+    }
+
+    /// Whether the formula contains random-effects terms
+    #[getter]
+    fn is_random_effects_model(&self) -> bool {
+        self.value["metadata"]["is_random_effects_model"]
+            .as_bool()
+            .unwrap_or(false)
+    }
+
+    /// Names of the response column(s), in formula order
+    #[getter]
+    fn response(&self) -> Vec<&str> {
+        self.names_where(|info| has_role(info, "Response"))
+    }
+
+    /// Names of the fixed-effect predictor columns, in formula order
+    #[getter]
+    fn fixed_effects(&self) -> Vec<&str> {
+        self.names_where(is_fixed_effect)
+    }
+
+    /// Names of the random-effects grouping variables, in formula order
+    #[getter]
+    fn grouping_variables(&self) -> Vec<&str> {
+        self.names_where(|info| has_role(info, "GroupingVariable"))
+    }
+
+    /// Random-effects specifications keyed by the column they belong to
+    #[getter]
+    fn random_effects(&self, py: Python) -> PyResult<PyObject> {
+        let py_dict = PyDict::new_bound(py);
+        for (name, info) in columns_in_order(&self.value) {
+            let effects = &info["random_effects"];
+            if effects.as_array().map_or(false, |items| !items.is_empty()) {
+                py_dict.set_item(name, json_value_to_python(py, effects)?)?;
+            }
+        }
+        Ok(py_dict.into())
+    }
+
+    /// All generated column names, in design-matrix order
+    #[getter]
+    fn all_generated_columns(&self) -> Vec<&str> {
+        str_list(&self.value["all_generated_columns"])
+    }
+
+    /// `Column` objects keyed by column name, in formula order
+    #[getter]
+    fn columns(&self, py: Python) -> PyResult<PyObject> {
+        let py_dict = PyDict::new_bound(py);
+        for (name, _) in columns_in_order(&self.value) {
+            let column = Column {
+                root: Arc::clone(&self.value),
+                name: name.to_owned(),
+            };
+            py_dict.set_item(name, Py::new(py, column)?)?;
+        }
+        Ok(py_dict.into())
+    }
+
+    /// The formula-level metadata dictionary
+    #[getter]
+    fn metadata(&self, py: Python) -> PyResult<PyObject> {
+        json_value_to_python(py, &self.value["metadata"])
+    }
+
+    /// Build the full dictionary returned by `parse_formula()`
+    fn to_dict(&self, py: Python) -> PyResult<PyObject> {
+        json_value_to_python(py, &self.value)
+    }
+
+    /// Convert a single top-level entry of the `parse_formula()` dictionary
+    fn __getitem__(&self, py: Python, key: &str) -> PyResult<PyObject> {
+        match self.value.get(key) {
+            Some(value) => json_value_to_python(py, value),
+            None => Err(PyKeyError::new_err(key.to_owned())),
+        }
+    }
+
+    /// Pickle through the compact encoding of `dumps`, so unpickling does not re-parse
+    fn __reduce__<'py>(&self, py: Python<'py>) -> PyResult<(Bound<'py, PyAny>, (Bound<'py, PyBytes>,))> {
+        let loads = py.import_bound("fiasto_py")?.getattr("loads")?;
+        Ok((loads, (PyBytes::new_bound(py, &binary::encode(&self.value)),)))
+    }
+
+    fn __repr__(&self) -> String {
+        format!("ParsedFormula({:?})", self.formula())
+    }
+}
+
+/// One column of a parsed formula
+#[pyclass(frozen, module = "fiasto_py")]
+pub struct Column {
+    root: Arc<Value>,
+    name: String,
+}
+
+impl Column {
+    fn info(&self) -> &Value {
+        &self.root["columns"][self.name.as_str()]
+    }
+}
+
+#[pymethods]
+impl Column {
+    /// The column name
+    #[getter]
+    fn name(&self) -> &str {
+        &self.name
+    }
+
+    /// The column's position in the formula, starting at 1
+    #[getter]
+    fn id(&self) -> Option<i64> {
+        self.info()["id"].as_i64()
+    }
+
+    /// The roles this column plays, e.g. `['Response']` or `['FixedEffect']`
+    #[getter]
+    fn roles(&self) -> Vec<&str> {
+        str_list(&self.info()["roles"])
+    }
+
+    /// The design-matrix columns generated from this column
+    #[getter]
+    fn generated_columns(&self) -> Vec<&str> {
+        str_list(&self.info()["generated_columns"])
+    }
+
+    /// Interactions this column takes part in
+    #[getter]
+    fn interactions(&self, py: Python) -> PyResult<PyObject> {
+        json_value_to_python(py, &self.info()["interactions"])
+    }
+
+    /// Random-effects specifications attached to this column
+    #[getter]
+    fn random_effects(&self, py: Python) -> PyResult<PyObject> {
+        json_value_to_python(py, &self.info()["random_effects"])
+    }
+
+    /// Transformations applied to this column
+    #[getter]
+    fn transformations(&self, py: Python) -> PyResult<PyObject> {
+        json_value_to_python(py, &self.info()["transformations"])
+    }
+
+    /// Build the dictionary found under `parse_formula()['columns'][name]`
+    fn to_dict(&self, py: Python) -> PyResult<PyObject> {
+        json_value_to_python(py, self.info())
+    }
+
+    fn __repr__(&self) -> String {
+        format!("Column({:?}, roles={:?})", self.name, self.roles())
+    }
+}
+
+/// Resolve a formula argument that may be a string or an already parsed `ParsedFormula`
+pub(crate) fn formula_value(formula: &Bound<PyAny>) -> PyResult<Arc<Value>> {
+    match formula.downcast::<ParsedFormula>() {
+        Ok(parsed) => Ok(Arc::clone(parsed.get().value())),
+        Err(_) => {
+            let formula = formula.extract::<String>()?;
+            cache::parse_cached(&formula).map_err(|e| parse_error(&formula, e))
+        }
+    }
+}
+
+/// Parse a Wilkinson's formula string and return a lazily converted `ParsedFormula`
+#[pyfunction]
+pub fn parse(formula: &str) -> PyResult<ParsedFormula> {
+    cache::parse_cached(formula)
+        .map(ParsedFormula::new)
+        .map_err(|e| parse_error(formula, e))
+}
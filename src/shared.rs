@@ -0,0 +1,373 @@
+//! Model matrices for many formulas over one dataset, sharing common columns.
+//!
+//! Every formula is planned, then its terms are merged into one evaluation
+//! graph: each distinct non-interaction term (raw column, transformation,
+//! intercept) is a leaf computed once from the data, and each distinct
+//! interaction is the product of leaf columns, computed once however many
+//! formulas use it and in whatever order its members were written. Leaves
+//! and then products are filled in parallel into a single column-major
+//! store with the GIL released; each formula's matrix is a list of store
+//! columns.
+
+use std::collections::HashMap;
+
+use numpy::ndarray::{Array2, ShapeBuilder};
+use numpy::{IntoPyArray, PyArray2, PyArrayMethods, PyUntypedArrayMethods};
+use pyo3::exceptions::{PyIndexError, PyValueError};
+use pyo3::prelude::*;
+use rayon::prelude::*;
+
+use crate::batch::run_batch;
+use crate::data::Table;
+use crate::design::{fill_term, ColumnSet, FittedState, Plan, Term, PARALLEL_THRESHOLD};
+use crate::matrix::{read_factors, state_from_python, state_to_python};
+use crate::{cache, parse_error, stats};
+
+/// The deduplicated columns of a set of plans
+#[derive(Default)]
+struct Graph {
+    /// Distinct non-interaction terms, stored first
+    leaves: Vec<Term>,
+    leaf_ids: HashMap<Term, usize>,
+    /// Distinct interactions as sorted leaf ids, stored after the leaves
+    products: Vec<Vec<usize>>,
+    product_ids: HashMap<Vec<usize>, usize>,
+    /// Name of each store column, from the first formula that generates it
+    names: Vec<Option<String>>,
+    /// Store columns of each formula's matrix, in the formula's column order
+    outputs: Vec<Vec<usize>>,
+}
+
+impl Graph {
+    fn build(plans: &[Plan]) -> Graph {
+        let mut graph = Graph::default();
+        // Register every leaf first so products can be numbered after them
+        for plan in plans {
+            for term in &plan.terms {
+                match term {
+                    Term::Interaction(members) => members.iter().for_each(|m| {
+                        graph.leaf(m);
+                    }),
+                    term => {
+                        graph.leaf(term);
+                    }
+                }
+            }
+        }
+        let nleaves = graph.leaves.len();
+        graph.names = vec![None; nleaves];
+        for plan in plans {
+            let mut output = Vec::with_capacity(plan.terms.len());
+            for (term, name) in plan.terms.iter().zip(&plan.names) {
+                let id = match term {
+                    Term::Interaction(members) => {
+                        let mut ids: Vec<usize> = members.iter().map(|m| graph.leaf_ids[m]).collect();
+                        ids.sort_unstable();
+                        nleaves + graph.product(ids)
+                    }
+                    term => graph.leaf_ids[term],
+                };
+                graph.names[id].get_or_insert_with(|| name.clone());
+                output.push(id);
+            }
+            graph.outputs.push(output);
+        }
+        graph
+    }
+
+    fn leaf(&mut self, term: &Term) -> usize {
+        if let Some(&id) = self.leaf_ids.get(term) {
+            return id;
+        }
+        self.leaves.push(term.clone());
+        self.leaf_ids.insert(term.clone(), self.leaves.len() - 1);
+        self.leaves.len() - 1
+    }
+
+    fn product(&mut self, ids: Vec<usize>) -> usize {
+        if let Some(&id) = self.product_ids.get(&ids) {
+            return id;
+        }
+        self.products.push(ids.clone());
+        self.product_ids.insert(ids, self.products.len() - 1);
+        self.names.push(None);
+        self.products.len() - 1
+    }
+
+    fn ncols(&self) -> usize {
+        self.leaves.len() + self.products.len()
+    }
+
+    /// Learn the constants of every stateful leaf at once
+    fn fit(&self, columns: &ColumnSet) -> Result<FittedState, String> {
+        let plan = Plan {
+            response: Vec::new(),
+            response_terms: Vec::new(),
+            names: Vec::new(),
+            terms: self.leaves.clone(),
+        };
+        plan.fit(columns)
+    }
+
+    /// Compute the store: leaves from the data, then products from the leaves
+    fn evaluate(&self, state: &FittedState, columns: &ColumnSet) -> Result<Vec<f64>, String> {
+        let nrows = columns.nrows();
+        let mut store = vec![0.0; nrows * self.ncols()];
+        if nrows == 0 {
+            return Ok(store);
+        }
+        stats::EVALUATE.time(|| {
+            let (leaf_store, product_store) = store.split_at_mut(nrows * self.leaves.len());
+            let parallel = nrows * self.ncols() >= PARALLEL_THRESHOLD;
+            let fill = |(term, out): (&Term, &mut [f64])| fill_term(term, state, columns, 0..nrows, out);
+            if parallel {
+                self.leaves
+                    .par_iter()
+                    .zip(leaf_store.par_chunks_mut(nrows))
+                    .try_for_each(fill)?;
+            } else {
+                self.leaves.iter().zip(leaf_store.chunks_mut(nrows)).try_for_each(fill)?;
+            }
+            let leaf_store = &*leaf_store;
+            let multiply = |(ids, out): (&Vec<usize>, &mut [f64])| {
+                let column = |id: usize| &leaf_store[id * nrows..(id + 1) * nrows];
+                out.copy_from_slice(column(ids[0]));
+                for &id in &ids[1..] {
+                    out.iter_mut().zip(column(id)).for_each(|(o, v)| *o *= v);
+                }
+            };
+            if parallel {
+                self.products
+                    .par_iter()
+                    .zip(product_store.par_chunks_mut(nrows))
+                    .for_each(multiply);
+            } else {
+                self.products.iter().zip(product_store.chunks_mut(nrows)).for_each(multiply);
+            }
+            Ok(())
+        })?;
+        Ok(store)
+    }
+}
+
+/// Model matrices of several formulas backed by one store of shared columns
+///
+/// `store` holds every distinct generated column once, read-only; formula
+/// `i` is the store columns listed by `indices(i)`. `matrix(i)` and
+/// `m[i]` gather them into a contiguous matrix of that formula's own.
+#[pyclass(frozen, module = "fiasto_py")]
+pub struct SharedModelMatrices {
+    formulas: Vec<String>,
+    store: Py<PyArray2<f64>>,
+    store_names: Vec<String>,
+    outputs: Vec<Vec<usize>>,
+    names: Vec<Vec<String>>,
+    state: FittedState,
+}
+
+impl SharedModelMatrices {
+    fn position(&self, i: isize) -> PyResult<usize> {
+        let n = self.outputs.len() as isize;
+        let position = if i < 0 { i + n } else { i };
+        if !(0..n).contains(&position) {
+            return Err(PyIndexError::new_err("formula index out of range"));
+        }
+        Ok(position as usize)
+    }
+}
+
+#[pymethods]
+impl SharedModelMatrices {
+    /// The formulas, in input order
+    #[getter]
+    fn formulas(&self) -> Vec<String> {
+        self.formulas.clone()
+    }
+
+    /// The read-only `(nrows, n_store_columns)` array of distinct columns
+    #[getter]
+    fn store(&self, py: Python) -> PyObject {
+        self.store.clone_ref(py).into_any()
+    }
+
+    /// Names of the store columns
+    #[getter]
+    fn store_columns(&self) -> Vec<String> {
+        self.store_names.clone()
+    }
+
+    /// The fitted state shared by all formulas, as returned by `fit_state`
+    #[getter]
+    fn state(&self, py: Python) -> PyResult<PyObject> {
+        state_to_python(py, &self.state)
+    }
+
+    /// Columns across all formulas per distinct store column (1.0 when nothing is shared)
+    #[getter]
+    fn sharing(&self) -> f64 {
+        let total: usize = self.outputs.iter().map(Vec::len).sum();
+        match self.store_names.len() {
+            0 => 1.0,
+            n => total as f64 / n as f64,
+        }
+    }
+
+    /// Store column positions of formula `i`'s matrix
+    fn indices(&self, i: isize) -> PyResult<Vec<usize>> {
+        Ok(self.outputs[self.position(i)?].clone())
+    }
+
+    /// Column names of formula `i`'s matrix
+    fn columns(&self, i: isize) -> PyResult<Vec<String>> {
+        Ok(self.names[self.position(i)?].clone())
+    }
+
+    /// Formula `i`'s model matrix, gathered from the store
+    fn matrix(&self, py: Python, i: isize) -> PyResult<PyObject> {
+        let output = &self.outputs[self.position(i)?];
+        let store = self.store.bind(py).readonly();
+        let nrows = store.shape()[0];
+        let values = store.as_slice()?;
+        let gathered = py.allow_threads(|| {
+            let mut out = Vec::with_capacity(nrows * output.len());
+            for &id in output {
+                out.extend_from_slice(&values[id * nrows..(id + 1) * nrows]);
+            }
+            out
+        });
+        crate::matrix::to_numpy(py, gathered, nrows, output.len())
+    }
+
+    fn __len__(&self) -> usize {
+        self.outputs.len()
+    }
+
+    /// `(matrix, columns)` for formula `i`, like `model_matrix`
+    fn __getitem__(&self, py: Python, i: isize) -> PyResult<(PyObject, Vec<String>)> {
+        Ok((self.matrix(py, i)?, self.columns(i)?))
+    }
+
+    fn __repr__(&self, py: Python) -> String {
+        let store = self.store.bind(py);
+        format!(
+            "SharedModelMatrices(formulas={}, nrows={}, store_columns={}, sharing={:.2})",
+            self.outputs.len(),
+            store.shape()[0],
+            store.shape()[1],
+            self.sharing()
+        )
+    }
+}
+
+/// Build the model matrices of many formulas over the same data at once
+///
+/// Each formula is parsed (in parallel when `parallel` is true) and planned
+/// as in `model_matrix`. Columns generated by more than one formula, such
+/// as a shared main effect, transformation or interaction, are computed
+/// once; interactions reuse the stored member columns. Data-dependent
+/// constants and the levels of categorical columns are learned once from
+/// `data` unless a `state` is given, so every formula codes a categorical
+/// column the same way. Returns a `SharedModelMatrices`.
+#[pyfunction]
+#[pyo3(signature = (formulas, data, state = None, parallel = true))]
+pub fn shared_model_matrices(
+    py: Python,
+    formulas: Vec<String>,
+    data: &Bound<PyAny>,
+    state: Option<&Bound<PyAny>>,
+    parallel: bool,
+) -> PyResult<SharedModelMatrices> {
+    let results = run_batch(py, &formulas, parallel, |formula| {
+        cache::parse_cached(formula).map(|value| Plan::from_parsed(&value))
+    });
+    let mut parsed = Vec::with_capacity(formulas.len());
+    for (formula, result) in formulas.iter().zip(results) {
+        let plan = result.map_err(|e| parse_error(formula, e))?;
+        parsed.push(plan.map_err(PyValueError::new_err)?);
+    }
+
+    let state = state.map(state_from_python).transpose()?;
+    let table = Table::new(data)?;
+    let factors = read_factors(
+        &table,
+        &parsed.iter().collect::<Vec<_>>(),
+        &[],
+        state.as_ref().map(|state| &state.levels),
+    )?;
+    let levels: HashMap<String, Vec<String>> = factors
+        .iter()
+        .map(|(column, factor)| (column.clone(), factor.levels.clone()))
+        .collect();
+    let plans = parsed
+        .iter()
+        .map(|plan| plan.expand(&levels))
+        .collect::<Result<Vec<_>, _>>()
+        .map_err(PyValueError::new_err)?;
+
+    let graph = Graph::build(&plans);
+    let mut required = Vec::new();
+    for plan in &plans {
+        for column in plan.required_columns() {
+            if !required.contains(&column) {
+                required.push(column);
+            }
+        }
+    }
+    let mut inputs = table.numeric(&required, &[])?;
+    for (column, factor) in factors {
+        inputs.add_codes(&column, factor.codes);
+    }
+    let columns = inputs.column_set()?;
+    let state = match state {
+        Some(state) => state,
+        None => {
+            let mut state = py
+                .allow_threads(|| graph.fit(&columns))
+                .map_err(PyValueError::new_err)?;
+            state.levels = levels;
+            state
+        }
+    };
+    let values = py
+        .allow_threads(|| graph.evaluate(&state, &columns))
+        .map_err(PyValueError::new_err)?;
+
+    let store = Array2::from_shape_vec((columns.nrows(), graph.ncols()).f(), values)
+        .map_err(|e| PyValueError::new_err(e.to_string()))?
+        .into_pyarray_bound(py);
+    store.getattr("flags")?.setattr("writeable", false)?;
+    let store_names = (0..graph.ncols())
+        .map(|id| match &graph.names[id] {
+            Some(name) => name.clone(),
+            None => leaf_name(&graph.leaves[id], &state.levels),
+        })
+        .collect();
+    Ok(SharedModelMatrices {
+        formulas,
+        store: store.unbind(),
+        store_names,
+        outputs: graph.outputs,
+        names: plans.into_iter().map(|plan| plan.names).collect(),
+        state,
+    })
+}
+
+/// Name a leaf that is only an interaction member, so no formula names it
+fn leaf_name(term: &Term, levels: &HashMap<String, Vec<String>>) -> String {
+    match term {
+        Term::Column(column) => column.clone(),
+        Term::Transform {
+            function,
+            column,
+            index,
+            count,
+            ..
+        } => match count {
+            1 => format!("{}({})", function, column),
+            _ => format!("{}({})[{}]", function, column, index),
+        },
+        Term::Level { column, level } => format!("{}[{}]", column, levels[column][*level as usize]),
+        Term::Intercept => "intercept".to_owned(),
+        Term::Interaction(_) => unreachable!("interactions are never leaves"),
+    }
+}
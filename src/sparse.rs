@@ -0,0 +1,468 @@
+//! Sparse (CSR/CSC) design matrices for random effects and categorical terms.
+//!
+//! Both builders write SciPy-compatible `data`/`indices`/`indptr` buffers
+//! directly, so memory grows with the number of nonzeros rather than with
+//! rows times levels.
+
+use std::collections::{HashMap, HashSet};
+
+use numpy::IntoPyArray;
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+use pyo3::types::PyDict;
+use serde_json::Value;
+
+use crate::data::{Factor, Table};
+use crate::design::{coded_members, fill_term, FittedState, Member, Plan};
+use crate::matrix::{read_factors, state_from_python, state_to_python};
+use crate::parsed::{columns_in_order, formula_value, str_list};
+
+/// A sparse matrix in compressed row (CSR) or column (CSC) form
+#[pyclass(frozen, module = "fiasto_py")]
+pub struct SparseMatrix {
+    format: &'static str,
+    shape: (usize, usize),
+    data: PyObject,
+    indices: PyObject,
+    indptr: PyObject,
+    columns: Vec<String>,
+    state: Option<FittedState>,
+}
+
+impl SparseMatrix {
+    fn new(
+        py: Python,
+        format: &'static str,
+        shape: (usize, usize),
+        (data, indices, indptr): (Vec<f64>, Vec<i64>, Vec<i64>),
+        columns: Vec<String>,
+        state: Option<FittedState>,
+    ) -> Self {
+        SparseMatrix {
+            format,
+            shape,
+            data: data.into_pyarray_bound(py).into_any().unbind(),
+            indices: indices.into_pyarray_bound(py).into_any().unbind(),
+            indptr: indptr.into_pyarray_bound(py).into_any().unbind(),
+            columns,
+            state,
+        }
+    }
+}
+
+#[pymethods]
+impl SparseMatrix {
+    /// `'csr'` or `'csc'`
+    #[getter]
+    fn format(&self) -> &str {
+        self.format
+    }
+
+    /// `(rows, columns)`
+    #[getter]
+    fn shape(&self) -> (usize, usize) {
+        self.shape
+    }
+
+    /// The stored values
+    #[getter]
+    fn data(&self, py: Python) -> PyObject {
+        self.data.clone_ref(py)
+    }
+
+    /// Column (CSR) or row (CSC) index of each stored value
+    #[getter]
+    fn indices(&self, py: Python) -> PyObject {
+        self.indices.clone_ref(py)
+    }
+
+    /// Offsets into `data`/`indices` where each row (CSR) or column (CSC) starts
+    #[getter]
+    fn indptr(&self, py: Python) -> PyObject {
+        self.indptr.clone_ref(py)
+    }
+
+    /// Names of the matrix columns
+    #[getter]
+    fn columns(&self) -> Vec<String> {
+        self.columns.clone()
+    }
+
+    /// The constants and categorical levels used, in the format of
+    /// `fit_state()`; `None` for random-effects matrices
+    #[getter]
+    fn state(&self, py: Python) -> PyResult<Option<PyObject>> {
+        self.state.as_ref().map(|state| state_to_python(py, state)).transpose()
+    }
+
+    /// Number of stored values
+    #[getter]
+    fn nnz(&self, py: Python) -> PyResult<usize> {
+        self.data.bind(py).len()
+    }
+
+    /// Build a `scipy.sparse` array sharing these buffers (requires SciPy)
+    fn to_scipy(&self, py: Python) -> PyResult<PyObject> {
+        let sparse = py.import_bound("scipy.sparse")?;
+        let array = format!("{}_array", self.format);
+        let constructor = match sparse.getattr(array.as_str()) {
+            Ok(constructor) => constructor,
+            // SciPy < 1.8 only has the matrix classes
+            Err(_) => sparse.getattr(format!("{}_matrix", self.format).as_str())?,
+        };
+        let kwargs = PyDict::new_bound(py);
+        kwargs.set_item("shape", self.shape)?;
+        let buffers = (
+            self.data.clone_ref(py),
+            self.indices.clone_ref(py),
+            self.indptr.clone_ref(py),
+        );
+        Ok(constructor.call((buffers,), Some(&kwargs))?.unbind())
+    }
+
+    fn __repr__(&self, py: Python) -> PyResult<String> {
+        Ok(format!(
+            "SparseMatrix(format={:?}, shape={:?}, nnz={})",
+            self.format,
+            self.shape,
+            self.nnz(py)?
+        ))
+    }
+}
+
+/// One random-effects term: `(1 + variables | group)`
+#[derive(PartialEq)]
+struct RandomEffect {
+    group: String,
+    intercept: bool,
+    variables: Vec<String>,
+}
+
+impl RandomEffect {
+    fn width(&self) -> usize {
+        self.intercept as usize + self.variables.len()
+    }
+}
+
+/// Collect the distinct random-effects terms of a parse result
+fn random_effects(value: &Value) -> Vec<RandomEffect> {
+    let mut effects: Vec<RandomEffect> = Vec::new();
+    for (_, info) in columns_in_order(value) {
+        for entry in info["random_effects"].as_array().into_iter().flatten() {
+            let Some(group) = entry["grouping_variable"].as_str() else {
+                continue;
+            };
+            let effect = RandomEffect {
+                group: group.to_owned(),
+                intercept: entry["has_intercept"].as_bool().unwrap_or(true),
+                variables: str_list(&entry["variables"]).into_iter().map(str::to_owned).collect(),
+            };
+            if effect.width() > 0 && !effects.contains(&effect) {
+                effects.push(effect);
+            }
+        }
+    }
+    effects
+}
+
+/// Check that every input has `nrows` rows, or take the first input's count
+fn common_rows(lengths: impl IntoIterator<Item = usize>) -> PyResult<usize> {
+    let mut nrows = None;
+    for length in lengths {
+        match nrows {
+            None => nrows = Some(length),
+            Some(n) if n != length => {
+                return Err(PyValueError::new_err(format!(
+                    "columns have different lengths ({} and {})",
+                    n, length
+                )))
+            }
+            _ => {}
+        }
+    }
+    Ok(nrows.unwrap_or(0))
+}
+
+/// Rows of each level combination that occurs, in the order of a full
+/// expansion, so memory grows with the rows rather than the level counts
+fn observed_buckets(cats: &[(&Factor, usize)], nrows: usize) -> Vec<(Box<[u32]>, Vec<usize>)> {
+    let mut ids: HashMap<Box<[u32]>, usize> = HashMap::new();
+    let mut buckets: Vec<(Box<[u32]>, Vec<usize>)> = Vec::new();
+    let mut combination = vec![0u32; cats.len()];
+    'rows: for row in 0..nrows {
+        for (code, (factor, first)) in combination.iter_mut().zip(cats) {
+            *code = factor.codes[row];
+            if (*code as usize) < *first {
+                continue 'rows;
+            }
+        }
+        let id = match ids.get(combination.as_slice()) {
+            Some(&id) => id,
+            None => {
+                let key: Box<[u32]> = combination.as_slice().into();
+                ids.insert(key.clone(), buckets.len());
+                buckets.push((key, Vec::new()));
+                buckets.len() - 1
+            }
+        };
+        buckets[id].1.push(row);
+    }
+    // The first factor varies fastest
+    buckets.sort_unstable_by(|a, b| a.0.iter().rev().cmp(b.0.iter().rev()));
+    buckets
+}
+
+/// Rows of every combination of the coded levels, empty for those that do
+/// not occur, in the order `Plan::expand` names them
+fn full_buckets(cats: &[(&Factor, usize)], nrows: usize) -> Vec<(Box<[u32]>, Vec<usize>)> {
+    let sizes: Vec<usize> = cats
+        .iter()
+        .map(|(factor, first)| factor.levels.len().saturating_sub(*first))
+        .collect();
+    let total: usize = sizes.iter().product();
+
+    // Mixed-radix index of each row's combination, the first factor varying fastest
+    let ids: Vec<Option<usize>> = (0..nrows)
+        .map(|row| {
+            let (mut id, mut stride) = (0, 1);
+            for ((factor, first), size) in cats.iter().zip(&sizes) {
+                let code = factor.codes[row] as usize;
+                if code < *first {
+                    return None;
+                }
+                id += (code - first) * stride;
+                stride *= size;
+            }
+            Some(id)
+        })
+        .collect();
+    let mut counts = vec![0usize; total];
+    for &id in ids.iter().flatten() {
+        counts[id] += 1;
+    }
+    let mut buckets: Vec<(Box<[u32]>, Vec<usize>)> = counts
+        .iter()
+        .enumerate()
+        .map(|(mut id, &count)| {
+            let combination: Box<[u32]> = cats
+                .iter()
+                .zip(&sizes)
+                .map(|((_, first), size)| {
+                    let code = first + id % size;
+                    id /= size;
+                    code as u32
+                })
+                .collect();
+            (combination, Vec::with_capacity(count))
+        })
+        .collect();
+    for (row, id) in ids.into_iter().enumerate() {
+        if let Some(id) = id {
+            buckets[id].1.push(row);
+        }
+    }
+    buckets
+}
+
+/// Build the random-effects design matrix Z as CSR
+///
+/// Each `(1 + x | group)` term contributes one block of columns per level of
+/// `group` (sorted), holding the intercept and slope variables for that
+/// level. Every row has exactly one nonzero per term and per variable.
+#[pyfunction]
+pub fn random_effects_matrix(py: Python, formula: &Bound<PyAny>, data: &Bound<PyAny>) -> PyResult<SparseMatrix> {
+    let value = formula_value(formula)?;
+    let effects = random_effects(&value);
+    if effects.is_empty() {
+        return Err(PyValueError::new_err("formula has no random effects"));
+    }
+    let table = Table::new(data)?;
+    let variables: Vec<&str> = effects
+        .iter()
+        .flat_map(|effect| effect.variables.iter().map(String::as_str))
+        .collect();
+    let inputs = table.numeric(&variables, &[])?;
+    let columns = inputs.column_set()?;
+    let factors = effects
+        .iter()
+        .map(|effect| table.factor(&effect.group))
+        .collect::<PyResult<Vec<Factor>>>()?;
+    let nrows = common_rows(
+        factors
+            .iter()
+            .map(|factor| factor.codes.len())
+            .chain((!variables.is_empty()).then(|| columns.nrows())),
+    )?;
+
+    // Column layout: per term, per level, [intercept, variables...]
+    let mut names = Vec::new();
+    let mut offsets = Vec::with_capacity(effects.len());
+    // (term, position within the level block, variable values or None for the intercept)
+    let mut slots: Vec<(usize, usize, Option<&[f64]>)> = Vec::new();
+    for (index, (effect, factor)) in effects.iter().zip(&factors).enumerate() {
+        offsets.push(names.len());
+        for level in &factor.levels {
+            if effect.intercept {
+                names.push(format!("intercept|{}[{}]", effect.group, level));
+            }
+            for variable in &effect.variables {
+                names.push(format!("{}|{}[{}]", variable, effect.group, level));
+            }
+        }
+        if effect.intercept {
+            slots.push((index, 0, None));
+        }
+        for (position, variable) in effect.variables.iter().enumerate() {
+            let values = columns.get(variable).map_err(PyValueError::new_err)?;
+            slots.push((index, effect.intercept as usize + position, Some(values)));
+        }
+    }
+
+    let per_row = slots.len();
+    let buffers = py.allow_threads(|| {
+        let nnz = nrows * per_row;
+        let mut data = Vec::with_capacity(nnz);
+        let mut indices = Vec::with_capacity(nnz);
+        for row in 0..nrows {
+            for &(term, position, values) in &slots {
+                let width = effects[term].width();
+                let level = factors[term].codes[row] as usize;
+                indices.push((offsets[term] + level * width + position) as i64);
+                data.push(values.map_or(1.0, |values| values[row]));
+            }
+        }
+        let indptr = (0..=nrows).map(|row| (row * per_row) as i64).collect();
+        (data, indices, indptr)
+    });
+    let shape = (nrows, names.len());
+    Ok(SparseMatrix::new(py, "csr", shape, buffers, names, None))
+}
+
+/// Build the fixed-effects model matrix as CSC, one-hot encoding categorical columns
+///
+/// Columns listed in `categorical`, non-numeric data columns and columns
+/// wrapped in `factor()`/`c()` are expanded into one indicator column per
+/// level. As in R, a categorical factor is coded by treatment contrasts
+/// (its first level dropped) when the term without it is also in the model,
+/// e.g. `g` with an intercept or `x:g` alongside `x`; otherwise all levels
+/// are kept. Interactions of categorical factors get a column only for the
+/// level combinations that occur in the data. Numeric terms are stored as
+/// dense columns.
+///
+/// With `state` (from `fit_state()` or a previous result's `state`), its
+/// constants are used and categorical columns are coded against its levels:
+/// every level combination gets a column, left empty when absent from
+/// `data`, so matrices built from different data share one layout.
+#[pyfunction]
+#[pyo3(signature = (formula, data, categorical = None, state = None))]
+pub fn sparse_model_matrix(
+    py: Python,
+    formula: &Bound<PyAny>,
+    data: &Bound<PyAny>,
+    categorical: Option<Vec<String>>,
+    state: Option<&Bound<PyAny>>,
+) -> PyResult<SparseMatrix> {
+    let value = formula_value(formula)?;
+    let plan = Plan::from_parsed(&value).map_err(PyValueError::new_err)?;
+    let table = Table::new(data)?;
+    let fitted = state.map(state_from_python).transpose()?;
+
+    let factors = read_factors(
+        &table,
+        &[&plan],
+        &categorical.unwrap_or_default(),
+        fitted.as_ref().map(|state| &state.levels),
+    )?;
+    let categorical: HashSet<&str> = factors.iter().map(|(column, _)| column.as_str()).collect();
+    let term_members = coded_members(&plan.terms, &categorical);
+
+    let mut numeric_columns: Vec<&str> = Vec::new();
+    for member in term_members.iter().flatten() {
+        if let Member::Numeric(term) = member {
+            let mut inputs = Vec::new();
+            term.inputs(&mut inputs);
+            for input in inputs {
+                if !numeric_columns.contains(&input) {
+                    numeric_columns.push(input);
+                }
+            }
+        }
+    }
+    let inputs = table.numeric(&numeric_columns, &[])?;
+    let columns = inputs.column_set()?;
+    let nrows = common_rows(
+        factors
+            .iter()
+            .map(|(_, factor)| factor.codes.len())
+            .chain((!numeric_columns.is_empty()).then(|| columns.nrows())),
+    )?;
+    let fixed = fitted.is_some();
+    let mut state = match fitted {
+        Some(state) => state,
+        None => py
+            .allow_threads(|| plan.fit(&columns))
+            .map_err(PyValueError::new_err)?,
+    };
+    state.levels = factors
+        .iter()
+        .map(|(column, factor)| (column.clone(), factor.levels.clone()))
+        .collect();
+
+    let (names, buffers) = py
+        .allow_threads(|| -> Result<_, String> {
+            let mut names = Vec::new();
+            let mut data = Vec::new();
+            let mut indices: Vec<i64> = Vec::new();
+            let mut indptr: Vec<i64> = vec![0];
+            for (name, term_members) in plan.names.iter().zip(&term_members) {
+                // Product of the numeric factors (or ones), computed once per term
+                let mut numeric = vec![1.0; nrows];
+                let mut buffer = vec![0.0; nrows];
+                for member in term_members {
+                    if let Member::Numeric(term) = member {
+                        fill_term(term, &state, &columns, 0..nrows, &mut buffer)?;
+                        numeric.iter_mut().zip(&buffer).for_each(|(n, b)| *n *= b);
+                    }
+                }
+
+                // (factor, first level kept) for each categorical factor of the term
+                let mut cats: Vec<(&Factor, usize)> = Vec::new();
+                for member in term_members {
+                    if let Member::Categorical { column, first } = member {
+                        let (_, factor) = factors.iter().find(|(c, _)| c.as_str() == *column).unwrap();
+                        cats.push((factor, *first));
+                    }
+                }
+
+                if cats.is_empty() {
+                    names.push(name.clone());
+                    data.extend_from_slice(&numeric);
+                    indices.extend((0..nrows).map(|row| row as i64));
+                    indptr.push(data.len() as i64);
+                    continue;
+                }
+
+                let buckets = if fixed {
+                    full_buckets(&cats, nrows)
+                } else {
+                    observed_buckets(&cats, nrows)
+                };
+                for (combination, rows) in &buckets {
+                    let labels: Vec<&str> = combination
+                        .iter()
+                        .zip(&cats)
+                        .map(|(&code, (factor, _))| factor.levels[code as usize].as_str())
+                        .collect();
+                    names.push(format!("{}[{}]", name, labels.join(":")));
+                    data.extend(rows.iter().map(|&row| numeric[row]));
+                    indices.extend(rows.iter().map(|&row| row as i64));
+                    indptr.push(data.len() as i64);
+                }
+            }
+            Ok((names, (data, indices, indptr)))
+        })
+        .map_err(PyValueError::new_err)?;
+
+    let shape = (nrows, names.len());
+    Ok(SparseMatrix::new(py, "csc", shape, buffers, names, Some(state)))
+}
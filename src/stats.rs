@@ -0,0 +1,197 @@
+//! Opt-in instrumentation counters readable through `stats()`.
+//!
+//! Timers and counters are process-wide atomics. While instrumentation is
+//! disabled (the default) each instrumented call costs one relaxed atomic
+//! load; enabling it adds two clock reads per timed phase and, for result
+//! conversion, a walk of the converted value to count objects and bytes.
+//! Cache and batch counts are always kept since they are plain increments.
+
+use std::sync::atomic::{AtomicBool, AtomicU64, Ordering};
+use std::time::Instant;
+
+use pyo3::prelude::*;
+use pyo3::types::PyDict;
+use serde_json::Value;
+
+use crate::cache;
+
+static ENABLED: AtomicBool = AtomicBool::new(false);
+
+/// Call count and total nanoseconds of one phase
+pub(crate) struct Timer {
+    calls: AtomicU64,
+    nanos: AtomicU64,
+}
+
+impl Timer {
+    const fn new() -> Self {
+        Timer {
+            calls: AtomicU64::new(0),
+            nanos: AtomicU64::new(0),
+        }
+    }
+
+    /// Run `f`, recording its duration when instrumentation is enabled
+    #[inline]
+    pub(crate) fn time<T>(&self, f: impl FnOnce() -> T) -> T {
+        if !ENABLED.load(Ordering::Relaxed) {
+            return f();
+        }
+        let start = Instant::now();
+        let result = f();
+        self.record(start);
+        result
+    }
+
+    /// Add the time elapsed since `start` as one call
+    pub(crate) fn record(&self, start: Instant) {
+        self.calls.fetch_add(1, Ordering::Relaxed);
+        self.nanos
+            .fetch_add(start.elapsed().as_nanos() as u64, Ordering::Relaxed);
+    }
+
+    fn reset(&self) {
+        self.calls.store(0, Ordering::Relaxed);
+        self.nanos.store(0, Ordering::Relaxed);
+    }
+
+    fn to_python<'py>(&self, py: Python<'py>) -> PyResult<Bound<'py, PyDict>> {
+        let py_dict = PyDict::new_bound(py);
+        py_dict.set_item("calls", self.calls.load(Ordering::Relaxed))?;
+        py_dict.set_item("ns", self.nanos.load(Ordering::Relaxed))?;
+        Ok(py_dict)
+    }
+}
+
+/// Lexing formulas with fiasto
+pub(crate) static LEX: Timer = Timer::new();
+/// Parsing formulas with fiasto (cache misses only)
+pub(crate) static PARSE: Timer = Timer::new();
+/// Checking formulas with `validate` and `validate_many`
+pub(crate) static VALIDATE: Timer = Timer::new();
+/// Building Python objects from parse and lex results
+pub(crate) static CONVERT: Timer = Timer::new();
+/// Evaluating model matrices and transformations
+pub(crate) static EVALUATE: Timer = Timer::new();
+/// Waiting to acquire the GIL on worker threads
+pub(crate) static GIL_WAIT: Timer = Timer::new();
+
+/// Python objects created by conversion
+static CONVERTED_OBJECTS: AtomicU64 = AtomicU64::new(0);
+/// UTF-8 bytes of the strings created by conversion
+static CONVERTED_BYTES: AtomicU64 = AtomicU64::new(0);
+
+/// In-memory parse cache counters, kept apart from `cache_info()`'s so
+/// `reset_stats` and `cache_clear` do not reset each other
+pub(crate) static CACHE_HITS: AtomicU64 = AtomicU64::new(0);
+pub(crate) static CACHE_MISSES: AtomicU64 = AtomicU64::new(0);
+
+/// Disk cache counters
+pub(crate) static DISK_HITS: AtomicU64 = AtomicU64::new(0);
+pub(crate) static DISK_MISSES: AtomicU64 = AtomicU64::new(0);
+pub(crate) static DISK_WRITES: AtomicU64 = AtomicU64::new(0);
+
+/// Batch calls and the formulas they processed
+pub(crate) static BATCH_CALLS: AtomicU64 = AtomicU64::new(0);
+pub(crate) static BATCH_ITEMS: AtomicU64 = AtomicU64::new(0);
+
+pub(crate) fn enabled() -> bool {
+    ENABLED.load(Ordering::Relaxed)
+}
+
+pub(crate) fn increment(counter: &AtomicU64, by: u64) {
+    counter.fetch_add(by, Ordering::Relaxed);
+}
+
+/// Count the objects and string bytes a conversion of `value` creates
+pub(crate) fn record_conversion(value: &Value) {
+    fn walk(value: &Value, objects: &mut u64, bytes: &mut u64) {
+        *objects += 1;
+        match value {
+            Value::String(s) => *bytes += s.len() as u64,
+            Value::Array(items) => items.iter().for_each(|item| walk(item, objects, bytes)),
+            Value::Object(map) => {
+                for (key, item) in map {
+                    *objects += 1;
+                    *bytes += key.len() as u64;
+                    walk(item, objects, bytes);
+                }
+            }
+            _ => {}
+        }
+    }
+    let (mut objects, mut bytes) = (0, 0);
+    walk(value, &mut objects, &mut bytes);
+    increment(&CONVERTED_OBJECTS, objects);
+    increment(&CONVERTED_BYTES, bytes);
+}
+
+/// Enable or disable the phase timers and conversion counters
+#[pyfunction]
+#[pyo3(signature = (enabled = true))]
+pub fn enable_stats(enabled: bool) {
+    ENABLED.store(enabled, Ordering::Relaxed);
+}
+
+/// Reset all counters to zero, leaving instrumentation enabled or disabled
+///
+/// The counters of `cache_info()` belong to the cache and are left alone;
+/// `cache_clear()` resets those.
+#[pyfunction]
+pub fn reset_stats() {
+    for timer in [&LEX, &PARSE, &VALIDATE, &CONVERT, &EVALUATE, &GIL_WAIT] {
+        timer.reset();
+    }
+    for counter in [
+        &CONVERTED_OBJECTS,
+        &CONVERTED_BYTES,
+        &CACHE_HITS,
+        &CACHE_MISSES,
+        &DISK_HITS,
+        &DISK_MISSES,
+        &DISK_WRITES,
+        &BATCH_CALLS,
+        &BATCH_ITEMS,
+    ] {
+        counter.store(0, Ordering::Relaxed);
+    }
+}
+
+/// Return a snapshot of the instrumentation counters as nested dictionaries
+///
+/// Phases (`lex`, `parse`, `validate`, `convert`, `evaluate`, `gil_wait`)
+/// report `calls` and total `ns` and only advance while `enable_stats()` is
+/// on; `convert` also reports the `objects` and string `bytes` it created.
+/// `cache`, `disk_cache` and `batch` counts are always kept.
+#[pyfunction]
+pub fn stats(py: Python) -> PyResult<PyObject> {
+    let load = |counter: &AtomicU64| counter.load(Ordering::Relaxed);
+    let py_dict = PyDict::new_bound(py);
+    py_dict.set_item("enabled", enabled())?;
+    py_dict.set_item("lex", LEX.to_python(py)?)?;
+    py_dict.set_item("parse", PARSE.to_python(py)?)?;
+    py_dict.set_item("validate", VALIDATE.to_python(py)?)?;
+    let convert = CONVERT.to_python(py)?;
+    convert.set_item("objects", load(&CONVERTED_OBJECTS))?;
+    convert.set_item("bytes", load(&CONVERTED_BYTES))?;
+    py_dict.set_item("convert", convert)?;
+    py_dict.set_item("evaluate", EVALUATE.to_python(py)?)?;
+    py_dict.set_item("gil_wait", GIL_WAIT.to_python(py)?)?;
+
+    let info = cache::cache_info();
+    let memory = PyDict::new_bound(py);
+    memory.set_item("hits", load(&CACHE_HITS))?;
+    memory.set_item("misses", load(&CACHE_MISSES))?;
+    memory.set_item("size", info.currsize)?;
+    py_dict.set_item("cache", memory)?;
+    let disk = PyDict::new_bound(py);
+    disk.set_item("hits", load(&DISK_HITS))?;
+    disk.set_item("misses", load(&DISK_MISSES))?;
+    disk.set_item("writes", load(&DISK_WRITES))?;
+    py_dict.set_item("disk_cache", disk)?;
+    let batch = PyDict::new_bound(py);
+    batch.set_item("calls", load(&BATCH_CALLS))?;
+    batch.set_item("items", load(&BATCH_ITEMS))?;
+    py_dict.set_item("batch", batch)?;
+    Ok(py_dict.into())
+}
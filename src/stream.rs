@@ -0,0 +1,393 @@
+//! Chunked model-matrix generation for data that does not fit in memory.
+//!
+//! `iter_model_matrix` pulls record batches from a file, an Arrow stream or
+//! any Python iterable of batches, evaluates each batch with the GIL
+//! released, and re-slices the output into chunks of exactly `chunk_rows`
+//! rows (the last chunk may be shorter). The column layout, every
+//! data-dependent constant and the levels of categorical columns are fixed
+//! before the first chunk is produced.
+
+use std::collections::{BTreeSet, HashSet};
+use std::fs::File;
+use std::io::Seek;
+use std::path::{Path, PathBuf};
+use std::sync::Arc;
+
+use arrow::csv::reader::Format;
+use arrow::csv::ReaderBuilder;
+use arrow::ipc::reader::FileReader;
+use arrow::record_batch::RecordBatchReader;
+use numpy::IntoPyArray;
+use parquet::arrow::arrow_reader::ParquetRecordBatchReaderBuilder;
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+use pyo3::types::PyIterator;
+
+use crate::data::{arrow_error, arrow_stream_reader, is_numeric_type, sort_levels, InputColumns, Table};
+use crate::design::{FittedState, Plan, Term};
+use crate::matrix::{state_from_python, to_numpy};
+use crate::parsed::formula_value;
+
+type BatchReader = Box<dyn RecordBatchReader>;
+
+/// Open a Parquet, CSV or Arrow IPC file as a record batch reader
+fn open_path(path: &Path, batch_size: usize) -> PyResult<BatchReader> {
+    let extension = path
+        .extension()
+        .and_then(|e| e.to_str())
+        .unwrap_or_default()
+        .to_ascii_lowercase();
+    let mut file = File::open(path)?;
+    let reader: BatchReader = match extension.as_str() {
+        "parquet" | "pq" => Box::new(
+            ParquetRecordBatchReaderBuilder::try_new(file)
+                .map_err(arrow_error)?
+                .with_batch_size(batch_size)
+                .build()
+                .map_err(arrow_error)?,
+        ),
+        "csv" => {
+            let (schema, _) = Format::default()
+                .with_header(true)
+                .infer_schema(&mut file, Some(1000))
+                .map_err(arrow_error)?;
+            file.rewind()?;
+            Box::new(
+                ReaderBuilder::new(Arc::new(schema))
+                    .with_header(true)
+                    .with_batch_size(batch_size)
+                    .build(file)
+                    .map_err(arrow_error)?,
+            )
+        }
+        "arrow" | "feather" | "ipc" => Box::new(FileReader::try_new(file, None).map_err(arrow_error)?),
+        _ => {
+            return Err(PyValueError::new_err(format!(
+                "unsupported file type '{}': expected .parquet, .csv, .arrow, .feather or .ipc",
+                path.display()
+            )))
+        }
+    };
+    Ok(reader)
+}
+
+/// Where record batches come from
+enum BatchSource {
+    Arrow(BatchReader),
+    /// A Python iterable, with the item taken early to look at its columns
+    Python(Py<PyIterator>, Option<PyObject>),
+}
+
+impl BatchSource {
+    /// Fetch the next batch, or `None` when exhausted
+    fn next_table<'py>(&mut self, py: Python<'py>) -> PyResult<Option<Table<'py>>> {
+        match self {
+            BatchSource::Arrow(reader) => match reader.next() {
+                Some(batch) => Ok(Some(Table::Arrow(vec![batch.map_err(arrow_error)?]))),
+                None => Ok(None),
+            },
+            BatchSource::Python(iterator, peeked) => {
+                let item = match peeked.take() {
+                    Some(item) => item.into_bound(py),
+                    None => match iterator.bind(py).clone().next() {
+                        Some(item) => item?,
+                        None => return Ok(None),
+                    },
+                };
+                Table::new(&item).map(Some)
+            }
+        }
+    }
+
+    /// The `names` that hold labels rather than numbers, judged from the
+    /// schema or from the first batch
+    fn non_numeric<'a>(&mut self, py: Python, names: Vec<&'a str>) -> PyResult<Vec<&'a str>> {
+        match self {
+            // A missing column is reported when the batches are read
+            BatchSource::Arrow(reader) => {
+                let schema = reader.schema();
+                Ok(names
+                    .into_iter()
+                    .filter(|name| {
+                        schema
+                            .field_with_name(name)
+                            .is_ok_and(|field| !is_numeric_type(field.data_type()))
+                    })
+                    .collect())
+            }
+            BatchSource::Python(iterator, peeked) => {
+                if peeked.is_none() {
+                    match iterator.bind(py).clone().next() {
+                        Some(item) => *peeked = Some(item?.unbind()),
+                        None => return Ok(Vec::new()),
+                    }
+                }
+                let Some(item) = peeked else {
+                    return Ok(Vec::new());
+                };
+                let table = Table::new(item.bind(py))?;
+                let mut out = Vec::new();
+                for name in names {
+                    if !table.is_numeric(name)? {
+                        out.push(name);
+                    }
+                }
+                Ok(out)
+            }
+        }
+    }
+}
+
+/// Iterator over fixed-size chunks of a model matrix
+#[pyclass(unsendable, module = "fiasto_py")]
+pub struct ModelMatrixChunks {
+    names: Vec<String>,
+    /// Response terms (when included) followed by the design-matrix terms
+    terms: Vec<Term>,
+    response_count: usize,
+    /// Columns read as float64
+    required: Vec<String>,
+    /// Categorical columns, coded against the levels in `state`
+    factors: Vec<String>,
+    state: FittedState,
+    source: BatchSource,
+    chunk_rows: usize,
+    /// Evaluated rows, one buffer per term; rows before `offset` were already emitted
+    pending: Vec<Vec<f64>>,
+    offset: usize,
+    exhausted: bool,
+}
+
+impl ModelMatrixChunks {
+    fn pending_rows(&self) -> usize {
+        self.pending.first().map_or(0, Vec::len) - self.offset
+    }
+
+    /// Read a batch's float64 columns and the codes of its categorical columns
+    fn read<'py>(&self, table: &Table<'py>) -> PyResult<InputColumns<'py>> {
+        let required: Vec<&str> = self.required.iter().map(String::as_str).collect();
+        let mut inputs = table.numeric(&required, &[])?;
+        for column in &self.factors {
+            let factor = table.factor(column)?.recode(column, &self.state.levels[column])?;
+            inputs.add_codes(column, factor.codes);
+        }
+        Ok(inputs)
+    }
+
+    /// Evaluate one batch and append its rows to the pending buffers
+    fn push(&mut self, py: Python, inputs: InputColumns) -> PyResult<()> {
+        let columns = inputs.column_set()?;
+        let nrows = columns.nrows();
+        let (terms, state) = (&self.terms, &self.state);
+        let values = py
+            .allow_threads(|| {
+                let mut values = vec![0.0; nrows * terms.len()];
+                Plan::fill(terms, state, &columns, 0..nrows, &mut values).map(|_| values)
+            })
+            .map_err(PyValueError::new_err)?;
+        if nrows > 0 {
+            // Drop emitted rows first; fewer than `chunk_rows` rows remain to move
+            for pending in &mut self.pending {
+                pending.drain(..self.offset);
+            }
+            self.offset = 0;
+            for (pending, column) in self.pending.iter_mut().zip(values.chunks(nrows)) {
+                pending.extend_from_slice(column);
+            }
+        }
+        Ok(())
+    }
+
+    /// Copy out the next `nrows` pending rows as a column-major buffer per part
+    fn take(&mut self, nrows: usize) -> (Vec<f64>, Vec<f64>) {
+        let mut response = Vec::with_capacity(nrows * self.response_count);
+        let mut matrix = Vec::with_capacity(nrows * (self.terms.len() - self.response_count));
+        let rows = self.offset..self.offset + nrows;
+        for (index, pending) in self.pending.iter().enumerate() {
+            let head = &pending[rows.clone()];
+            if index < self.response_count {
+                response.extend_from_slice(head);
+            } else {
+                matrix.extend_from_slice(head);
+            }
+        }
+        self.offset += nrows;
+        (response, matrix)
+    }
+}
+
+#[pymethods]
+impl ModelMatrixChunks {
+    /// Names of the model-matrix columns, the same for every chunk
+    #[getter]
+    fn columns(&self) -> Vec<String> {
+        self.names.clone()
+    }
+
+    fn __iter__(slf: PyRef<'_, Self>) -> PyRef<'_, Self> {
+        slf
+    }
+
+    fn __next__(&mut self, py: Python) -> PyResult<Option<PyObject>> {
+        while !self.exhausted && self.pending_rows() < self.chunk_rows {
+            match self.source.next_table(py)? {
+                Some(table) => {
+                    let inputs = self.read(&table)?;
+                    self.push(py, inputs)?
+                }
+                None => self.exhausted = true,
+            }
+        }
+        let nrows = self.pending_rows().min(self.chunk_rows);
+        if nrows == 0 {
+            return Ok(None);
+        }
+        let (response, matrix) = self.take(nrows);
+        let matrix = to_numpy(py, matrix, nrows, self.names.len())?;
+        Ok(Some(match self.response_count {
+            0 => matrix,
+            1 => (response.into_pyarray_bound(py), matrix).into_py(py),
+            n => (to_numpy(py, response, nrows, n)?, matrix).into_py(py),
+        }))
+    }
+}
+
+/// Stream a model matrix in chunks of `chunk_rows` rows
+///
+/// `source` is a path to a Parquet, CSV or Arrow IPC file, an object
+/// implementing `__arrow_c_stream__`, or an iterable whose items are
+/// mappings of columns or Arrow objects. Data-dependent constants and the
+/// levels of categorical columns (non-numeric or wrapped in `factor()`)
+/// come from `state` (see `fit_state`); if it is omitted for a formula that
+/// needs one, a file source is read twice and any other source raises
+/// `ValueError`. Formulas that read no data columns (e.g. `y ~ 1` without
+/// the response) raise `ValueError`. Yields model-matrix chunks, or
+/// `(y, X)` pairs when `include_response` is true.
+#[pyfunction]
+#[pyo3(signature = (formula, source, chunk_rows = 65536, state = None, include_response = false))]
+pub fn iter_model_matrix(
+    py: Python,
+    formula: &Bound<PyAny>,
+    source: &Bound<PyAny>,
+    chunk_rows: usize,
+    state: Option<&Bound<PyAny>>,
+    include_response: bool,
+) -> PyResult<ModelMatrixChunks> {
+    if chunk_rows == 0 {
+        return Err(PyValueError::new_err("chunk_rows must be positive"));
+    }
+    let value = formula_value(formula)?;
+    let plan = Plan::from_parsed(&value).map_err(PyValueError::new_err)?;
+    let mut reads = plan.required_columns();
+    if include_response {
+        if plan.response_terms.is_empty() {
+            return Err(PyValueError::new_err("formula has no response"));
+        }
+        reads.extend(plan.response_columns());
+    }
+    if reads.is_empty() {
+        // Rows are counted from the data columns, so an empty or intercept-only
+        // model would read the whole source and yield nothing
+        return Err(PyValueError::new_err(
+            "formula reads no data columns, so there are no rows to chunk",
+        ));
+    }
+
+    let path = if source.hasattr("__arrow_c_stream__")? {
+        None
+    } else {
+        source.extract::<PathBuf>().ok()
+    };
+    let mut batches = match &path {
+        Some(path) => BatchSource::Arrow(open_path(path, chunk_rows)?),
+        None if source.hasattr("__arrow_c_stream__")? => BatchSource::Arrow(Box::new(arrow_stream_reader(source)?)),
+        None => BatchSource::Python(source.iter()?.unbind(), None),
+    };
+
+    // Categorical columns: factor() columns, columns with fitted levels and
+    // bare columns whose type (from the schema or the first batch) is not numeric
+    let state = state.map(state_from_python).transpose()?;
+    let mut categorical: HashSet<&str> = HashSet::new();
+    categorical.extend(batches.non_numeric(py, plan.required_columns())?);
+    if let Some(state) = &state {
+        for name in plan.required_columns() {
+            if state.levels.contains_key(name) {
+                categorical.insert(name);
+            }
+        }
+    }
+    let factors: Vec<String> = plan
+        .factor_columns(&categorical)
+        .into_iter()
+        .map(str::to_owned)
+        .collect();
+
+    let state = match (state, &path) {
+        (Some(state), _) => {
+            if let Some(column) = factors.iter().find(|column| !state.levels.contains_key(*column)) {
+                return Err(PyValueError::new_err(format!(
+                    "the state has no levels for categorical column '{}'",
+                    column
+                )));
+            }
+            state
+        }
+        (None, _) if !plan.needs_state() && factors.is_empty() => FittedState::default(),
+        (None, Some(path)) => {
+            // First pass: learn the constants and levels from the whole file
+            let mut accumulator = plan.accumulator();
+            let mut levels: Vec<BTreeSet<String>> = vec![BTreeSet::new(); factors.len()];
+            let reader = open_path(path, chunk_rows)?;
+            let schema = reader.schema();
+            for batch in reader {
+                let table = Table::Arrow(vec![batch.map_err(arrow_error)?]);
+                for (column, seen) in factors.iter().zip(&mut levels) {
+                    seen.extend(table.factor(column)?.levels);
+                }
+                let inputs = table.numeric(&accumulator.columns(), &[])?;
+                let columns = inputs.column_set()?;
+                py.allow_threads(|| accumulator.update(&columns))
+                    .map_err(PyValueError::new_err)?;
+            }
+            let mut state = accumulator.finish();
+            for (column, seen) in factors.iter().zip(levels) {
+                let mut labels: Vec<String> = seen.into_iter().collect();
+                if let Ok(field) = schema.field_with_name(column) {
+                    sort_levels(&mut labels, field.data_type());
+                }
+                state.levels.insert(column.clone(), labels);
+            }
+            state
+        }
+        (None, None) => {
+            return Err(PyValueError::new_err(
+                "formula has data-dependent transformations or categorical columns; \
+                 pass state= (see fit_state) or a file path",
+            ))
+        }
+    };
+    let plan = plan.expand(&state.levels).map_err(PyValueError::new_err)?;
+
+    let mut required = plan.required_columns();
+    let mut terms = Vec::new();
+    if include_response {
+        required.extend(plan.response_columns());
+        terms.extend(plan.response_terms.iter().cloned());
+    }
+    let required: Vec<String> = required.into_iter().map(str::to_owned).collect();
+    let response_count = terms.len();
+    terms.extend(plan.terms.iter().cloned());
+    Ok(ModelMatrixChunks {
+        names: plan.names,
+        pending: vec![Vec::new(); terms.len()],
+        offset: 0,
+        terms,
+        response_count,
+        required,
+        factors,
+        state,
+        source: batches,
+        chunk_rows,
+        exhausted: false,
+    })
+}
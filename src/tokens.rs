@@ -0,0 +1,254 @@
+//! Compact, columnar token streams returned by `lex()`.
+//!
+//! Instead of one `{'lexeme', 'token'}` dict per token, a `TokenStream` holds
+//! three flat buffers: one `u8` kind code per token plus the start and end
+//! byte offsets of each token in the original formula. The buffers are
+//! `bytes` objects created once, so `numpy.frombuffer` and `memoryview` can
+//! wrap them without copying.
+
+use std::sync::{RwLock, RwLockReadGuard};
+
+use pyo3::exceptions::PyIndexError;
+use pyo3::prelude::*;
+use pyo3::types::{PyBytes, PyDict, PyList};
+use serde_json::Value;
+
+use crate::{lex_error, stats};
+
+/// Token kinds with fixed codes; the code of a kind is its index here
+const KNOWN_KINDS: &[&str] = &[
+    "ColumnName",
+    "Tilde",
+    "Plus",
+    "Minus",
+    "One",
+    "Zero",
+    "InteractionAndEffect",
+    "InteractionOnly",
+    "FunctionStart",
+    "FunctionEnd",
+    "Pipe",
+    "DoublePipe",
+    "Comma",
+    "Integer",
+];
+
+/// Kinds reported by fiasto that are not in `KNOWN_KINDS`, in first-seen order
+static EXTRA_KINDS: RwLock<Vec<String>> = RwLock::new(Vec::new());
+
+fn extra_kinds() -> RwLockReadGuard<'static, Vec<String>> {
+    EXTRA_KINDS.read().unwrap_or_else(|e| e.into_inner())
+}
+
+/// Return the code for a token kind, registering kinds not seen before
+fn kind_code(kind: &str) -> Result<u8, String> {
+    if let Some(code) = KNOWN_KINDS.iter().position(|k| *k == kind) {
+        return Ok(code as u8);
+    }
+    if let Some(index) = extra_kinds().iter().position(|k| k == kind) {
+        return code_for_extra(kind, index);
+    }
+    // Another thread may have registered the kind since the read lock was released
+    let mut extra = EXTRA_KINDS.write().unwrap_or_else(|e| e.into_inner());
+    let index = match extra.iter().position(|k| k == kind) {
+        Some(index) => index,
+        None => {
+            extra.push(kind.to_owned());
+            extra.len() - 1
+        }
+    };
+    code_for_extra(kind, index)
+}
+
+fn code_for_extra(kind: &str, index: usize) -> Result<u8, String> {
+    u8::try_from(KNOWN_KINDS.len() + index).map_err(|_| format!("too many token kinds to encode {kind}"))
+}
+
+/// Return the kind name for a code
+pub(crate) fn kind_name(code: u8) -> String {
+    let code = code as usize;
+    match KNOWN_KINDS.get(code) {
+        Some(kind) => (*kind).to_owned(),
+        None => extra_kinds()[code - KNOWN_KINDS.len()].clone(),
+    }
+}
+
+/// Names of all token kinds, indexed by the codes used in `TokenStream.kinds`
+///
+/// Codes of the common kinds are fixed; kinds outside that set get codes in
+/// first-seen order within the process, so always map codes through this table.
+#[pyfunction]
+pub fn token_kinds() -> Vec<String> {
+    KNOWN_KINDS
+        .iter()
+        .map(|kind| (*kind).to_owned())
+        .chain(extra_kinds().iter().cloned())
+        .collect()
+}
+
+/// Pack `u32` values into a bytes object in native byte order
+fn u32_bytes<'py>(py: Python<'py>, values: &[u32]) -> PyResult<Bound<'py, PyBytes>> {
+    PyBytes::new_bound_with(py, values.len() * 4, |buf| {
+        for (chunk, value) in buf.chunks_exact_mut(4).zip(values) {
+            chunk.copy_from_slice(&value.to_ne_bytes());
+        }
+        Ok(())
+    })
+}
+
+/// Read a `u32` written by `u32_bytes`
+fn read_u32(bytes: &[u8], index: usize) -> u32 {
+    let start = index * 4;
+    u32::from_ne_bytes(bytes[start..start + 4].try_into().unwrap())
+}
+
+/// Kind codes and byte offsets computed from fiasto's lex output
+pub(crate) struct Tokens {
+    pub(crate) kinds: Vec<u8>,
+    pub(crate) starts: Vec<u32>,
+    pub(crate) ends: Vec<u32>,
+}
+
+impl Tokens {
+    /// Encode fiasto's `[{'lexeme', 'token'}, ...]` output, locating each
+    /// lexeme in `formula` after the end of the previous one
+    ///
+    /// Every span lies on character boundaries of `formula`.
+    pub(crate) fn from_lexed(formula: &str, lexed: &Value) -> Result<Tokens, String> {
+        let items = lexed.as_array().map(Vec::as_slice).unwrap_or_default();
+        let mut tokens = Tokens {
+            kinds: Vec::with_capacity(items.len()),
+            starts: Vec::with_capacity(items.len()),
+            ends: Vec::with_capacity(items.len()),
+        };
+        let mut cursor = 0;
+        for item in items {
+            let lexeme = item["lexeme"].as_str().unwrap_or_default();
+            let start = formula[cursor..]
+                .find(lexeme)
+                .map_or(cursor, |offset| cursor + offset);
+            // A lexeme fiasto rewrote is not found verbatim and gets a
+            // best-effort span at the cursor, kept inside the formula and on
+            // a character boundary so slicing with it cannot panic
+            let mut end = (start + lexeme.len()).min(formula.len());
+            while !formula.is_char_boundary(end) {
+                end -= 1;
+            }
+            tokens.kinds.push(kind_code(item["token"].as_str().unwrap_or_default())?);
+            tokens.starts.push(start as u32);
+            tokens.ends.push(end as u32);
+            cursor = end;
+        }
+        Ok(tokens)
+    }
+}
+
+/// Lex `formula` with fiasto into its `[{'lexeme', 'token'}, ...]` value
+pub(crate) fn lex_value(formula: &str) -> Result<Value, String> {
+    stats::LEX
+        .time(|| fiasto::lex_formula(formula))
+        .map_err(|e| e.to_string())
+}
+
+/// Lex `formula` into kind codes and byte offsets
+pub(crate) fn lex_tokens(formula: &str) -> Result<Tokens, String> {
+    let lexed = lex_value(formula)?;
+    Tokens::from_lexed(formula, &lexed)
+}
+
+/// A lexed formula stored as flat buffers of kind codes and byte offsets
+#[pyclass(frozen, module = "fiasto_py")]
+pub struct TokenStream {
+    formula: String,
+    kinds: Py<PyBytes>,
+    starts: Py<PyBytes>,
+    ends: Py<PyBytes>,
+}
+
+impl TokenStream {
+    pub(crate) fn new(py: Python, formula: String, tokens: &Tokens) -> PyResult<Self> {
+        Ok(TokenStream {
+            formula,
+            kinds: PyBytes::new_bound(py, &tokens.kinds).unbind(),
+            starts: u32_bytes(py, &tokens.starts)?.unbind(),
+            ends: u32_bytes(py, &tokens.ends)?.unbind(),
+        })
+    }
+
+    /// Byte span of token `index` in the formula
+    fn span(&self, py: Python, index: usize) -> PyResult<(usize, usize)> {
+        if index >= self.kinds.bind(py).as_bytes().len() {
+            return Err(PyIndexError::new_err("token index out of range"));
+        }
+        Ok((
+            read_u32(self.starts.bind(py).as_bytes(), index) as usize,
+            read_u32(self.ends.bind(py).as_bytes(), index) as usize,
+        ))
+    }
+}
+
+#[pymethods]
+impl TokenStream {
+    /// The formula string that was lexed
+    #[getter]
+    fn formula(&self) -> &str {
+        &self.formula
+    }
+
+    /// One `u8` kind code per token; see `token_kinds()` for the names
+    #[getter]
+    fn kinds(&self, py: Python) -> Py<PyBytes> {
+        self.kinds.clone_ref(py)
+    }
+
+    /// Start byte offset of each token, as native-endian `uint32`
+    #[getter]
+    fn starts(&self, py: Python) -> Py<PyBytes> {
+        self.starts.clone_ref(py)
+    }
+
+    /// End byte offset (exclusive) of each token, as native-endian `uint32`
+    #[getter]
+    fn ends(&self, py: Python) -> Py<PyBytes> {
+        self.ends.clone_ref(py)
+    }
+
+    /// The source text of token `index`
+    fn lexeme(&self, py: Python, index: usize) -> PyResult<&str> {
+        let (start, end) = self.span(py, index)?;
+        Ok(&self.formula[start..end])
+    }
+
+    /// The kind name of token `index`
+    fn kind(&self, py: Python, index: usize) -> PyResult<String> {
+        self.span(py, index)?;
+        Ok(kind_name(self.kinds.bind(py).as_bytes()[index]))
+    }
+
+    /// Build the list of `{'lexeme', 'token'}` dicts returned by `lex_formula()`
+    fn to_list(&self, py: Python) -> PyResult<PyObject> {
+        let py_list = PyList::empty_bound(py);
+        for index in 0..self.__len__(py) {
+            let token = PyDict::new_bound(py);
+            token.set_item("lexeme", self.lexeme(py, index)?)?;
+            token.set_item("token", self.kind(py, index)?)?;
+            py_list.append(token)?;
+        }
+        Ok(py_list.into())
+    }
+
+    fn __len__(&self, py: Python) -> usize {
+        self.kinds.bind(py).as_bytes().len()
+    }
+
+    fn __repr__(&self, py: Python) -> String {
+        format!("TokenStream({:?}, tokens={})", self.formula, self.__len__(py))
+    }
+}
+
+/// Tokenize a formula string into a compact `TokenStream`
+#[pyfunction]
+pub fn lex(py: Python, formula: &str) -> PyResult<TokenStream> {
+    let tokens = lex_tokens(formula).map_err(|e| lex_error(formula, e))?;
+    TokenStream::new(py, formula.to_owned(), &tokens)
+}
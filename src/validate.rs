@@ -0,0 +1,48 @@
+//! Syntax checks that skip building Python results.
+//!
+//! `validate` lexes and parses a formula and drops the result without
+//! converting it to Python objects or storing it in the parse cache. fiasto
+//! has no parse-only entry point, so the Rust-side parse, including building
+//! its result value, still runs: what is saved is the conversion to Python
+//! objects, usually the larger part of a `parse_formula` call. Failures are
+//! reported as `FormulaParseError` instances, whose location is only worked
+//! out when it is read.
+
+use pyo3::prelude::*;
+use pyo3::types::PyList;
+
+use crate::batch::run_batch;
+use crate::errors::check;
+use crate::parse_error;
+
+/// Check that a formula lexes and parses, without building the parse result
+///
+/// Returns `None` for a valid formula. Otherwise returns (without raising)
+/// the `FormulaParseError` that `parse_formula()` would raise, with its
+/// `span`, `char_span`, `token` and `expected` attributes. The formula is
+/// fully parsed in Rust, but nothing is converted to Python objects or
+/// cached.
+#[pyfunction]
+pub fn validate(py: Python, formula: &str) -> Option<PyObject> {
+    let reason = py.allow_threads(|| check(formula)).err()?;
+    Some(parse_error(formula, reason).into_value(py).into_any())
+}
+
+/// Validate many formulas with the GIL released
+///
+/// Returns a list in input order holding `None` for each valid formula and a
+/// `FormulaParseError` instance for each invalid one.
+#[pyfunction]
+#[pyo3(signature = (formulas, parallel = true))]
+pub fn validate_many(py: Python, formulas: Vec<String>, parallel: bool) -> PyResult<PyObject> {
+    let results = run_batch(py, &formulas, parallel, check);
+    let items: Vec<PyObject> = results
+        .into_iter()
+        .zip(&formulas)
+        .map(|(result, formula)| match result {
+            Ok(()) => py.None(),
+            Err(reason) => parse_error(formula, reason).into_value(py).into_any(),
+        })
+        .collect();
+    Ok(PyList::new_bound(py, items).into())
+}
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for fiasto-py asyncio entry points
+"""
+
+import asyncio
+
+import pytest
+import fiasto_py
+
+
+class TestAsyncParse:
+    """Test aparse_formula and aparse_formulas"""
+
+    def test_aparse_formula(self):
+        """Test that awaiting gives the parse_formula result"""
+        async def main():
+            return await fiasto_py.aparse_formula("y ~ x1*x2 + (1|group)")
+
+        result = asyncio.run(main())
+        assert result == fiasto_py.parse_formula("y ~ x1*x2 + (1|group)")
+
+    def test_aparse_formula_error(self):
+        """Test that invalid formulas raise ValueError when awaited"""
+        async def main():
+            return await fiasto_py.aparse_formula("y x1*x2")
+
+        with pytest.raises(ValueError, match="Formula parsing error"):
+            asyncio.run(main())
+
+    def test_concurrent_calls(self):
+        """Test many concurrent awaits with gather"""
+        formulas = [f"y ~ x{i} + x{i + 1}" for i in range(50)]
+
+        async def main():
+            return await asyncio.gather(*(fiasto_py.aparse_formula(f) for f in formulas))
+
+        results = asyncio.run(main())
+        assert [r['formula'] for r in results] == formulas
+
+    @pytest.mark.parametrize("parallel", [True, False])
+    def test_aparse_formulas(self, parallel):
+        """Test the batch form, including per-item errors"""
+        formulas = ["y ~ x1 + x2", "y x1*x2", "y ~ x1*x2"]
+
+        async def main():
+            return await fiasto_py.aparse_formulas(formulas, parallel=parallel)
+
+        results = asyncio.run(main())
+
+        assert results[0] == fiasto_py.parse_formula("y ~ x1 + x2")
+        assert isinstance(results[1], ValueError)
+        assert results[2] == fiasto_py.parse_formula("y ~ x1*x2")
+
+    def test_cancelled_future(self):
+        """Test that cancelling before completion is harmless"""
+        async def main():
+            future = fiasto_py.aparse_formula("y ~ x")
+            future.cancel()
+            await asyncio.sleep(0.05)
+            return await fiasto_py.aparse_formula("y ~ x")
+
+        assert asyncio.run(main())['formula'] == "y ~ x"
+
+    def test_requires_running_loop(self):
+        """Test that calling outside an event loop raises RuntimeError"""
+        with pytest.raises(RuntimeError):
+            fiasto_py.aparse_formula("y ~ x")
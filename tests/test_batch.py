@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for the fiasto-py batch parse and lex functions
+"""
+
+import pytest
+import fiasto_py
+
+
+class TestBatch:
+    """Test parse_formulas and lex_formulas"""
+
+    def test_parse_formulas_matches_single(self):
+        """Test that batch results equal parse_formula results, in order"""
+        formulas = ["y ~ x1 + x2", "y ~ x1*x2", "mpg ~ wt + cyl + (1|gear)"]
+        results = fiasto_py.parse_formulas(formulas)
+
+        assert len(results) == len(formulas)
+        for formula, result in zip(formulas, results):
+            assert result == fiasto_py.parse_formula(formula)
+
+    def test_parse_formulas_sequential(self):
+        """Test that parallel and sequential batches agree"""
+        formulas = [f"y ~ x{i} + z{i}" for i in range(50)]
+        assert fiasto_py.parse_formulas(formulas, parallel=False) == fiasto_py.parse_formulas(formulas)
+
+    def test_parse_formulas_error_entries(self):
+        """Test that a bad formula yields a ValueError entry without aborting the batch"""
+        results = fiasto_py.parse_formulas(["y ~ x1", "y x1*x2", "y ~ x2"])
+
+        assert results[0]['formula'] == "y ~ x1"
+        assert isinstance(results[1], ValueError)
+        assert "Formula parsing error" in str(results[1])
+        assert results[2]['formula'] == "y ~ x2"
+
+    def test_parse_formulas_empty(self):
+        """Test that an empty batch returns an empty list"""
+        assert fiasto_py.parse_formulas([]) == []
+
+    def test_lex_formulas_matches_single(self):
+        """Test that batch lexing equals lex_formula results"""
+        formulas = ["y ~ x1*x2*x3", "y ~ x1 + (1|group)"]
+        results = fiasto_py.lex_formulas(formulas)
+
+        assert results == [fiasto_py.lex_formula(f) for f in formulas]
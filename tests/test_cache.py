@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for the fiasto-py parse cache
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+import fiasto_py
+
+
+@pytest.fixture
+def cache():
+    """Enable a small cache for one test and disable it afterwards"""
+    fiasto_py.configure_cache(maxsize=2)
+    fiasto_py.cache_clear()
+    yield
+    fiasto_py.configure_cache(maxsize=0)
+    fiasto_py.cache_clear()
+
+
+class TestParseCache:
+    """Test configure_cache, cache_info and cache_clear"""
+
+    def test_disabled_by_default(self):
+        """Test that the cache records nothing unless enabled"""
+        fiasto_py.parse_formula("y ~ x1")
+        info = fiasto_py.cache_info()
+        assert info.maxsize == 0
+        assert info.currsize == 0
+
+    def test_hits_and_misses(self, cache):
+        """Test that repeated formulas are served from the cache"""
+        first = fiasto_py.parse_formula("y ~ x1 + x2")
+        second = fiasto_py.parse_formula("y ~ x1 + x2")
+
+        assert first == second
+        info = fiasto_py.cache_info()
+        assert (info.hits, info.misses, info.maxsize, info.currsize) == (1, 1, 2, 1)
+
+    def test_results_are_copies(self, cache):
+        """Test that mutating a returned dict does not affect the cache"""
+        first = fiasto_py.parse_formula("y ~ x1")
+        first['columns'].clear()
+
+        assert 'x1' in fiasto_py.parse_formula("y ~ x1")['columns']
+
+    def test_lru_eviction(self, cache):
+        """Test that the least recently used formula is evicted"""
+        fiasto_py.parse_formula("y ~ a")
+        fiasto_py.parse_formula("y ~ b")
+        fiasto_py.parse_formula("y ~ a")
+        fiasto_py.parse_formula("y ~ c")  # evicts "y ~ b"
+        fiasto_py.parse_formula("y ~ a")
+
+        info = fiasto_py.cache_info()
+        assert info.currsize == 2
+        assert info.hits == 2
+
+    def test_errors_not_cached(self, cache):
+        """Test that invalid formulas still raise and are not stored"""
+        with pytest.raises(ValueError):
+            fiasto_py.parse_formula("y x1")
+        assert fiasto_py.cache_info().currsize == 0
+
+    def test_cache_clear(self, cache):
+        """Test that cache_clear drops entries and resets statistics"""
+        fiasto_py.parse_formula("y ~ x1")
+        fiasto_py.parse_formula("y ~ x1")
+        fiasto_py.cache_clear()
+
+        info = fiasto_py.cache_info()
+        assert (info.hits, info.misses, info.currsize) == (0, 0, 0)
+
+
+@pytest.fixture
+def disk_cache(tmp_path):
+    """Point the disk cache at a temporary directory for one test"""
+    previous = fiasto_py.disk_cache_path()
+    fiasto_py.configure_disk_cache(tmp_path)
+    yield tmp_path
+    fiasto_py.configure_disk_cache(previous)
+
+
+def parse_in_subprocess(directory, formula):
+    """Parse `formula` in a fresh process using the disk cache at `directory`"""
+    code = "import sys, fiasto_py; fiasto_py.parse_formula(sys.argv[1])"
+    env = dict(os.environ, FIASTO_PY_CACHE_DIR=str(directory))
+    subprocess.run([sys.executable, "-c", code, formula], env=env, check=True)
+
+
+class TestDiskCache:
+    """Test configure_disk_cache, disk_cache_path and disk_cache_clear"""
+
+    def test_writes_one_entry_per_formula(self, disk_cache):
+        """Test that parsing stores one entry per distinct formula"""
+        fiasto_py.parse_formula("y ~ x1 + x2")
+        fiasto_py.parse_formula("y ~ x1 + x2")
+        fiasto_py.parse_formula("y ~ x1*x2")
+
+        assert str(fiasto_py.disk_cache_path()) == str(disk_cache)
+        assert len(list(disk_cache.glob("*.fpc"))) == 2
+        assert not list(disk_cache.glob("*.tmp"))
+
+    def test_entries_are_reused(self, disk_cache):
+        """Test that cached results equal fresh parse results"""
+        expected = fiasto_py.parse_formula("y ~ x1*x2 + (1|group)")
+        assert fiasto_py.parse_formula("y ~ x1*x2 + (1|group)") == expected
+
+    def test_shared_between_processes(self, disk_cache):
+        """Test that an entry written by another process is read here"""
+        parse_in_subprocess(disk_cache, "y ~ x1 + log(x2)")
+        assert len(list(disk_cache.glob("*.fpc"))) == 1
+
+        fiasto_py.reset_stats()
+        assert fiasto_py.parse_formula("y ~ x1 + log(x2)")['formula'] == "y ~ x1 + log(x2)"
+        assert len(list(disk_cache.glob("*.fpc"))) == 1
+        disk = fiasto_py.stats()['disk_cache']
+        assert disk['hits'] == 1
+        assert disk['writes'] == 0
+
+    def test_clear(self, disk_cache):
+        """Test that disk_cache_clear removes every entry"""
+        fiasto_py.parse_formula("y ~ x1")
+        fiasto_py.parse_formula("y ~ x2")
+
+        assert fiasto_py.disk_cache_clear() == 2
+        assert not list(disk_cache.glob("*.fpc"))
+
+    def test_disable(self, disk_cache):
+        """Test that None disables the disk cache"""
+        fiasto_py.configure_disk_cache(None)
+        fiasto_py.parse_formula("y ~ x1")
+
+        assert fiasto_py.disk_cache_path() is None
+        assert not list(disk_cache.glob("*.fpc"))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for fiasto-py canonical forms and formula hashing
+"""
+
+import pytest
+import fiasto_py
+
+
+class TestCanonicalize:
+    """Test canonicalize"""
+
+    @pytest.mark.parametrize("a, b", [
+        ("y ~ a*b", "y ~ b + a + a:b"),
+        ("y ~ a + b", "y ~ b + a"),
+        ("y ~ a*b*c", "y ~ c*b*a"),
+        ("y ~ x + (1 + x | g)", "y ~ (1 + x | g) + x"),
+    ])
+    def test_equivalent_formulas(self, a, b):
+        """Test that formulas for the same model share a canonical form"""
+        assert fiasto_py.canonicalize(a) == fiasto_py.canonicalize(b)
+
+    @pytest.mark.parametrize("a, b", [
+        ("y ~ a + b", "y ~ a*b"),
+        ("y ~ a + b", "y ~ a + b - 1"),
+        ("y ~ a", "z ~ a"),
+        ("y ~ a + (1 | g)", "y ~ a + (1 | h)"),
+        ("y ~ lag(x, 1)", "y ~ lag(x, 2)"),
+        ("y ~ poly(x, 2)", "y ~ poly(x, 3)"),
+    ])
+    def test_different_formulas(self, a, b):
+        """Test that different models have different canonical forms"""
+        assert fiasto_py.canonicalize(a) != fiasto_py.canonicalize(b)
+
+    def test_sorted_by_order(self):
+        """Test that main effects come before interactions"""
+        assert fiasto_py.canonicalize("y ~ b*a") == "y ~ a + b + a:b"
+
+    def test_canonical_form_parses(self):
+        """Test that the canonical form is itself a formula with the same form"""
+        canonical = fiasto_py.canonicalize("y ~ x2*x1 + log(z) + (1 | g)")
+        assert fiasto_py.canonicalize(canonical) == canonical
+
+    def test_no_intercept(self):
+        """Test that a removed intercept is written as 0"""
+        assert fiasto_py.canonicalize("y ~ a - 1").startswith("y ~ 0 + ")
+
+    def test_accepts_parsed_formula(self):
+        """Test that ParsedFormula objects are accepted"""
+        assert fiasto_py.canonicalize(fiasto_py.parse("y ~ b + a")) == "y ~ a + b"
+
+
+class TestFormulaHash:
+    """Test formula_hash and the batch functions"""
+
+    def test_equivalent_formulas_hash_equal(self):
+        """Test that equivalent formulas hash equally"""
+        assert fiasto_py.formula_hash("y ~ a*b") == fiasto_py.formula_hash("y ~ b + a + a:b")
+        assert fiasto_py.formula_hash("y ~ a*b") != fiasto_py.formula_hash("y ~ a + b")
+
+    def test_bits(self):
+        """Test 64- and 128-bit hashes"""
+        assert 0 <= fiasto_py.formula_hash("y ~ a") < 2 ** 64
+        assert 0 <= fiasto_py.formula_hash("y ~ a", bits=128) < 2 ** 128
+        with pytest.raises(ValueError):
+            fiasto_py.formula_hash("y ~ a", bits=32)
+
+    def test_stable_value(self):
+        """Test that the hash is FNV-1a of the canonical form"""
+        canonical = fiasto_py.canonicalize("y ~ a").encode()
+        expected = 0xcbf29ce484222325
+        for byte in canonical:
+            expected = ((expected ^ byte) * 0x100000001b3) % 2 ** 64
+        assert fiasto_py.formula_hash("y ~ a") == expected
+
+    def test_batch(self):
+        """Test canonicalize_formulas and formula_hashes with per-item errors"""
+        formulas = ["y ~ a*b", "y x1*x2", "y ~ b + a + a:b"]
+        canonical = fiasto_py.canonicalize_formulas(formulas)
+        hashes = fiasto_py.formula_hashes(formulas, bits=128)
+
+        assert canonical[0] == canonical[2]
+        assert isinstance(canonical[1], ValueError)
+        assert hashes[0] == hashes[2] == fiasto_py.formula_hash("y ~ a*b", bits=128)
+        assert isinstance(hashes[1], ValueError)
+
+    def test_unique_formulas(self):
+        """Test deduplication keeps the first of each model and skips invalid formulas"""
+        formulas = ["y ~ a*b", "y ~ a + b", "y x1*x2", "y ~ b*a", "y ~ b + a"]
+        assert fiasto_py.unique_formulas(formulas) == [0, 1]
+
+    def test_transform_arguments_kept(self):
+        """Test that formulas differing only in transformation arguments are not merged"""
+        formulas = ["y ~ lag(x, 1)", "y ~ lag(x, 2)", "y ~ lag(x, 1)"]
+        assert fiasto_py.formula_hash(formulas[0]) != fiasto_py.formula_hash(formulas[1])
+        assert fiasto_py.unique_formulas(formulas) == [0, 1]
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for fiasto-py compiled formulas
+"""
+
+import pickle
+
+import pytest
+import fiasto_py
+
+np = pytest.importorskip("numpy")
+
+
+@pytest.fixture
+def data():
+    """Random columnar data"""
+    rng = np.random.default_rng(0)
+    return {name: rng.normal(size=40) + 2.0 for name in ["y", "x1", "x2"]}
+
+
+class TestCompiledFormula:
+    """Test compile and CompiledFormula"""
+
+    def test_matches_model_matrix(self, data):
+        """Test that transform agrees with model_matrix"""
+        compiled = fiasto_py.compile("y ~ x1*x2 + log(x1)")
+        X, names = fiasto_py.model_matrix("y ~ x1*x2 + log(x1)", data)
+
+        assert compiled.columns == names
+        assert compiled.response == ['y']
+        np.testing.assert_allclose(compiled.transform(data), X)
+
+    def test_include_response(self, data):
+        """Test that include_response returns (y, X)"""
+        y, X = fiasto_py.compile("y ~ x1").transform(data, include_response=True)
+
+        np.testing.assert_array_equal(y, data['y'])
+        assert X.shape == (40, 2)
+
+    def test_fit_reuses_state(self, data):
+        """Test that a fitted formula applies the learned constants to new data"""
+        compiled = fiasto_py.compile("y ~ scale(x1)")
+        assert not compiled.is_fitted
+        with pytest.raises(ValueError):
+            compiled.transform(data)
+
+        fitted = compiled.fit(data)
+        assert fitted.is_fitted
+        assert not compiled.is_fitted
+        part = {k: v[:10] for k, v in data.items()}
+        X = fitted.transform(part)
+        expected, _ = fiasto_py.model_matrix("y ~ scale(x1)", part, state=fitted.state)
+        np.testing.assert_allclose(X, expected)
+
+    def test_compile_with_data(self, data):
+        """Test that compile(formula, data) fits immediately"""
+        compiled = fiasto_py.compile("y ~ poly(x1, 2)", data)
+        assert compiled.state == fiasto_py.fit_state("y ~ poly(x1, 2)", data)
+
+    def test_pickle_roundtrip(self, data):
+        """Test that compiled formulas survive pickling with their state"""
+        fitted = fiasto_py.compile("y ~ center(x1) + x2", data)
+        restored = pickle.loads(pickle.dumps(fitted))
+
+        assert restored.formula == fitted.formula
+        assert restored.columns == fitted.columns
+        assert restored.state == fitted.state
+        np.testing.assert_array_equal(restored.transform(data), fitted.transform(data))
+
+    def test_categorical_levels(self, data):
+        """Test that fit learns categorical levels and pickling keeps them"""
+        data = dict(data, g=np.array(["b", "a", "c", "a"] * 10))
+        compiled = fiasto_py.compile("y ~ x1 + g")
+        assert compiled.columns == ["intercept", "x1", "g"]
+
+        fitted = compiled.fit(data)
+        assert fitted.columns == ["intercept", "x1", "g[b]", "g[c]"]
+        assert fitted.state['factor(g)'] == ["a", "b", "c"]
+        X, _ = fiasto_py.model_matrix("y ~ x1 + g", data)
+        np.testing.assert_array_equal(fitted.transform(data), X)
+
+        part = {name: values[:2] for name, values in data.items()}
+        restored = pickle.loads(pickle.dumps(fitted))
+        assert restored.columns == fitted.columns
+        np.testing.assert_array_equal(restored.transform(part), X[:2])
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for fiasto-py FormulaError exceptions
+"""
+
+import pickle
+
+import pytest
+import fiasto_py
+
+
+INVALID = "y x1*x2"
+
+
+class TestFormulaError:
+    """Test the FormulaError hierarchy"""
+
+    def test_hierarchy(self):
+        """Test that both errors are FormulaErrors and ValueErrors"""
+        for cls in (fiasto_py.FormulaParseError, fiasto_py.FormulaLexError):
+            assert issubclass(cls, fiasto_py.FormulaError)
+        assert issubclass(fiasto_py.FormulaError, ValueError)
+
+    def test_parse_formula_raises(self):
+        """Test that parse_formula raises FormulaParseError with its attributes"""
+        with pytest.raises(fiasto_py.FormulaParseError) as excinfo:
+            fiasto_py.parse_formula(INVALID)
+        error = excinfo.value
+        assert error.formula == INVALID
+        assert error.kind == "parse"
+        assert str(error) == f"Formula parsing error: {error.reason}"
+        assert isinstance(error.expected, list)
+
+    def test_location_of_unexpected_token(self):
+        """Test the span, token and expected kinds of a token that cannot follow the previous one"""
+        error = fiasto_py.validate(INVALID)
+        assert error.span == (2, 4)
+        assert error.char_span == (2, 4)
+        assert error.token == "x1"
+        assert "Tilde" in error.expected
+
+    def test_location_at_end(self):
+        """Test that a formula ending in an operator fails at its end, expecting an operand"""
+        error = fiasto_py.validate("y ~ x +")
+        assert error.span == (7, 7)
+        assert error.token is None
+        assert "ColumnName" in error.expected
+
+    def test_location_of_unlexable_character(self):
+        """Test that a lexing failure points at the character the lexer rejects"""
+        error = fiasto_py.FormulaLexError("y ~ x $", "unexpected character")
+        assert error.span == (6, 7)
+        assert error.token == "$"
+        assert error.expected == []
+
+    def test_char_span_after_non_ascii(self):
+        """Test that character offsets account for multi-byte characters"""
+        error = fiasto_py.validate("y ~ größe +* x")
+        assert error.span == (13, 14)
+        assert error.char_span == (11, 12)
+        assert error.token == "*"
+
+    def test_batch_slots(self):
+        """Test that batch functions place FormulaParseError instances in failing slots"""
+        results = fiasto_py.parse_formulas(["y ~ x", INVALID])
+        assert isinstance(results[1], fiasto_py.FormulaParseError)
+        assert results[1].formula == INVALID
+
+    def test_lex_error_message(self):
+        """Test that FormulaLexError formats a lexing message"""
+        error = fiasto_py.FormulaLexError("y ~ x $", "unexpected character")
+        assert error.kind == "lex"
+        assert str(error) == "Formula lexing error: unexpected character"
+
+    def test_pickle(self):
+        """Test that errors survive pickling"""
+        error = fiasto_py.validate(INVALID)
+        restored = pickle.loads(pickle.dumps(error))
+        assert type(restored) is fiasto_py.FormulaParseError
+        assert str(restored) == str(error)
+        assert restored.formula == INVALID
+
+    def test_invalid_kind(self):
+        """Test that constructing a FormulaError with an unknown kind raises"""
+        with pytest.raises(ValueError):
+            fiasto_py.FormulaError("y ~ x", "reason", kind="bogus")
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for fiasto-py fused transformation evaluation
+"""
+
+import array
+
+import pytest
+import fiasto_py
+
+np = pytest.importorskip("numpy")
+
+
+@pytest.fixture
+def data():
+    """Positive random columns"""
+    rng = np.random.default_rng(0)
+    return {name: rng.uniform(1.0, 5.0, size=100) for name in ["y", "x", "z", "w"]}
+
+
+class TestEvaluateTransformations:
+    """Test evaluate_transformations"""
+
+    def test_generated_columns(self, data):
+        """Test that every transformation output is written in formula order"""
+        out, names = fiasto_py.evaluate_transformations("y ~ log(x) + poly(z, 2) + w", data)
+
+        generated = fiasto_py.parse_formula("y ~ log(x) + poly(z, 2) + w")['all_generated_columns']
+        assert names == [n for n in generated if n in names]
+        assert len(names) == 3
+        assert out.shape == (100, 3)
+        np.testing.assert_allclose(out[:, 0], np.log(data['x']))
+
+    def test_matches_model_matrix(self, data):
+        """Test that values agree with the model matrix columns"""
+        formula = "y ~ log(x) + scale(z) + poly(w, 3)"
+        out, names = fiasto_py.evaluate_transformations(formula, data)
+        X, columns = fiasto_py.model_matrix(formula, data)
+
+        for i, name in enumerate(names):
+            np.testing.assert_allclose(out[:, i], X[:, columns.index(name)])
+
+    def test_spline(self, data):
+        """Test that a spline smooth is written as its basis columns"""
+        formula = "y ~ log(x) + s(z)"
+        out, names = fiasto_py.evaluate_transformations(formula, data)
+        X, columns = fiasto_py.model_matrix(formula, data)
+
+        assert names[1:] == [f"z_s_{i}" for i in range(1, 10)]
+        assert out.shape == (100, 10)
+        for i, name in enumerate(names):
+            np.testing.assert_allclose(out[:, i], X[:, columns.index(name)])
+
+    @pytest.mark.parametrize("order", ["C", "F"])
+    @pytest.mark.parametrize("parallel", ["auto", "rows", "columns", None])
+    def test_out_buffer(self, order, parallel):
+        """Test writing into a preallocated array in either layout"""
+        rng = np.random.default_rng(1)
+        big = {"y": rng.normal(size=50_000), "x": rng.uniform(1, 2, size=50_000)}
+        formula = "y ~ log(x) + sqrt(x) + exp(x)"
+        expected, names = fiasto_py.evaluate_transformations(formula, big, parallel=None)
+        out = np.empty((50_000, len(names)), order=order)
+
+        result, _ = fiasto_py.evaluate_transformations(formula, big, out=out, parallel=parallel)
+        assert result is out
+        np.testing.assert_allclose(out, expected)
+
+    def test_strided_out(self, data):
+        """Test writing into a non-contiguous view"""
+        backing = np.zeros((100, 4))
+        fiasto_py.evaluate_transformations("y ~ log(x) + sqrt(z)", data, out=backing[:, ::2])
+
+        np.testing.assert_allclose(backing[:, 0], np.log(data['x']))
+        np.testing.assert_allclose(backing[:, 2], np.sqrt(data['z']))
+        np.testing.assert_array_equal(backing[:, 1], 0.0)
+
+    def test_buffer_inputs(self):
+        """Test that buffer-protocol inputs are accepted"""
+        data = {"y": array.array("d", [1.0, 2.0]), "x": array.array("d", [1.0, 4.0])}
+        out, _ = fiasto_py.evaluate_transformations("y ~ sqrt(x)", data)
+        np.testing.assert_allclose(out[:, 0], [1.0, 2.0])
+
+    def test_state(self, data):
+        """Test that a supplied state is used instead of fitting"""
+        state = {"center(x)": [1.0]}
+        out, _ = fiasto_py.evaluate_transformations("y ~ center(x)", data, state=state)
+        np.testing.assert_allclose(out[:, 0], data['x'] - 1.0)
+
+    def test_bad_out_shape(self, data):
+        """Test that a wrongly shaped out raises ValueError"""
+        with pytest.raises(ValueError):
+            fiasto_py.evaluate_transformations("y ~ log(x)", data, out=np.empty((100, 2)))
+
+    def test_bad_parallel(self, data):
+        """Test that unknown parallel modes raise ValueError"""
+        with pytest.raises(ValueError):
+            fiasto_py.evaluate_transformations("y ~ log(x)", data, parallel="diagonal")
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for fiasto-py incremental re-parsing
+"""
+
+import pytest
+import fiasto_py
+
+
+def apply_edits(formula, edits):
+    """Apply (offset, deleted, inserted) edits one after another"""
+    current = fiasto_py.parse_incremental(formula)
+    for offset, deleted, inserted in edits:
+        current, _ = current.edit(offset, deleted, inserted)
+    return current
+
+
+class TestIncrementalFormula:
+    """Test parse_incremental and IncrementalFormula.edit"""
+
+    def test_initial_parse(self):
+        """Test that the session starts from a full parse"""
+        current = fiasto_py.parse_incremental("y ~ x1 + x2")
+
+        assert current.is_valid
+        assert current.error is None
+        assert current.parsed.to_dict() == fiasto_py.parse_formula("y ~ x1 + x2")
+
+    @pytest.mark.parametrize("edits", [
+        [(11, 0, " + x3")],
+        [(5, 1, "9")],
+        [(4, 2, "log(x1)")],
+        [(6, 5, "")],
+        [(11, 0, " +"), (13, 0, " x3"), (9, 2, "x2*x4")],
+    ])
+    def test_matches_full_parse(self, edits):
+        """Test that edited results equal parsing the final text from scratch"""
+        current = apply_edits("y ~ x1 + x2", edits)
+
+        assert current.parsed.to_dict() == fiasto_py.parse_formula(current.formula)
+        assert current.tokens.to_list() == fiasto_py.lex_formula(current.formula)
+
+    def test_diff_reports_added_column(self):
+        """Test that the diff lists added columns and terms"""
+        current = fiasto_py.parse_incremental("y ~ x1 + x2")
+        updated, diff = current.edit(11, 0, " + x3")
+
+        assert updated.formula == "y ~ x1 + x2 + x3"
+        assert diff.added_columns == ['x3']
+        assert diff.added_terms == ['x3']
+        assert diff.removed_columns == []
+        assert diff.reparsed
+        assert current.formula == "y ~ x1 + x2"
+
+    def test_diff_reports_changed_column(self):
+        """Test that adding an interaction marks the existing columns as changed"""
+        _, diff = fiasto_py.parse_incremental("y ~ x1 + x2").edit(7, 1, "*")
+
+        assert 'x1_x2' in diff.added_terms
+        assert 'x1' in diff.changed_columns
+
+    def test_whitespace_edit_skips_parse(self):
+        """Test that whitespace-only edits reuse the previous parse"""
+        updated, diff = fiasto_py.parse_incremental("y ~ x1 + x2").edit(8, 0, "  ")
+
+        assert not diff.reparsed
+        assert diff.is_empty()
+        assert updated.parsed.formula == "y ~ x1 +   x2"
+
+    def test_invalid_intermediate_state(self):
+        """Test that editing through an invalid formula keeps the session usable"""
+        broken, diff = fiasto_py.parse_incremental("y ~ x1").edit(6, 0, " +")
+
+        assert not broken.is_valid
+        assert broken.error.startswith("Formula parsing error")
+        assert broken.parsed is None
+        assert diff.removed_columns
+
+        fixed, diff = broken.edit(8, 0, " x2")
+        assert fixed.is_valid
+        assert fixed.parsed.to_dict() == fiasto_py.parse_formula("y ~ x1 + x2")
+
+    def test_character_offsets(self):
+        """Test that offsets count characters rather than bytes"""
+        current = fiasto_py.parse_incremental("y ~ x1 + x2")
+        updated, _ = current.edit(0, 0, "µ")
+        updated, _ = updated.edit(1, 0, "y")
+        assert updated.formula == "µyy ~ x1 + x2"
+
+    def test_offset_out_of_range(self):
+        """Test that offsets past the end raise IndexError"""
+        with pytest.raises(IndexError):
+            fiasto_py.parse_incremental("y ~ x").edit(10, 0, "z")
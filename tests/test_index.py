@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for the fiasto-py FormulaIndex
+"""
+
+import pickle
+
+import pytest
+import fiasto_py
+from fiasto_py import IndexQuery as Q
+
+
+FORMULAS = [
+    "sales ~ price + promo",
+    "sales ~ log(price) + (1 + price | store)",
+    "sales ~ x1*x2*x3 + (1 | store)",
+    "y ~ x1 + x2",
+]
+
+
+@pytest.fixture
+def index():
+    """An index over FORMULAS"""
+    return fiasto_py.FormulaIndex(FORMULAS)
+
+
+class TestFormulaIndex:
+    """Test building, querying and updating a FormulaIndex"""
+
+    def test_build(self, index):
+        """Test that formulas get ids in input order"""
+        assert len(index) == len(FORMULAS)
+        assert index.ids() == list(range(len(FORMULAS)))
+        assert [index[i] for i in index.ids()] == FORMULAS
+
+    def test_column_and_role(self, index):
+        """Test queries by column and by column role"""
+        assert index.search(Q.column("price")) == [0, 1]
+        fixed = index.search(Q.column("price", role="FixedEffect"))
+        assert 0 in fixed and 2 not in fixed and 3 not in fixed
+        assert index.search(Q.column("sales", role="Response")) == [0, 1, 2]
+
+    def test_transformation(self, index):
+        """Test queries by transformation, optionally on a column"""
+        assert index.search(Q.transformation("log")) == [1]
+        assert index.search(Q.transformation("log", column="price")) == [1]
+        assert index.search(Q.transformation("log", column="promo")) == []
+
+    def test_interaction(self, index):
+        """Test queries by interaction order and member"""
+        assert index.search(Q.interaction(order=3, column="x1")) == [2]
+        assert index.search(Q.interaction()) == [2]
+        assert index.search(Q.interaction(order=2, column="promo")) == []
+
+    def test_random_effects(self, index):
+        """Test queries on random intercepts and slopes"""
+        assert index.search(Q.random_slope("store")) == [1]
+        assert index.search(Q.random_slope("store", variable="price")) == [1]
+        assert index.search(Q.random_intercept("store")) == [1, 2]
+
+    def test_boolean_queries(self, index):
+        """Test combining queries with &, |, ~ and -"""
+        store = Q.random_intercept("store")
+        assert index.search(store & Q.column("price")) == [1]
+        assert index.search(Q.column("promo") | Q.column("x3")) == [0, 2]
+        assert index.search(~store) == [0, 3]
+        assert index.search(Q.column("sales") - store) == [0]
+        assert index.count(Q.column("x1")) == 2
+
+    def test_unknown_key(self, index):
+        """Test that a key no formula has matches nothing"""
+        assert index.search(Q.column("missing")) == []
+
+    def test_add_and_remove(self, index):
+        """Test incremental updates keep queries consistent and ids unique"""
+        new_id = index.add("z ~ price + (1 | store)")
+        assert new_id == len(FORMULAS)
+        assert index.search(Q.column("promo") | Q.column("z")) == [0, new_id]
+
+        index.remove(0)
+        assert 0 not in index
+        assert len(index) == len(FORMULAS)
+        assert index.search(Q.column("promo") | Q.column("z")) == [new_id]
+        assert index.search(~Q.column("price")) == [2, 3]
+        assert index.add("w ~ a") == new_id + 1
+        with pytest.raises(IndexError):
+            index.remove(0)
+        with pytest.raises(IndexError):
+            index[0]
+
+    def test_add_many_invalid(self, index):
+        """Test that add_many skips invalid formulas and reports None"""
+        ids = index.add_many(["a ~ b", "y x1*x2", "c ~ d"])
+        assert ids[0] is not None and ids[2] is not None
+        assert ids[1] is None
+        assert index.search(Q.column("d")) == [ids[2]]
+
+    def test_invalid_raises(self):
+        """Test that building from an invalid formula raises FormulaParseError"""
+        with pytest.raises(fiasto_py.FormulaParseError):
+            fiasto_py.FormulaIndex(["y ~ x", "y x1*x2"])
+        with pytest.raises(fiasto_py.FormulaParseError):
+            fiasto_py.FormulaIndex().add("y x1*x2")
+
+
+class TestIndexPersistence:
+    """Test saving, loading and pickling a FormulaIndex"""
+
+    def test_bytes_round_trip(self, index):
+        """Test that to_bytes/from_bytes preserve ids, removals and queries"""
+        index.remove(1)
+        restored = fiasto_py.FormulaIndex.from_bytes(index.to_bytes())
+        assert restored.ids() == index.ids()
+        assert restored.search(Q.column("price")) == [0]
+        assert restored.add("q ~ r") == len(FORMULAS)
+
+    def test_save_load(self, index, tmp_path):
+        """Test writing an index to a file and reading it back"""
+        path = tmp_path / "formulas.fidx"
+        index.save(path)
+        restored = fiasto_py.FormulaIndex.load(path)
+        assert restored.search(Q.interaction(order=3)) == [2]
+
+    def test_pickle(self, index):
+        """Test that indexes pickle"""
+        restored = pickle.loads(pickle.dumps(index))
+        assert restored.search(Q.random_slope("store")) == [1]
+
+    def test_corrupt(self):
+        """Test that bad payloads raise ValueError"""
+        with pytest.raises(ValueError):
+            fiasto_py.FormulaIndex.from_bytes(b"FIAX\x01\x05")
+        with pytest.raises(ValueError):
+            fiasto_py.FormulaIndex.from_bytes(b"nope")
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for fiasto-py model matrix construction
+"""
+
+import pytest
+import fiasto_py
+
+np = pytest.importorskip("numpy")
+
+
+@pytest.fixture
+def data():
+    """Random columnar data"""
+    rng = np.random.default_rng(0)
+    return {name: rng.normal(size=50) + 2.0 for name in ["y", "x1", "x2", "x3", "z"]}
+
+
+class TestModelMatrix:
+    """Test model_matrix"""
+
+    def test_main_effects(self, data):
+        """Test intercept and main effects"""
+        X, names = fiasto_py.model_matrix("y ~ x1 + x2", data)
+
+        assert names == ['intercept', 'x1', 'x2']
+        assert X.shape == (50, 3)
+        np.testing.assert_array_equal(X[:, 0], 1.0)
+        np.testing.assert_array_equal(X[:, 1], data['x1'])
+        np.testing.assert_array_equal(X[:, 2], data['x2'])
+
+    def test_names_follow_generated_columns(self, data):
+        """Test that names follow all_generated_columns without the response"""
+        formula = "y ~ x1*x2*x3"
+        _, names = fiasto_py.model_matrix(formula, data)
+        generated = fiasto_py.parse_formula(formula)['all_generated_columns']
+
+        assert [n for n in generated if n != 'y'] == [n for n in names if n in generated]
+
+    def test_interaction(self, data):
+        """Test that interactions are elementwise products"""
+        X, names = fiasto_py.model_matrix("y ~ x1*x2", data)
+
+        np.testing.assert_allclose(X[:, names.index('x1_x2')], data['x1'] * data['x2'])
+
+    def test_no_intercept(self, data):
+        """Test that removing the intercept drops the column of ones"""
+        _, names = fiasto_py.model_matrix("y ~ x1 + x2 - 1", data)
+        assert 'intercept' not in names
+
+    def test_log_transformation(self, data):
+        """Test log transformation"""
+        X, names = fiasto_py.model_matrix("y ~ log(x1)", data)
+
+        np.testing.assert_allclose(X[:, -1], np.log(data['x1']))
+
+    def test_poly_is_orthonormal(self, data):
+        """Test that poly() columns are orthonormal and centered"""
+        X, names = fiasto_py.model_matrix("y ~ poly(x1, 3)", data)
+        P = X[:, 1:]
+
+        assert P.shape[1] == 3
+        np.testing.assert_allclose(P.T @ P, np.eye(3), atol=1e-8)
+        np.testing.assert_allclose(P.sum(axis=0), 0.0, atol=1e-8)
+
+    def test_spline_basis(self, data):
+        """Test that s() expands into a cubic B-spline basis with fitted knots"""
+        X, names = fiasto_py.model_matrix("y ~ s(x1)", data)
+        B = X[:, 1:]
+
+        assert names == ['intercept'] + [f"x1_s_{i}" for i in range(1, 10)]
+        assert B.min() >= 0.0
+        # The dropped first basis function makes up the rest of the partition of unity
+        assert B.sum(axis=1).max() <= 1.0 + 1e-12
+        np.testing.assert_allclose(B[np.argmin(data['x1'])], 0.0, atol=1e-12)
+        np.testing.assert_allclose(B[np.argmax(data['x1']), -1], 1.0)
+
+        state = fiasto_py.fit_state("y ~ s(x1)", data)
+        knots = state["s(x1, 9)"]
+        assert len(knots) == 8
+        np.testing.assert_allclose(knots[1:-1], np.quantile(data['x1'], np.arange(1, 7) / 7))
+
+    def test_spline_state_reused(self, data):
+        """Test that spline knots fitted on one dataset are applied to another"""
+        state = fiasto_py.fit_state("y ~ s(x1)", data)
+        half = {name: values[:25] for name, values in data.items()}
+        X_full, _ = fiasto_py.model_matrix("y ~ s(x1)", data)
+        X_half, _ = fiasto_py.model_matrix("y ~ s(x1)", half, state=state)
+        np.testing.assert_allclose(X_half, X_full[:25])
+
+    def test_state_per_degree(self, data):
+        """Test that poly() states of different degrees are kept apart"""
+        quadratic = fiasto_py.fit_state("y ~ poly(x1, 2)", data)
+        cubic = fiasto_py.fit_state("y ~ poly(x1, 3)", data)
+        assert not set(quadratic) & set(cubic)
+
+        state = {**quadratic, **cubic}
+        for formula in ["y ~ poly(x1, 2)", "y ~ poly(x1, 3)"]:
+            X, _ = fiasto_py.model_matrix(formula, data, state=state)
+            expected, _ = fiasto_py.model_matrix(formula, data)
+            np.testing.assert_allclose(X, expected)
+
+    def test_categorical(self, data):
+        """Test that a string column is expanded with treatment contrasts"""
+        data['g'] = np.array(["b", "a", "c", "a", "b"] * 10)
+        X, names = fiasto_py.model_matrix("y ~ x1 + g", data)
+
+        assert names == ["intercept", "x1", "g[b]", "g[c]"]
+        np.testing.assert_array_equal(X[:, 2], data['g'] == "b")
+        np.testing.assert_array_equal(X[:, 3], data['g'] == "c")
+
+    def test_categorical_levels_in_state(self, data):
+        """Test that fitted levels fix the columns for data missing some levels"""
+        data['g'] = np.array(["b", "a", "c", "a", "b"] * 10)
+        state = fiasto_py.fit_state("y ~ x1:g", data)
+        assert state['factor(g)'] == ["a", "b", "c"]
+
+        part = {name: values[:2] for name, values in data.items()}
+        X, names = fiasto_py.model_matrix("y ~ x1:g", part, state=state)
+        assert [name[name.index("["):] for name in names[1:]] == ["[a]", "[b]", "[c]"]
+        np.testing.assert_array_equal(X[:, 3], 0.0)
+
+        part['g'] = np.array(["a", "d"])
+        with pytest.raises(ValueError):
+            fiasto_py.model_matrix("y ~ x1:g", part, state=state)
+
+    def test_accepts_parsed_formula_and_lists(self, data):
+        """Test ParsedFormula input and non-array columns"""
+        parsed = fiasto_py.parse("y ~ x1")
+        X, _ = fiasto_py.model_matrix(parsed, {"y": [1, 2, 3], "x1": [4, 5, 6]})
+
+        np.testing.assert_array_equal(X[:, 1], [4.0, 5.0, 6.0])
+
+    def test_missing_column(self, data):
+        """Test that a missing column raises KeyError"""
+        with pytest.raises(KeyError):
+            fiasto_py.model_matrix("y ~ missing", data)
+
+    def test_length_mismatch(self, data):
+        """Test that columns of different lengths raise ValueError"""
+        data['x2'] = data['x2'][:10]
+        with pytest.raises(ValueError):
+            fiasto_py.model_matrix("y ~ x1 + x2", data)
+
+
+class TestDesignMatrices:
+    """Test design_matrices and Arrow input"""
+
+    def test_response_and_matrix(self, data):
+        """Test that the response and matrix match model_matrix"""
+        y, X, names = fiasto_py.design_matrices("y ~ x1 + x2", data)
+        expected_X, expected_names = fiasto_py.model_matrix("y ~ x1 + x2", data)
+
+        assert y.shape == (50,)
+        np.testing.assert_array_equal(y, data['y'])
+        np.testing.assert_array_equal(X, expected_X)
+        assert names == expected_names
+
+    def test_missing_response(self, data):
+        """Test that a missing response column raises KeyError"""
+        del data['y']
+        with pytest.raises(KeyError):
+            fiasto_py.design_matrices("y ~ x1", data)
+
+    def test_pyarrow_table(self, data):
+        """Test Arrow PyCapsule input from a pyarrow Table"""
+        pa = pytest.importorskip("pyarrow")
+        table = pa.table(data)
+
+        y, X, names = fiasto_py.design_matrices("y ~ x1*x2", table)
+        expected_y, expected_X, expected_names = fiasto_py.design_matrices("y ~ x1*x2", data)
+
+        np.testing.assert_array_equal(y, expected_y)
+        np.testing.assert_array_equal(X, expected_X)
+        assert names == expected_names
+
+    def test_pyarrow_chunks_and_nulls(self):
+        """Test multi-chunk Arrow columns and nulls as NaN"""
+        pa = pytest.importorskip("pyarrow")
+        table = pa.concat_tables([
+            pa.table({"y": [1.0, 2.0], "x": [1, None]}),
+            pa.table({"y": [3.0], "x": [3, ]}),
+        ])
+
+        X, _ = fiasto_py.model_matrix("y ~ x", table)
+        np.testing.assert_array_equal(X[:, 1], [1.0, np.nan, 3.0])
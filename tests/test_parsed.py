@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for the fiasto-py ParsedFormula and Column objects
+"""
+
+import pytest
+import fiasto_py
+
+
+class TestParsedFormula:
+    """Test parse() and the lazily converted result objects"""
+
+    def test_to_dict_matches_parse_formula(self):
+        """Test that to_dict reproduces parse_formula output"""
+        for formula in ["y ~ x1 + x2", "y ~ x1*x2*x3", "y ~ x1 + x2 + (1|group)"]:
+            assert fiasto_py.parse(formula).to_dict() == fiasto_py.parse_formula(formula)
+
+    def test_response_and_fixed_effects(self):
+        """Test the response and fixed effect column names"""
+        parsed = fiasto_py.parse("mpg ~ wt + cyl")
+
+        assert parsed.formula == "mpg ~ wt + cyl"
+        assert parsed.response == ['mpg']
+        assert parsed.fixed_effects == ['wt', 'cyl']
+        assert parsed.has_intercept is True
+
+    def test_no_intercept(self):
+        """Test intercept removal is reported"""
+        assert fiasto_py.parse("y ~ x1*x2 - 1").has_intercept is False
+
+    def test_random_effects(self):
+        """Test grouping variables and random effects"""
+        parsed = fiasto_py.parse("y ~ x1 + x2 + (1|group)")
+
+        assert parsed.is_random_effects_model is True
+        assert parsed.grouping_variables == ['group']
+        assert 'group' not in parsed.fixed_effects
+        assert parsed.random_effects['group'][0]['grouping_variable'] == 'group'
+
+    def test_columns(self):
+        """Test Column objects mirror the columns dictionary"""
+        formula = "y ~ x1*x2"
+        parsed = fiasto_py.parse(formula)
+        expected = fiasto_py.parse_formula(formula)['columns']
+
+        assert list(parsed.columns) == ['y', 'x1', 'x2']
+        for name, column in parsed.columns.items():
+            assert column.name == name
+            assert column.id == expected[name]['id']
+            assert column.roles == expected[name]['roles']
+            assert column.generated_columns == expected[name]['generated_columns']
+            assert column.interactions == expected[name]['interactions']
+            assert column.to_dict() == expected[name]
+
+    def test_getitem(self):
+        """Test dictionary-style access to top-level entries"""
+        parsed = fiasto_py.parse("y ~ x1")
+
+        assert parsed['metadata'] == parsed.metadata
+        with pytest.raises(KeyError):
+            parsed['missing']
+
+    def test_error_handling(self):
+        """Test that invalid formulas raise ValueError"""
+        with pytest.raises(ValueError):
+            fiasto_py.parse("y x1*x2")
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for fiasto-py dumps/loads and pickling of parsed formulas
+"""
+
+import pickle
+
+import pytest
+import fiasto_py
+
+FORMULAS = [
+    "y ~ x",
+    "y ~ x1*x2*x3 + log(z) + poly(w, 3)",
+    "y ~ x1 + x2 + (1 + x1 | group) + (1 | site)",
+]
+
+
+class TestDumpsLoads:
+    """Test dumps and loads"""
+
+    @pytest.mark.parametrize("formula", FORMULAS)
+    def test_roundtrip(self, formula):
+        """Test that loads(dumps(...)) restores the full parse result"""
+        restored = fiasto_py.loads(fiasto_py.dumps(fiasto_py.parse(formula)))
+
+        assert isinstance(restored, fiasto_py.ParsedFormula)
+        assert restored.to_dict() == fiasto_py.parse_formula(formula)
+
+    def test_accepts_string(self):
+        """Test that dumps parses formula strings"""
+        payload = fiasto_py.dumps("y ~ x1 + x2")
+        assert fiasto_py.loads(payload).formula == "y ~ x1 + x2"
+
+    def test_versioned_header(self):
+        """Test that payloads start with the magic bytes and a version"""
+        payload = fiasto_py.dumps("y ~ x")
+        assert payload[:4] == b"FIAS"
+        assert payload[4] == 1
+
+    def test_smaller_than_pickled_dict(self):
+        """Test that the payload is smaller than a pickled parse_formula dict"""
+        formula = "y ~ " + " + ".join(f"x{i}" for i in range(50)) + " + (1 | g)"
+        payload = fiasto_py.dumps(formula)
+        assert len(payload) < len(pickle.dumps(fiasto_py.parse_formula(formula)))
+
+    @pytest.mark.parametrize("payload", [b"", b"nope", b"FIAS\x63", fiasto_py.dumps("y ~ x")[:-1]])
+    def test_invalid_payload(self, payload):
+        """Test that bad payloads raise ValueError"""
+        with pytest.raises(ValueError):
+            fiasto_py.loads(payload)
+
+
+class TestPickle:
+    """Test pickling ParsedFormula"""
+
+    @pytest.mark.parametrize("formula", FORMULAS)
+    def test_pickle_roundtrip(self, formula):
+        """Test that ParsedFormula pickles through the compact encoding"""
+        parsed = fiasto_py.parse(formula)
+        restored = pickle.loads(pickle.dumps(parsed))
+
+        assert restored.to_dict() == parsed.to_dict()
+        assert restored.fixed_effects == parsed.fixed_effects
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for fiasto-py shared multi-formula model matrices
+"""
+
+import pytest
+import fiasto_py
+
+np = pytest.importorskip("numpy")
+
+
+FORMULAS = [
+    "y ~ x1 + x2",
+    "y ~ x1*x2",
+    "y ~ x1*x2 + log(x3)",
+    "y ~ x2:x1 + log(x3) + scale(z)",
+]
+
+
+@pytest.fixture
+def data():
+    """Random columnar data"""
+    rng = np.random.default_rng(0)
+    return {name: rng.normal(size=50) + 3.0 for name in ["y", "x1", "x2", "x3", "z"]}
+
+
+@pytest.fixture
+def shared(data):
+    """Shared matrices for FORMULAS"""
+    return fiasto_py.shared_model_matrices(FORMULAS, data)
+
+
+class TestSharedModelMatrices:
+    """Test shared_model_matrices"""
+
+    def test_matches_model_matrix(self, shared, data):
+        """Test that every formula's matrix and names match model_matrix"""
+        assert len(shared) == len(FORMULAS)
+        assert shared.formulas == FORMULAS
+        for i, formula in enumerate(FORMULAS):
+            X, names = fiasto_py.model_matrix(formula, data)
+            shared_X, shared_names = shared[i]
+            assert shared_names == names == shared.columns(i)
+            np.testing.assert_allclose(shared_X, X)
+            assert shared_X.flags.f_contiguous
+
+    def test_columns_computed_once(self, shared):
+        """Test that shared columns, including reordered interactions, are stored once"""
+        # intercept, x1, x2, log(x3), scale(z) and x1:x2
+        assert shared.store.shape == (50, 6)
+        assert len(shared.store_columns) == 6
+        assert shared.indices(1)[-1] in shared.indices(3)
+        assert shared.sharing == pytest.approx(16 / 6)
+
+    def test_store_view(self, shared):
+        """Test that indexing the store reproduces each matrix and the store is read-only"""
+        for i in range(len(shared)):
+            np.testing.assert_array_equal(shared.store[:, shared.indices(i)], shared.matrix(i))
+        assert not shared.store.flags.writeable
+        with pytest.raises(ValueError):
+            shared.store[0, 0] = 1.0
+
+    def test_iteration_and_negative_index(self, shared):
+        """Test iterating over (matrix, names) pairs and indexing from the end"""
+        pairs = list(shared)
+        assert len(pairs) == len(FORMULAS)
+        np.testing.assert_array_equal(shared.matrix(-1), pairs[-1][0])
+        with pytest.raises(IndexError):
+            shared.matrix(len(FORMULAS))
+
+    def test_state(self, shared, data):
+        """Test that the shared state is learned once and can be reused"""
+        assert set(shared.state) == {"scale(z)"}
+        half = {name: values[:25] for name, values in data.items()}
+        reused = fiasto_py.shared_model_matrices(FORMULAS, half, state=shared.state)
+        X, _ = fiasto_py.model_matrix(FORMULAS[3], half, state=shared.state)
+        np.testing.assert_allclose(reused.matrix(3), X)
+
+    def test_mixed_poly_degrees(self, data):
+        """Test that poly() terms of different degrees on one column each get their own fit"""
+        formulas = ["y ~ poly(x1, 2)", "y ~ poly(x1, 3) + x2", "y ~ poly(x1, 2) + x2"]
+        shared = fiasto_py.shared_model_matrices(formulas, data)
+        for i, formula in enumerate(formulas):
+            X, names = fiasto_py.model_matrix(formula, data)
+            assert shared.columns(i) == names
+            np.testing.assert_allclose(shared.matrix(i), X)
+        assert len(shared.state) == 2
+        # intercept, two quadratic and three cubic columns, and x2
+        assert shared.store.shape == (50, 7)
+
+    def test_categorical(self, data):
+        """Test that a categorical column is coded alike in every formula"""
+        data['g'] = np.array(["b", "a", "c", "a", "b"] * 10)
+        formulas = ["y ~ x1 + g", "y ~ g - 1", "y ~ x1:g"]
+        shared = fiasto_py.shared_model_matrices(formulas, data)
+
+        assert shared.state['factor(g)'] == ["a", "b", "c"]
+        for i, formula in enumerate(formulas):
+            X, names = fiasto_py.model_matrix(formula, data)
+            assert shared.columns(i) == names
+            np.testing.assert_array_equal(shared.matrix(i), X)
+
+    def test_serial(self, shared, data):
+        """Test that parallel=False gives the same store"""
+        serial = fiasto_py.shared_model_matrices(FORMULAS, data, parallel=False)
+        np.testing.assert_array_equal(serial.store, shared.store)
+
+    def test_invalid_formula(self, data):
+        """Test that an invalid formula raises FormulaParseError"""
+        with pytest.raises(fiasto_py.FormulaParseError):
+            fiasto_py.shared_model_matrices(["y ~ x1", "y x1*x2"], data)
+
+    def test_missing_column(self, data):
+        """Test that a column missing from the data raises KeyError"""
+        with pytest.raises(KeyError):
+            fiasto_py.shared_model_matrices(["y ~ x1 + w"], data)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for fiasto-py sparse design matrices
+"""
+
+import pytest
+import fiasto_py
+
+np = pytest.importorskip("numpy")
+
+
+@pytest.fixture
+def data():
+    """Numeric columns and a string grouping column"""
+    rng = np.random.default_rng(0)
+    return {
+        "y": rng.normal(size=12),
+        "x": rng.normal(size=12),
+        "g": np.array(["b", "a", "c"] * 4),
+    }
+
+
+def to_dense(matrix):
+    """Expand a SparseMatrix into a dense array without SciPy"""
+    dense = np.zeros(matrix.shape)
+    for outer in range(len(matrix.indptr) - 1):
+        for k in range(matrix.indptr[outer], matrix.indptr[outer + 1]):
+            if matrix.format == "csr":
+                dense[outer, matrix.indices[k]] = matrix.data[k]
+            else:
+                dense[matrix.indices[k], outer] = matrix.data[k]
+    return dense
+
+
+class TestRandomEffectsMatrix:
+    """Test random_effects_matrix"""
+
+    def test_random_intercept(self, data):
+        """Test one indicator column per level with one nonzero per row"""
+        Z = fiasto_py.random_effects_matrix("y ~ x + (1 | g)", data)
+
+        assert Z.format == "csr"
+        assert Z.shape == (12, 3)
+        assert Z.nnz == 12
+        assert Z.columns == ["intercept|g[a]", "intercept|g[b]", "intercept|g[c]"]
+        dense = to_dense(Z)
+        np.testing.assert_array_equal(dense[0], [0.0, 1.0, 0.0])
+        np.testing.assert_array_equal(dense.sum(axis=1), 1.0)
+
+    def test_random_slope(self, data):
+        """Test that slopes hold the variable's value in its level block"""
+        Z = fiasto_py.random_effects_matrix("y ~ x + (1 + x | g)", data)
+
+        assert Z.shape == (12, 6)
+        dense = to_dense(Z)
+        np.testing.assert_allclose(dense[:, Z.columns.index("x|g[a]")], np.where(data["g"] == "a", data["x"], 0.0))
+
+    def test_no_random_effects(self, data):
+        """Test that a formula without random effects raises ValueError"""
+        with pytest.raises(ValueError):
+            fiasto_py.random_effects_matrix("y ~ x", data)
+
+    def test_to_scipy(self, data):
+        """Test conversion to a SciPy sparse array"""
+        pytest.importorskip("scipy")
+        Z = fiasto_py.random_effects_matrix("y ~ x + (1 | g)", data)
+        np.testing.assert_array_equal(Z.to_scipy().toarray(), to_dense(Z))
+
+
+class TestSparseModelMatrix:
+    """Test sparse_model_matrix"""
+
+    def test_treatment_contrasts(self, data):
+        """Test that the first level is dropped when there is an intercept"""
+        X = fiasto_py.sparse_model_matrix("y ~ x + g", data)
+
+        assert X.format == "csc"
+        assert X.columns == ["intercept", "x", "g[b]", "g[c]"]
+        dense = to_dense(X)
+        np.testing.assert_array_equal(dense[:, 2], data["g"] == "b")
+        np.testing.assert_array_equal(dense[:, 1], data["x"])
+
+    def test_full_coding_without_intercept(self, data):
+        """Test that all levels are kept without an intercept"""
+        X = fiasto_py.sparse_model_matrix("y ~ g - 1", data)
+        assert X.columns == ["g[a]", "g[b]", "g[c]"]
+        assert X.nnz == 12
+
+    def test_interaction_observed_levels_only(self, data):
+        """Test that a factor interaction gets columns only for level combinations present"""
+        data = dict(data, h=np.where(data["g"] == "a", "u", "v"))
+        X = fiasto_py.sparse_model_matrix("y ~ g:h - 1", data)
+
+        assert [c[c.index("["):] for c in X.columns] == ["[a:u]", "[b:v]", "[c:v]"]
+        assert X.nnz == 12
+        dense = to_dense(X)
+        np.testing.assert_array_equal(dense[:, 1], data["g"] == "b")
+
+    def test_explicit_categorical(self, data):
+        """Test that numeric columns can be declared categorical"""
+        data = dict(data, k=np.array([2, 1, 2, 1] * 3))
+        X = fiasto_py.sparse_model_matrix("y ~ k", data, categorical=["k"])
+        assert X.columns == ["intercept", "k[2]"]
+
+    def test_matches_dense_for_numeric_terms(self, data):
+        """Test that numeric-only formulas agree with model_matrix"""
+        X, names = fiasto_py.model_matrix("y ~ x + log(y)", data)
+        S = fiasto_py.sparse_model_matrix("y ~ x + log(y)", data)
+
+        assert S.columns == names
+        np.testing.assert_allclose(to_dense(S), X)
+
+    def test_state_keeps_unobserved_levels(self, data):
+        """Test that levels from a state give empty columns for combinations not in the data"""
+        data = dict(data, h=np.where(data["g"] == "a", "u", "v"))
+        state = fiasto_py.fit_state("y ~ x + g:h", data)
+        subset = {name: values[data["g"] == "b"] for name, values in data.items()}
+        X = fiasto_py.sparse_model_matrix("y ~ x + g:h", subset, state=state)
+        dense, names = fiasto_py.model_matrix("y ~ x + g:h", subset, state=state)
+
+        assert X.columns == names
+        assert len(X.columns) == 2 + 3 * 2
+        np.testing.assert_allclose(to_dense(X), dense)
+        assert X.state["factor(g)"] == ["a", "b", "c"]
+
+    def test_state_roundtrip(self, data):
+        """Test that a result's state fixes the layout of later matrices"""
+        data = dict(data, k=np.array([2, 1, 2, 1] * 3))
+        X = fiasto_py.sparse_model_matrix("y ~ k", data, categorical=["k"])
+        subset = {name: values[data["k"] == 1] for name, values in data.items()}
+        S = fiasto_py.sparse_model_matrix("y ~ k", subset, state=X.state)
+
+        assert S.columns == X.columns == ["intercept", "k[2]"]
+        assert S.nnz == len(subset["y"])
+
+    def test_state_unknown_level(self, data):
+        """Test that a level missing from the state raises ValueError"""
+        state = fiasto_py.fit_state("y ~ g", {name: values[:2] for name, values in data.items()})
+        with pytest.raises(ValueError):
+            fiasto_py.sparse_model_matrix("y ~ g", data, state=state)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for fiasto-py instrumentation counters
+"""
+
+import asyncio
+
+import pytest
+import fiasto_py
+
+
+@pytest.fixture
+def instrumented():
+    """Enable instrumentation with fresh counters for one test"""
+    fiasto_py.enable_stats()
+    fiasto_py.reset_stats()
+    yield
+    fiasto_py.enable_stats(False)
+    fiasto_py.reset_stats()
+
+
+class TestStats:
+    """Test stats, enable_stats and reset_stats"""
+
+    def test_disabled_by_default(self):
+        """Test that phase timers do not advance while disabled"""
+        fiasto_py.reset_stats()
+        fiasto_py.parse_formula("y ~ x1 + x2")
+        stats = fiasto_py.stats()
+
+        assert stats['enabled'] is False
+        assert stats['parse'] == {'calls': 0, 'ns': 0}
+        assert stats['convert']['calls'] == 0
+
+    def test_phases(self, instrumented):
+        """Test that parse, lex and convert are timed separately"""
+        fiasto_py.parse_formula("y ~ x1*x2")
+        fiasto_py.lex_formula("y ~ x1*x2")
+        stats = fiasto_py.stats()
+
+        assert stats['enabled'] is True
+        assert stats['parse']['calls'] == 1
+        assert stats['lex']['calls'] == 1
+        assert stats['convert']['calls'] == 2
+        assert stats['convert']['objects'] > 0
+        assert stats['convert']['bytes'] > 0
+        assert stats['parse']['ns'] > 0
+
+    def test_lazy_parse_skips_conversion(self, instrumented):
+        """Test that parse() does not count as conversion"""
+        fiasto_py.parse("y ~ x1 + x2")
+        stats = fiasto_py.stats()
+
+        assert stats['parse']['calls'] == 1
+        assert stats['convert']['calls'] == 0
+
+    def test_validate_timed_separately(self, instrumented):
+        """Test that validation is timed under validate, not parse"""
+        fiasto_py.validate("y ~ x1 + x2")
+        fiasto_py.validate_many(["y ~ a", "y x1*x2"])
+        stats = fiasto_py.stats()
+
+        assert stats['validate']['calls'] == 3
+        assert stats['parse']['calls'] == 0
+
+    def test_batch(self, instrumented):
+        """Test batch call and item counts"""
+        fiasto_py.parse_formulas(["y ~ a", "y ~ b", "y ~ c"])
+        stats = fiasto_py.stats()
+
+        assert stats['batch'] == {'calls': 1, 'items': 3}
+        assert stats['parse']['calls'] == 3
+
+    def test_async_batch(self, instrumented):
+        """Test that aparse_formulas counts as a batch"""
+        async def main():
+            return await fiasto_py.aparse_formulas(["y ~ a", "y ~ b"])
+
+        asyncio.run(main())
+        assert fiasto_py.stats()['batch'] == {'calls': 1, 'items': 2}
+
+    def test_cache(self, instrumented):
+        """Test that cache hits and misses are reported"""
+        fiasto_py.configure_cache(16)
+        try:
+            fiasto_py.parse_formula("y ~ cached")
+            fiasto_py.parse_formula("y ~ cached")
+            cache = fiasto_py.stats()['cache']
+        finally:
+            fiasto_py.configure_cache(0)
+
+        assert cache['hits'] == 1
+        assert cache['misses'] == 1
+
+    def test_reset_keeps_cache_info(self, instrumented):
+        """Test that reset_stats leaves cache_info's counters alone"""
+        fiasto_py.configure_cache(16)
+        fiasto_py.cache_clear()
+        try:
+            fiasto_py.parse_formula("y ~ kept")
+            fiasto_py.parse_formula("y ~ kept")
+            fiasto_py.reset_stats()
+            info = fiasto_py.cache_info()
+            cache = fiasto_py.stats()['cache']
+        finally:
+            fiasto_py.configure_cache(0)
+
+        assert (info.hits, info.misses) == (1, 1)
+        assert (cache['hits'], cache['misses']) == (0, 0)
+
+    def test_evaluate(self, instrumented):
+        """Test that model matrix evaluation is timed"""
+        np = pytest.importorskip("numpy")
+        fiasto_py.model_matrix("y ~ x", {"y": np.ones(3), "x": np.arange(3.0)})
+        assert fiasto_py.stats()['evaluate']['calls'] >= 1
+
+    def test_reset(self, instrumented):
+        """Test that reset_stats zeroes every counter"""
+        fiasto_py.parse_formula("y ~ x")
+        fiasto_py.reset_stats()
+        stats = fiasto_py.stats()
+
+        assert stats['parse'] == {'calls': 0, 'ns': 0}
+        assert stats['convert']['objects'] == 0
+        assert stats['enabled'] is True
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for fiasto-py chunked model matrix generation
+"""
+
+import pytest
+import fiasto_py
+
+np = pytest.importorskip("numpy")
+
+
+@pytest.fixture
+def data():
+    """Random columnar data"""
+    rng = np.random.default_rng(1)
+    return {name: rng.normal(size=250) + 3.0 for name in ["y", "x1", "x2"]}
+
+
+def batches(data, size):
+    """Split columnar data into dict batches of `size` rows"""
+    n = len(data['y'])
+    return [{k: v[i:i + size] for k, v in data.items()} for i in range(0, n, size)]
+
+
+class TestIterModelMatrix:
+    """Test iter_model_matrix, fit_state and state="""
+
+    def test_chunks_match_model_matrix(self, data):
+        """Test that stacked chunks equal the in-memory matrix"""
+        chunks = fiasto_py.iter_model_matrix("y ~ x1*x2", batches(data, 37), chunk_rows=100)
+        parts = list(chunks)
+        expected, names = fiasto_py.model_matrix("y ~ x1*x2", data)
+
+        assert [p.shape[0] for p in parts] == [100, 100, 50]
+        assert chunks.columns == names
+        np.testing.assert_array_equal(np.vstack(parts), expected)
+
+    def test_small_chunks_of_large_batch(self, data):
+        """Test many small chunks cut from one large batch"""
+        parts = list(fiasto_py.iter_model_matrix("y ~ x1*x2", [data], chunk_rows=7))
+        expected, _ = fiasto_py.model_matrix("y ~ x1*x2", data)
+
+        assert [p.shape[0] for p in parts] == [7] * 35 + [5]
+        np.testing.assert_array_equal(np.vstack(parts), expected)
+
+    def test_no_data_columns(self, data):
+        """Test that a formula reading no data columns raises instead of consuming the source"""
+        with pytest.raises(ValueError):
+            fiasto_py.iter_model_matrix("y ~ 1", batches(data, 50))
+
+    def test_include_response(self, data):
+        """Test (y, X) chunks"""
+        pairs = list(fiasto_py.iter_model_matrix(
+            "y ~ x1", batches(data, 50), chunk_rows=125, include_response=True
+        ))
+
+        assert len(pairs) == 2
+        np.testing.assert_array_equal(np.concatenate([y for y, _ in pairs]), data['y'])
+
+    def test_state_required_for_iterables(self, data):
+        """Test that stateful transformations need state for one-shot sources"""
+        with pytest.raises(ValueError):
+            fiasto_py.iter_model_matrix("y ~ poly(x1, 2)", batches(data, 50))
+
+    def test_supplied_state(self, data):
+        """Test that a state from fit_state reproduces the in-memory matrix"""
+        formula = "y ~ poly(x1, 2) + x2"
+        state = fiasto_py.fit_state(formula, data)
+        parts = list(fiasto_py.iter_model_matrix(formula, batches(data, 60), state=state))
+        expected, _ = fiasto_py.model_matrix(formula, data)
+
+        np.testing.assert_allclose(np.vstack(parts), expected)
+
+    def test_state_transfers_to_new_data(self, data):
+        """Test that state= reuses constants learned on other data"""
+        formula = "y ~ poly(x1, 2)"
+        state = fiasto_py.fit_state(formula, data)
+        half = {k: v[:100] for k, v in data.items()}
+
+        X_full, _ = fiasto_py.model_matrix(formula, data)
+        X_half, _ = fiasto_py.model_matrix(formula, half, state=state)
+        np.testing.assert_allclose(X_half, X_full[:100])
+
+    @pytest.mark.parametrize("formula", ["y ~ poly(x1, 2) + x2", "y ~ s(x1) + x2"])
+    def test_csv_two_pass(self, data, tmp_path, formula):
+        """Test that a file source learns the state on a first pass"""
+        path = tmp_path / "data.csv"
+        with open(path, "w") as f:
+            f.write("y,x1,x2\n")
+            for row in zip(data['y'], data['x1'], data['x2']):
+                f.write(",".join(repr(float(v)) for v in row) + "\n")
+
+        parts = list(fiasto_py.iter_model_matrix(formula, str(path), chunk_rows=64))
+        expected, _ = fiasto_py.model_matrix(formula, data)
+
+        np.testing.assert_allclose(np.vstack(parts), expected, rtol=1e-9, atol=1e-12)
+
+    def test_categorical_state(self, data):
+        """Test that fitted levels keep the layout of chunks missing some levels"""
+        data['g'] = np.repeat(["a", "b", "c"], [100, 100, 50])
+        formula = "y ~ x1 + g"
+        state = fiasto_py.fit_state(formula, data)
+        chunks = fiasto_py.iter_model_matrix(formula, batches(data, 60), state=state)
+        parts = list(chunks)
+        expected, names = fiasto_py.model_matrix(formula, data)
+
+        assert chunks.columns == names
+        assert {part.shape[1] for part in parts} == {len(names)}
+        np.testing.assert_array_equal(np.vstack(parts), expected)
+
+        with pytest.raises(ValueError):
+            fiasto_py.iter_model_matrix(formula, batches(data, 60))
+
+    def test_categorical_csv_two_pass(self, data, tmp_path):
+        """Test that a file source collects categorical levels on the first pass"""
+        data['g'] = np.repeat(["a", "b", "c"], [100, 100, 50])
+        path = tmp_path / "data.csv"
+        with open(path, "w") as f:
+            f.write("y,x1,g\n")
+            for y, x1, g in zip(data['y'], data['x1'], data['g']):
+                f.write(f"{float(y)!r},{float(x1)!r},{g}\n")
+
+        chunks = fiasto_py.iter_model_matrix("y ~ x1:g", str(path), chunk_rows=64)
+        parts = list(chunks)
+        expected, names = fiasto_py.model_matrix("y ~ x1:g", data)
+
+        assert chunks.columns == names
+        np.testing.assert_allclose(np.vstack(parts), expected, rtol=1e-9, atol=1e-12)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for calling fiasto-py from many threads at once
+"""
+
+import sys
+import sysconfig
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import fiasto_py
+
+
+FORMULAS = [f"y ~ x{i} * z{i % 7} + log(w{i}) + (1 | g{i % 3})" for i in range(64)]
+
+
+def run_threads(function, n_threads=8):
+    """Call `function` from `n_threads` threads started together and return the results"""
+    barrier = threading.Barrier(n_threads)
+
+    def start(_):
+        barrier.wait()
+        return function()
+
+    with ThreadPoolExecutor(n_threads) as executor:
+        return list(executor.map(start, range(n_threads)))
+
+
+class TestThreads:
+    """Test concurrent use of the module's shared state"""
+
+    def test_gil_not_required(self):
+        """Test that a free-threaded interpreter keeps the GIL disabled after import"""
+        if not sysconfig.get_config_var("Py_GIL_DISABLED"):
+            pytest.skip("not a free-threaded interpreter")
+        assert not sys._is_gil_enabled()
+
+    @pytest.mark.parametrize("maxsize", [0, 16])
+    def test_parse_formula_concurrently(self, maxsize):
+        """Test that concurrent parses, with and without the cache, match serial ones"""
+        expected = [fiasto_py.parse_formula(formula) for formula in FORMULAS]
+        fiasto_py.configure_cache(maxsize)
+        try:
+            results = run_threads(lambda: [fiasto_py.parse_formula(formula) for formula in FORMULAS])
+        finally:
+            fiasto_py.configure_cache(0)
+        assert all(result == expected for result in results)
+
+    def test_cache_counts_consistent(self):
+        """Test that hits and misses add up to the number of calls"""
+        fiasto_py.configure_cache(len(FORMULAS))
+        fiasto_py.cache_clear()
+        try:
+            run_threads(lambda: [fiasto_py.parse_formula(formula) for formula in FORMULAS])
+            info = fiasto_py.cache_info()
+        finally:
+            fiasto_py.configure_cache(0)
+        assert info.hits + info.misses == 8 * len(FORMULAS)
+        assert info.currsize == len(FORMULAS)
+
+    def test_token_kinds_concurrently(self):
+        """Test that concurrent lexing assigns every thread the same kind codes"""
+        results = run_threads(lambda: [bytes(fiasto_py.lex(formula).kinds) for formula in FORMULAS])
+        assert all(result == results[0] for result in results)
+
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for the fiasto-py compact TokenStream
+"""
+
+import struct
+
+import pytest
+import fiasto_py
+
+
+def unpack_u32(buffer):
+    """Unpack a native-endian uint32 buffer into a list"""
+    return list(struct.unpack(f"={len(buffer) // 4}I", buffer))
+
+
+class TestTokenStream:
+    """Test lex() and token_kinds()"""
+
+    def test_to_list_matches_lex_formula(self):
+        """Test that to_list reproduces lex_formula output"""
+        for formula in ["y ~ x1*x2*x3", "y ~ x1 + x2 + (1|group)"]:
+            assert fiasto_py.lex(formula).to_list() == fiasto_py.lex_formula(formula)
+
+    def test_kinds_and_offsets(self):
+        """Test kind codes and byte offsets"""
+        formula = "y ~ x1 + x2"
+        stream = fiasto_py.lex(formula)
+        names = fiasto_py.token_kinds()
+
+        assert len(stream) == 5
+        assert [names[k] for k in stream.kinds] == [
+            'ColumnName', 'Tilde', 'ColumnName', 'Plus', 'ColumnName'
+        ]
+        starts = unpack_u32(stream.starts)
+        ends = unpack_u32(stream.ends)
+        assert [formula[s:e] for s, e in zip(starts, ends)] == ['y', '~', 'x1', '+', 'x2']
+
+    def test_non_ascii_offsets(self):
+        """Test that byte offsets around multi-byte column names slice cleanly"""
+        formula = "größe ~ x1 + ñame*über"
+        stream = fiasto_py.lex(formula)
+        raw = formula.encode()
+        starts = unpack_u32(stream.starts)
+        ends = unpack_u32(stream.ends)
+
+        lexemes = [raw[s:e].decode() for s, e in zip(starts, ends)]
+        assert lexemes == [token['lexeme'] for token in fiasto_py.lex_formula(formula)]
+        assert [stream.lexeme(i) for i in range(len(stream))] == lexemes
+        assert stream.to_list() == fiasto_py.lex_formula(formula)
+
+    def test_buffers_are_shared(self):
+        """Test that the buffers are created once and reused"""
+        stream = fiasto_py.lex("y ~ x")
+        assert stream.kinds is stream.kinds
+        assert memoryview(stream.starts).cast('I').tolist() == [0, 2, 4]
+
+    def test_lexeme_and_kind(self):
+        """Test single-token accessors"""
+        stream = fiasto_py.lex("y ~ x1*x2")
+
+        assert stream.lexeme(3) == '*'
+        assert stream.kind(3) == 'InteractionAndEffect'
+        with pytest.raises(IndexError):
+            stream.kind(10)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Pytest tests for fiasto-py formula validation
+"""
+
+import pytest
+import fiasto_py
+
+
+INVALID = "y x1*x2"
+
+
+class TestValidate:
+    """Test validate"""
+
+    @pytest.mark.parametrize("formula", [
+        "y ~ x",
+        "y ~ x1*x2 + log(z)",
+        "y ~ x + (1 + x | group)",
+    ])
+    def test_valid(self, formula):
+        """Test that valid formulas give None"""
+        assert fiasto_py.validate(formula) is None
+
+    def test_invalid(self):
+        """Test that an invalid formula gives the error parse_formula raises"""
+        error = fiasto_py.validate(INVALID)
+        assert isinstance(error, fiasto_py.FormulaParseError)
+        with pytest.raises(fiasto_py.FormulaParseError) as excinfo:
+            fiasto_py.parse_formula(INVALID)
+        assert str(error) == str(excinfo.value)
+        assert error.formula == INVALID
+
+    def test_does_not_populate_cache(self):
+        """Test that validation leaves the parse cache untouched"""
+        fiasto_py.configure_cache(16)
+        fiasto_py.cache_clear()
+        try:
+            fiasto_py.validate("y ~ x")
+            assert fiasto_py.cache_info().currsize == 0
+        finally:
+            fiasto_py.configure_cache(0)
+
+
+class TestValidateMany:
+    """Test validate_many"""
+
+    @pytest.mark.parametrize("parallel", [True, False])
+    def test_matches_validate(self, parallel):
+        """Test that results are in input order and agree with validate"""
+        formulas = ["y ~ x", INVALID, "y ~ a*b"]
+        results = fiasto_py.validate_many(formulas, parallel=parallel)
+        assert results[0] is None
+        assert results[2] is None
+        assert isinstance(results[1], fiasto_py.FormulaParseError)
+        assert str(results[1]) == str(fiasto_py.validate(INVALID))
+
+    def test_empty(self):
+        """Test validating an empty list"""
+        assert fiasto_py.validate_many([]) == []